@@ -1,8 +1,20 @@
+import argparse
+import functools
 import gradio as gr
+import inspect
 import os
+import queue
 import sys
+import threading
+import time
+import torch
+from collections import OrderedDict
 from pathlib import Path
 from detection import run_detection
+from models.cascade import CascadeDetector
+from utils.cache import SessionCache
+from utils.serving import FairScheduler, cpu_workers
+from utils.torch_utils import select_device
 from train import run_training
 from val import run_validation
 from difference import run_diff_detection
@@ -14,6 +26,118 @@ ROOT = FILE.parents[0]  # YOLOv5 root directory
 if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+GALLERY_FRAMES = 24  # most recent annotated images shown while a detection run streams
+UPDATE_INTERVAL = 0.5  # minimum seconds between streamed UI updates
+SCHEDULER = FairScheduler(workers=1)  # detection runs, configured by main()
+SESSIONS = 8  # most recent sessions keeping their raw predictions for re-thresholding
+SESSION_CACHE_MB = 256  # in-memory predictions per session, spilled to a temporary file beyond
+SESSION_CACHES = OrderedDict()  # session hash: SessionCache, least recent first
+SESSION_LOCK = threading.Lock()
+DETECT_WEIGHTS = os.path.join(ROOT, 'best-solar.pt')  # detection tab defaults, main() warms the registry with these
+DETECT_DATA = os.path.join(ROOT, 'data.yaml')
+DETECT_DEVICE = 'cpu'  # main() sets the detection tab devices to --device
+DETECT_DEVICES = []  # device inputs of the detection tabs
+DETECT_FP16 = False
+DETECT_INPUTS = ('weights', 'source', 'data', 'img_height', 'img_width', 'conf_thres', 'iou_thres', 'max_det', 'device',
+                 'view_img', 'save_txt', 'save_conf', 'save_crop', 'nosave', 'classes', 'agnostic_nms', 'augment',
+                 'visualize', 'update', 'project', 'name', 'exist_ok', 'line_thickness', 'hide_labels', 'hide_conf',
+                 'half', 'dnn')  # run_detection() and run_diff_detection() inputs, in UI order
+
+
+def queued(request, progress):
+    # Wait for an inference worker, round robin between sessions, showing the queue position. Yields no-op updates
+    # while waiting so a queued run can be cancelled, returns the granted Ticket
+    try:
+        ticket = SCHEDULER.ticket(request.session_hash if request else None)
+    except OverflowError as e:
+        raise gr.Error(f'Server busy, {e}. Please try again later.')
+    try:
+        while not ticket.wait(1.0):
+            progress(None, desc=f'Queued, position {ticket.position()} of {len(SCHEDULER)}')
+            yield gr.update(), gr.update()
+    except BaseException:
+        ticket.release()  # cancelled while queued
+        raise
+    return ticket
+
+
+def session_cache(request):
+    # Raw predictions of the session's previous runs, re-runs of the same frames with other thresholds only re-run NMS.
+    # None without a session, runs of unknown users never share one
+    key = request.session_hash if request else None
+    if key is None:
+        return None
+    with SESSION_LOCK:
+        if key in SESSION_CACHES:
+            SESSION_CACHES.move_to_end(key)
+        else:
+            SESSION_CACHES[key] = SessionCache(max_mb=SESSION_CACHE_MB)
+            while len(SESSION_CACHES) > SESSIONS:
+                SESSION_CACHES.popitem(last=False)[1].close()
+        return SESSION_CACHES[key]
+
+
+def detection_inputs(fn):
+    # Give a generator fn(*args, request=None, progress=gr.Progress()) the positional signature of the DETECT_INPUTS.
+    # Gradio stops looking for special parameters at *args, so request and progress must be positional to be injected
+    n, extra = len(DETECT_INPUTS), [p for p in inspect.signature(fn).parameters.values() if p.kind == p.KEYWORD_ONLY]
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return (yield from fn(*args[:n], **dict(zip((p.name for p in extra), args[n:])), **kwargs))
+
+    wrapper.__signature__ = inspect.Signature([
+        *(inspect.Parameter(k, inspect.Parameter.POSITIONAL_OR_KEYWORD) for k in DETECT_INPUTS),
+        *(p.replace(kind=p.POSITIONAL_OR_KEYWORD) for p in extra)])
+    return wrapper
+
+
+@detection_inputs
+def stream_detection(*args, request: gr.Request = None, progress=gr.Progress()):
+    # Run detection on a background thread, streaming annotated frames to the gallery with frames done / total and
+    # throughput. Cancelling the event stops the run after its current batch, keeping the results saved so far
+    with (yield from queued(request, progress)):
+        yield from detection_updates(*args, progress=progress, cache=session_cache(request))
+
+
+@detection_inputs
+def queued_diff_detection(*args, request: gr.Request = None, progress=gr.Progress()):
+    # Run difference detection once an inference worker is free
+    with (yield from queued(request, progress)):
+        yield run_diff_detection(*args)
+
+
+def detection_updates(*args, progress, **kwargs):
+    updates, stop = queue.Queue(), threading.Event()
+
+    def target():
+        try:
+            updates.put(('done', run_detection(*args, progress=updates.put, stop=stop, **kwargs)))
+        except Exception as e:
+            updates.put(('error', e))
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    gallery, t = [], 0.0
+    try:
+        while True:
+            x = updates.get()
+            if isinstance(x, dict):  # frame done
+                name = Path(x['path']).name
+                gallery = (gallery + [(im[..., ::-1], name) for im in x['images']])[-GALLERY_FRAMES:]  # BGR to RGB
+                desc = f"{x['seen']}/{x['total'] or '?'} frames, {x['fps']:.1f} FPS"
+                progress((x['seen'], x['total']) if x['total'] else None, desc=desc)
+                if time.time() - t > UPDATE_INTERVAL:
+                    t = time.time()
+                    yield gallery, None
+            elif x[0] == 'error':
+                raise x[1]
+            else:  # all saved images and label files
+                yield x[1]
+                return
+    finally:
+        stop.set()  # cancelled
+        thread.join()
 
 
 with gr.Blocks() as iface:
@@ -26,16 +150,17 @@ with gr.Blocks() as iface:
                 # Grouping file inputs and source details
                 gr.Markdown("### File Inputs")
                 with gr.Row():
-                    weights = gr.Textbox(value=os.path.join(ROOT, 'best-solar.pt'), label='Weights', placeholder='Enter model paths separated by space', info='model path(s)')
+                    weights = gr.Textbox(value=DETECT_WEIGHTS, label='Weights', placeholder='Enter model paths separated by space', info='model path(s)')
                     source = gr.Textbox(label='Source', value=os.path.join(ROOT, 'test_folder'), info='file/dir/URL/glob, 0 for webcam', placeholder='Enter source path')
-                    data = gr.Textbox(label='Data', value=os.path.join(ROOT, 'data.yaml'), info='(optional) dataset.yaml path', placeholder='Enter dataset.yaml path')
+                    data = gr.Textbox(label='Data', value=DETECT_DATA, info='(optional) dataset.yaml path', placeholder='Enter dataset.yaml path')
 
                 # Grouping image specifications
                 gr.Markdown("### Image Specifications")
                 with gr.Row():
                     image_height = gr.Number(label='Image Height', value=640, info='Inference image size height')
                     image_width = gr.Number(label='Image Width', value=640, info='Inference image size width')
-                    device = gr.Radio(choices=['cpu', '0', '1', '2', '3'], label='Device', value='cpu', info='CUDA device, i.e. 0 or 0,1,2,3 or CPU')
+                    device = gr.Radio(choices=['cpu', '0', '1', '2', '3'], label='Device', value=DETECT_DEVICE, info='CUDA device, i.e. 0 or 0,1,2,3 or CPU')
+                    DETECT_DEVICES.append(device)
 
                 # Grouping detection settings
                 gr.Markdown("### Detection Settings")
@@ -67,7 +192,7 @@ with gr.Blocks() as iface:
                     line_thickness = gr.Slider(minimum=1, maximum=10, step=1, value=3, label='Line Thickness', info='Bounding box thickness (pixels)')
                     hide_labels = gr.Checkbox(value=False, label='Hide Labels', info='Hide labels on images')
                     hide_confidence = gr.Checkbox(value=False, label='Hide Confidence', info='Hide confidence on images')
-                    use_fp16 = gr.Checkbox(value=False, label='Use FP16 Half-Precision Inference', info='Use FP16 half-precision inference')
+                    use_fp16 = gr.Checkbox(value=DETECT_FP16, label='Use FP16 Half-Precision Inference', info='Use FP16 half-precision inference')
                     use_opencv = gr.Checkbox(value=False, label='Use OpenCV DNN for ONNX Inference', info='Use OpenCV DNN for ONNX inference')
 
             with gr.Column():
@@ -78,17 +203,21 @@ with gr.Blocks() as iface:
                     saved_text_files = gr.File(label='Saved Text Files')
 
             with gr.Column():
-                # Submit Button
-                submit_button_detection = gr.Button("Run Detection")
-                submit_button_detection.click(
-                    run_detection,
+                # Submit and Cancel Buttons
+                with gr.Row():
+                    submit_button_detection = gr.Button("Run Detection")
+                    cancel_button_detection = gr.Button("Cancel")
+                detection_event = submit_button_detection.click(
+                    stream_detection,
                     inputs=[
                         weights, source, data, image_height, image_width, confidence_threshold, nms_iou_threshold, max_detections, device, view_image, save_text,
                         save_confidence, save_crop, no_save, classes, class_agnostic_nms, augment, visualize, update, project, name, exist_ok, line_thickness,
                         hide_labels, hide_confidence, use_fp16, use_opencv
                     ],
-                    outputs=[saved_images, saved_text_files]
+                    outputs=[saved_images, saved_text_files],
+                    concurrency_limit=None  # limited by SCHEDULER
                 )
+                cancel_button_detection.click(None, cancels=[detection_event])
 
         with gr.Tab("Image Training"):
             gr.Markdown("## Image Training \nConfigure and initiate the training of your model. Set parameters such as epochs, batch size, and more below.")
@@ -242,16 +371,17 @@ with gr.Blocks() as iface:
                 # Grouping model and source settings
                 gr.Markdown("### Model and Source Settings")
                 with gr.Row():
-                    weights = gr.Textbox(value=os.path.join(ROOT, 'best-solar.pt'), label='Weights', placeholder='Enter model paths separated by space', info='model path(s)')
+                    weights = gr.Textbox(value=DETECT_WEIGHTS, label='Weights', placeholder='Enter model paths separated by space', info='model path(s)')
                     source = gr.Textbox(label='Source', value=os.path.join(ROOT, 'test_folder'), info='file/dir/URL/glob, 0 for webcam', placeholder='Enter source path')
-                    data = gr.Textbox(label='Data', value=os.path.join(ROOT, 'data.yaml'), info='(optional) dataset.yaml path', placeholder='Enter dataset.yaml path')
+                    data = gr.Textbox(label='Data', value=DETECT_DATA, info='(optional) dataset.yaml path', placeholder='Enter dataset.yaml path')
 
                 # Grouping image processing parameters
                 gr.Markdown("### Image Processing Parameters")
                 with gr.Row():
                     image_height = gr.Number(label='Image Height', value=640, info='Inference image size height')
                     image_width = gr.Number(label='Image Width', value=640, info='Inference image size width')
-                    device = gr.Radio(choices=['cpu', '0', '1', '2', '3'], label='Device', value='cpu', info='CUDA device, i.e. 0 or 0,1,2,3 or CPU')
+                    device = gr.Radio(choices=['cpu', '0', '1', '2', '3'], label='Device', value=DETECT_DEVICE, info='CUDA device, i.e. 0 or 0,1,2,3 or CPU')
+                    DETECT_DEVICES.append(device)
                 
                 # Grouping detection settings
                 gr.Markdown("### Detection Settings")
@@ -282,7 +412,7 @@ with gr.Blocks() as iface:
                     line_thickness = gr.Slider(minimum=1, maximum=10, step=1, value=3, label='Line Thickness', info='Bounding box thickness (pixels)')
                     hide_labels = gr.Checkbox(value=False, label='Hide Labels', info='Hide labels on images')
                     hide_confidence = gr.Checkbox(value=False, label='Hide Confidence', info='Hide confidence on images')
-                    use_fp16 = gr.Checkbox(value=False, label='Use FP16 Half-Precision Inference', info='Use FP16 half-precision inference')
+                    use_fp16 = gr.Checkbox(value=DETECT_FP16, label='Use FP16 Half-Precision Inference', info='Use FP16 half-precision inference')
                     use_opencv = gr.Checkbox(value=False, label='Use OpenCV DNN for ONNX Inference', info='Use OpenCV DNN for ONNX inference')
 
             with gr.Column():
@@ -296,7 +426,7 @@ with gr.Blocks() as iface:
                 # Submit Button
                 submit_button_diff_detection = gr.Button("Run Diff Detection")
                 submit_button_diff_detection.click(
-                    run_diff_detection,
+                    queued_diff_detection,
                     inputs=[
                         weights, source, data, image_height, image_width, confidence_threshold, nms_iou_threshold, 
                         max_detections, device, view_image, save_text, save_confidence, save_crop, 
@@ -304,7 +434,8 @@ with gr.Blocks() as iface:
                         project, name, exist_ok, line_thickness, hide_labels, hide_confidence, 
                         use_fp16, use_opencv
                     ],
-                    outputs=[saved_images, saved_text_files]
+                    outputs=[saved_images, saved_text_files],
+                    concurrency_limit=None  # limited by SCHEDULER
                 )
 
         with gr.Tab("Model Export"):
@@ -375,5 +506,33 @@ with gr.Blocks() as iface:
                     outputs=export_output
                 )
 
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default=DETECT_DEVICE, choices=['cpu', '0', '1', '2', '3'],
+                        help='device models are loaded and warmed up on, default device of the detection tabs')
+    parser.add_argument('--workers', type=int, default=0, help='concurrent detection runs, 0 for auto (1 on CUDA, '
+                        'one per 4 cores on CPU)')
+    parser.add_argument('--max-queue', type=int, default=32, help='maximum queued detection runs')
+    parser.add_argument('--port', type=int, default=None, help='server port, default 7860')
+    return parser.parse_args()
+
+
+def main(opt):
+    # Warm models shared by all workers, bounded fair job queue and CPU intra-op threads split between workers
+    global SCHEDULER
+    device = select_device(opt.device)
+    for x in DETECT_DEVICES:
+        x.value = opt.device  # UI runs use the warmed up registry key
+    workers = opt.workers or 1
+    if device.type == 'cpu':
+        workers, threads = cpu_workers(opt.workers)
+        torch.set_num_threads(threads)  # process wide, workers running at once share the cores
+    SCHEDULER = FairScheduler(workers, max_queue=opt.max_queue)
+    # Load the three PV models into the shared registry once, with the registry key of the detection tab defaults
+    CascadeDetector(weights=DETECT_WEIGHTS, device=device, data=DETECT_DATA, half=DETECT_FP16).warmup()
+    iface.queue(max_size=opt.max_queue + workers).launch(server_port=opt.port, max_threads=opt.max_queue + workers + 8)
+
+
 if __name__ == '__main__':
-    iface.launch()
\ No newline at end of file
+    opt = parse_opt()
+    main(opt)
\ No newline at end of file
@@ -1,9 +1,11 @@
 import argparse
+import json
 import os
 import sys
-import numpy as np
+import time
 from pathlib import Path
 
+import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 
@@ -13,12 +15,20 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
-from models.common import DetectMultiBackend
-from utils.datasets import IMG_FORMATS, VID_FORMATS, LoadImages, LoadStreams
-from utils.general import (LOGGER, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
-                           increment_path, non_max_suppression, print_args, scale_coords, strip_optimizer, xyxy2xywh, apply_classifier)
-from utils.plots import Annotator, colors, save_one_box
-from utils.torch_utils import select_device, time_sync
+from models.cascade import TASKS, CascadeDetector
+from utils.cache import CACHE_MB, ResultCache
+from utils.datasets import IMG_FORMATS, STREAM_POLICIES, VID_FORMATS, LoadImages, LoadImagesPrefetch, LoadStreams
+from utils.general import (LOGGER, check_file, check_imshow, check_requirements, colorstr, cv2, increment_path,
+                           print_args, strip_optimizer, xyxy2xywh)
+from utils.plots import Annotator, ReplayViewer, colors, plot_anomalies
+from utils.store import ResultsStore
+from utils.serving import ProcessDetector
+from utils.thermal import Radiometric
+from utils.thermal import hotspots as measure_hotspots
+from utils.tiling import TILE_MERGES, LoadRasters, TiledDetector
+from utils.torch_utils import select_device
+from utils.tracking import CascadeTracker
+from utils.writers import ImageWriter, LabelWriter
 
 
 @torch.no_grad()
@@ -31,7 +41,7 @@ def run(
         iou_thres=0.45,  # NMS IOU threshold
         max_det=1000,  # maximum detections per image
         device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
-        view_img=True,  # show results
+        view_img=False,  # replay results in a background viewer
         save_txt=False,  # save results to *.txt
         save_conf=False,  # save confidences in --save-txt labels
         save_crop=False,  # save cropped prediction boxes
@@ -49,6 +59,35 @@ def run(
         hide_conf=False,  # hide confidences
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
+        weights_fault=ROOT / 'best.pt',  # fault model.pt path
+        weights_single=ROOT / 'best-singlemodule.pt',  # single PV module model.pt path
+        batch_size=1,  # frames per cascade batch (image/video sources)
+        parallel=False,  # run the three models concurrently
+        save_jsonl=False,  # save --save-txt labels to one labels.jsonl instead of *.txt files
+        save_results=False,  # save all boxes to a columnar results store
+        image_format=None,  # saved image format, i.e. jpg, png or webp, default the source format
+        image_quality=95,  # saved JPEG/WebP image quality
+        renders=('arrays', 'modules', 'anomalies'),  # annotated images to save per source image
+        workers=4,  # image decode/letterbox threads, 0 to load on the main thread
+        prefetch=32,  # maximum frames prefetched ahead of inference
+        fold_scale=False,  # fold the 1/255 input scale into the first conv of the PyTorch models
+        progress=None,  # callback called with a progress dict after every frame
+        stop=None,  # threading.Event, stop after the current batch once set
+        processes=0,  # CPU inference worker processes sharing the models, 0 to run in this process
+        cache=None,  # result cache directory or ResultCache/SessionCache, re-runs skip inference, None to disable
+        cache_mb=CACHE_MB,  # result cache size budget (MB)
+        stream_policy='latest',  # stream frames to infer, 'latest' drops frames inference can't keep up with, 'every'
+        stream_buffer=8,  # frames queued per stream
+        tile=0,  # tiled inference of large images and orthomosaics with this tile size (pixels), 0 to disable
+        tile_overlap=0.2,  # overlap between neighbouring tiles, fraction of the tile size
+        tile_merge='nmm',  # seam box merging, 'nmm' (union), 'nms' or 'wbf'
+        radiometric=False,  # read 16-bit/float radiometric image frames, normalized over thermal_range
+        thermal_range='frame',  # radiometric normalization range, 'frame', 'survey' or (lo, hi) in °C
+        thermal_scale=1.0,  # radiometric raw value to °C scale
+        thermal_offset=0.0,  # radiometric raw value to °C offset
+        hotspots=False,  # measure module and fault max/mean/p95 temperature and ΔT vs their PV array
+        track=False,  # track detections across ordered image frames and videos, one record per physical fault
+        track_min_hits=3,  # frames a fault must be tracked in to be reported
 ):
     """
     Run the automatic faults detection on photovoltaic farms using thermal images.
@@ -62,7 +101,7 @@ def run(
         iou_thres (float): NMS IOU threshold.
         max_det (int): Maximum detections per image.
         device (str): CUDA device, i.e. 0 or 0,1,2,3 or cpu.
-        view_img (bool): Whether to show the results.
+        view_img (bool): Whether to replay the PV array, module and fault association in a background viewer.
         save_txt (bool): Whether to save the results to *.txt files.
         save_conf (bool): Whether to save confidences in --save-txt labels.
         save_crop (bool): Whether to save cropped prediction boxes.
@@ -80,6 +119,54 @@ def run(
         hide_conf (bool): Whether to hide confidences.
         half (bool): Whether to use FP16 half-precision inference.
         dnn (bool): Whether to use OpenCV DNN for ONNX inference.
+        weights_fault (str or Path): Path to the fault model weights file.
+        weights_single (str or Path): Path to the single PV module model weights file.
+        batch_size (int): Number of frames run through the cascade at once for image/video sources.
+        parallel (bool): Whether to run the three models concurrently (CUDA streams or CPU threads).
+        save_jsonl (bool): Whether to append all labels to a single labels.jsonl file instead of one *.txt per image.
+        save_results (bool): Whether to save every array, module and fault box with its parent array to a
+            results.parquet (results.db without pyarrow) store, see utils/store.py for queries.
+        image_format (str): Saved image format, i.e. 'jpg', 'png' or 'webp', default the source image format.
+        image_quality (int): Saved JPEG/WebP image quality 0-100.
+        renders (tuple): Annotated images saved per source image, any of 'arrays' (*_panel_detection), 'modules'
+            (*_panel_block_detection) and 'anomalies' (*_anomaly_detection). Videos always use 'modules'.
+        workers (int): Threads decoding and letterboxing image/video frames ahead of inference, 0 to disable.
+        prefetch (int): Maximum number of frames prefetched ahead of inference.
+        fold_scale (bool): Fold the 1/255 input scale into the first conv of the PyTorch models, skipping the
+            per-frame scaling.
+        progress (callable, optional): Called after every frame with a dict of 'path', 'frame', 'seen' (frames done),
+            'total' (frames in the source, None for streams), 'fps', 'result' (CascadeResult) and 'images' (annotated
+            BGR images of the frame, not to be modified).
+        stop (threading.Event, optional): Stops the run after the current batch once set, saving results so far.
+        processes (int): Run the cascade in this many CPU worker processes sharing the models in shared memory, each
+            with cores / processes torch threads, see utils/benchmarks.py --processes for the optimum. 0 to disable.
+        cache (str or Path or ResultCache, optional): Result cache directory, or a ResultCache or SessionCache shared
+            between runs. Per-frame NMS candidates are cached by frame content and model, re-runs with only display or
+            output changes or stricter thresholds skip inference. Not used with processes.
+        cache_mb (float): Result cache size, least recently used entries are deleted beyond it.
+        stream_policy (str): Stream sources only, 'latest' infers the newest frame of each stream and drops frames
+            inference can't keep up with, 'every' infers every decoded frame, slowing down the readers if needed.
+        stream_buffer (int): Stream sources only, decoded frames queued per stream.
+        tile (int): Run the cascade over overlapping tiles of this size, batch_size tiles at a time, and merge the
+            boxes to one result per image. Large .npy and TIFF sources are read by window, one batch of tiles at a time.
+            Labels only, annotated images, crops and the viewer are disabled. 0 to disable.
+        tile_overlap (float): Overlap between neighbouring tiles as a fraction of the tile size.
+        tile_merge (str): Merging of boxes cut by tile seams, 'nmm' (union), 'nms' (keep the most confident) or 'wbf'
+            (confidence weighted fusion).
+        radiometric (bool): Read image frames at their bit depth, 16-bit/float frames (i.e. 16-bit TIFF, PNG or .npy
+            temperature arrays) are normalized to 8-bit, run as 1-channel tensors and keep a °C view as
+            CascadeResult.temperature. 8-bit images and videos are read as before.
+        thermal_range (str or tuple): Radiometric normalization range, 'frame' for the min-max of each frame,
+            'survey' for one range fitted on up to 32 frames of the source, or a fixed (lo, hi) range in °C.
+        thermal_scale (float): Radiometric raw value to °C scale, i.e. 0.01 for centikelvin counts.
+        thermal_offset (float): Radiometric raw value to °C offset, i.e. -273.15 for centikelvin counts.
+        hotspots (bool): Measure the max, mean and p95 temperature of every module and fault and their ΔT against the
+            median module of the same PV array into CascadeResult.stats, on the radiometric temperature if available
+            else on the frame intensity.
+        track (bool): Track arrays, modules and faults across the ordered image frames or each video/stream into
+            CascadeResult.ids, compensating camera motion between frames, and save one record per tracked fault to
+            tracks.jsonl.
+        track_min_hits (int): Frames a fault must be tracked in to be reported in tracks.jsonl.
     """
     if isinstance(weights, str):
         weights = weights.split()
@@ -88,6 +175,7 @@ def run(
     #print(f"weights: {weights}, source: {source}, data: {data}, imgsz: {imgsz}, conf_thres: {conf_thres}, iou_thres: {iou_thres}, max_det: {max_det}, device: {device}, view_img: {view_img}, save_txt: {save_txt}, save_conf: {save_conf}, save_crop: {save_crop}, nosave: {nosave}, classes: {classes}, agnostic_nms: {agnostic_nms}, augment: {augment}, visualize: {visualize}, update: {update}, project: {project}, name: {name}, exist_ok: {exist_ok}, line_thickness: {line_thickness}, hide_labels: {hide_labels}, hide_conf: {hide_conf}, half: {half}, dnn: {dnn}")
 
     source = str(source)
+    save_txt |= save_jsonl
     save_img = not nosave and not source.endswith('.txt')  # save inference images
     is_file = Path(source).suffix[1:] in (IMG_FORMATS + VID_FORMATS)
     is_url = source.lower().startswith(('rtsp://', 'rtmp://', 'http://', 'https://'))
@@ -99,327 +187,188 @@ def run(
     save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
     (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
-    # Load model
+    # Load models (cached in the process-wide registry, loaded from disk only on first use or when changed)
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
-    stride, names, pt = model.stride, model.names, model.pt
-    imgsz = check_img_size(imgsz, s=stride)  # check image size
-
-    weights_fault = "best.pt"
-    model_fault = DetectMultiBackend(weights_fault, device=device, dnn=dnn, data=data, fp16=half)
-    # stride_fault, names_fault, pt_fault = model_fault.stride, model_fault.names, model_fault.pt
-
-    weights_single = "best-singlemodule.pt"
-    model_single = DetectMultiBackend(weights_single, device=device, dnn=dnn, data=data, fp16=half)
-    # stride_single, names_single, pt_single = model_single.stride, model_single.names, model_single.pt
+    kwargs = dict(weights=weights, weights_fault=weights_fault, weights_single=weights_single, device=device,
+                  imgsz=imgsz, data=data, half=half, dnn=dnn, conf_thres=conf_thres, iou_thres=iou_thres,
+                  classes=classes, agnostic_nms=agnostic_nms, max_det=max_det, parallel=parallel, fold_scale=fold_scale)
+    if tile and processes:
+        LOGGER.warning('WARNING: --processes is not supported with --tile, running in this process')
+        processes = 0
+    if tile and (save_img or save_crop or view_img):
+        LOGGER.warning('WARNING: --tile saves labels and results only, no annotated images, crops or viewer')
+        save_img = save_crop = view_img = False
+    if tile and track:
+        LOGGER.warning('WARNING: --track is not supported with --tile, tiled images are not a frame sequence')
+        track = False
+    if cache and processes:
+        LOGGER.warning('WARNING: --cache is not supported with --processes, running without the result cache')
+        cache = None
+    elif cache and not isinstance(cache, ResultCache):
+        cache = ResultCache(cache, max_mb=cache_mb)
+    cascade = ProcessDetector(processes, **kwargs) if processes else CascadeDetector(cache=cache, **kwargs)
+    if tile:
+        cascade = TiledDetector(cascade, tile, tile_overlap, batch_size, tile_merge)
+    stride, names, pt = cascade.stride, cascade.names, cascade.pt
+    imgsz = cascade.imgsz
 
     # Dataloader
-    if webcam:
-        view_img = check_imshow()
+    if isinstance(thermal_range, (list, tuple)):  # --thermal-range frame, survey or LO HI
+        thermal_range = tuple(map(float, thermal_range)) if len(thermal_range) == 2 else thermal_range[0]
+    radiometric = Radiometric(thermal_range, thermal_scale, thermal_offset) if radiometric else None
+    if tile:
+        dataset = LoadRasters(source, radiometric)  # images read by window, tiles read by the cascade
+        bs = 1  # images per batch, batch_size tiles per cascade batch
+    elif webcam:
         cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt)
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, policy=stream_policy,
+                              buffer=stream_buffer, workers=workers)
         bs = len(dataset)  # batch_size
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt)
-        bs = 1  # batch_size
-    vid_path, vid_writer = [None] * bs, [None] * bs
+        auto = pt and batch_size == 1  # fixed size letterbox for stackable batches
+        dataset = LoadImagesPrefetch(source, img_size=imgsz, stride=stride, auto=auto, workers=workers,
+                                     depth=max(prefetch, batch_size), radiometric=radiometric) if workers else \
+            LoadImages(source, img_size=imgsz, stride=stride, auto=auto, radiometric=radiometric)
+        bs = batch_size  # batch_size
+    if radiometric and radiometric.span == 'survey' and not webcam:
+        radiometric.fit([f for f, v in zip(dataset.files, dataset.video_flag) if not v])
+    images = ImageWriter(fmt=image_format, quality=image_quality)  # bounded background encoding
+    viewer = ReplayViewer() if view_img and check_imshow() else None  # headless unless a display is requested
+    labels = LabelWriter(save_dir / 'labels.jsonl' if save_jsonl else None, background=True)  # one write per image
+    store = ResultsStore(save_dir, survey=save_dir.name) if save_results else None
+    trackers = {}  # CascadeTracker per frame sequence, the ordered images or each video/stream
 
     # Run inference
-    model.warmup(imgsz=(1 if pt else bs, 3, *imgsz))  # warmup
-    dt, seen = [0.0, 0.0, 0.0], 0
-    for path, im, im0s, vid_cap, s in dataset:
-        t1 = time_sync()
-        im = torch.from_numpy(im).to(device)
-        im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-        im /= 255  # 0 - 255 to 0.0 - 1.0
-        if len(im.shape) == 3:
-            im = im[None]  # expand for batch dim
-        t2 = time_sync()
-        dt[0] += t2 - t1
-
-        # Inference
-        visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-        pred = model(im, augment=augment, visualize=visualize)
-        t3 = time_sync()
-        dt[1] += t3 - t2
-
-        # NMS
-        pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
-        dt[2] += time_sync() - t3
-
-        # Second-stage classifier (optional)
-        # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
-
-        pred_full_solar_modules = []
-        prob_full_solar_modules = []
-
+    seen, t0 = 0, time.time()
+    total = frame_count(dataset) if progress and not webcam else None
+    batches = batch_loader(dataset, bs, webcam)
+    batches = cascade.imap(batches) if processes or tile else \
+        infer_batches(cascade, batches, bs, save_dir, augment, visualize)
+    for batch, results in batches:
         # Process predictions
-        for i, det in enumerate(pred):  # per image
+        for i, ((path, im, im0s, vid_cap, s, mode, frame, temperature), r) in enumerate(zip(batch, results)):
             seen += 1
-            if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                s += f'{i}: '
-            else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
-
-            p = Path(p)  # to Path
+            r.temperature = temperature
+            if hotspots:
+                measure_hotspots(r, im0s)
+            if track:  # after hotspots, tracks keep their max ΔT
+                key = path if mode != 'image' else ''  # images of mixed folders also carry the video capture
+                if key not in trackers:
+                    trackers[key] = CascadeTracker(min_hits=track_min_hits, names=names)
+                trackers[key].update(r, im0s, path, frame)
+            p = Path(path)  # to Path
             save_path = str(save_dir / p.name)  # im.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-            s += '%gx%g ' % im.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            imc = im0.copy() if save_crop else im0  # for save_crop
-            annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
+            txt_path = str(save_dir / 'labels' / p.stem) + ('' if mode == 'image' else f'_{frame}')  # im.txt
+            s += '%gx%g ' % im.shape[1:]  # print string
+            gn = np.array(im0s.shape, dtype=np.float32)[[1, 0, 1, 0]]  # normalization gain whwh
+            imc = im0s.copy() if save_crop else im0s  # for save_crop
+            rendered = []  # annotated images of this frame, for progress
+            annotators = {
+                k: Annotator(im0s.copy(), line_width=line_thickness, example=str(names['arrays']))
+                for k in ('arrays', 'modules') if save_img and (k in renders or mode != 'image')}
+
+            # Arrays, faults and single modules share one labels file per image, detections are host-side already
+            for k in TASKS:
+                det, annotator = r[k][::-1], annotators.get(k)
 
                 # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+                for c, n in zip(*np.unique(det['cls'], return_counts=True)):
+                    s += f"{n} {names[k][c]}{'s' * int(n > 1)}, "  # add to string
 
                 # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    x1 = xyxy[0].detach().cpu().clone().numpy()
-                    y1 = xyxy[1].detach().cpu().clone().numpy()
-                    x2 = xyxy[2].detach().cpu().clone().numpy()
-                    y2 = xyxy[3].detach().cpu().clone().numpy()
-                    prob= conf.detach().cpu().clone().numpy().item()
-                    # print(x1.ndim)
-                    pred_full_solar_modules.append([float(x1), float(y1), float(x2), float(y2)])
-                    prob_full_solar_modules.append(prob)
-
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or save_crop or view_img:  # Add bbox to image
-                        c = int(cls)  # integer class
-                        label = f' {conf:.2f}'
-                        annotator.box_label(xyxy, label, color=colors(c, True))
-                        if save_crop:
-                            save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-
-            # Stream results
-            im1 = annotator.result()
-            if view_img:
-                cv2.imshow(str(p), im1)
-                cv2.waitKey(0)  # Wait until a key is pressed or the window is closed
-                cv2.destroyAllWindows()
-
-        pred = model_fault(im, augment=augment, visualize=visualize)
-        t3 = time_sync()
-        dt[1] += t3 - t2
-
-        # NMS
-        pred = non_max_suppression(pred, 0.01, 0.01, None, False, max_det=max_det)
-        dt[2] += time_sync() - t3
-
-        # Second-stage classifier (optional)
-        # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
-
-        pred_fault_solar_modules = []
-        prob_fault_solar_modules = []
-
-        # Process predictions
-        for i, det in enumerate(pred):  # per image
-            seen += 1
-            if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                s += f'{i}: '
-            else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
-
-            p = Path(p)  # to Path
-            save_path = str(save_dir / p.name)  # im.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-            s += '%gx%g ' % im.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            imc = im0.copy() if save_crop else im0  # for save_crop
-            annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
-
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+                if save_txt:  # Write to file
+                    xywh = xyxy2xywh(det['xyxy']) / gn  # normalized xywh
+                    labels.add(txt_path, np.column_stack((det['cls'], xywh, det['conf']) if save_conf else
+                                                         (det['cls'], xywh)))  # label format
 
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    x1 = xyxy[0].detach().cpu().clone().numpy()
-                    y1 = xyxy[1].detach().cpu().clone().numpy()
-                    x2 = xyxy[2].detach().cpu().clone().numpy()
-                    y2 = xyxy[3].detach().cpu().clone().numpy()
-                    prob= conf.detach().cpu().clone().numpy().item()
-                    pred_fault_solar_modules.append([float(x1), float(y1), float(x2), float(y2)])
-                    prob_fault_solar_modules.append(prob)
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or save_crop or view_img:  # Add bbox to image
-                        c = int(cls)  # integer class
+                for xyxy, conf, c in det:
+                    if annotator:  # Add bbox to image
                         label = f' {conf:.2f}'
                         annotator.box_label(xyxy, label, color=colors(c, True))
-                        if save_crop:
-                            save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-
-        pred = model_single(im, augment=augment, visualize=visualize)
-        t3 = time_sync()
-        dt[1] += t3 - t2
+                    if save_crop:
+                        images.crop(xyxy, imc, file=save_dir / 'crops' / names[k][c] / f'{p.stem}.jpg', BGR=True)
 
-        pred = model_single(im, augment=augment, visualize=visualize)
-        t3 = time_sync()
-        dt[1] += t3 - t2
+            if store:
+                store.add(path, {k: r[k] for k in TASKS}, frame=frame, parents=r.parents, names=names)
 
-        # NMS
-        pred = non_max_suppression(pred, 0.01, 0.01, None, False, max_det=max_det)
-        dt[2] += time_sync() - t3
+            dt = r.stats['modules']['dt'] if r.stats else np.zeros(0)
+            if np.isfinite(dt).any():
+                s += f'max module ΔT {np.nanmax(dt):.1f}, '
 
-        # Second-stage classifier (optional)
-        # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
-
-        pred_single_solar_modules = []
-        prob_single_solar_modules = []
-        # Process predictions
-        for i, det in enumerate(pred):  # per image
-            seen += 1
-            if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                s += f'{i}: '
-            else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
-
-            p = Path(p)  # to Path
-            save_path = str(save_dir / p.name)  # im.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-            s += '%gx%g ' % im.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            imc = im0.copy() if save_crop else im0  # for save_crop
-            annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
+            # Stream results, replayed by a background viewer so display never stalls inference
+            if viewer:
+                viewer.put(str(p), im0s, r)
 
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    x1 = xyxy[0].detach().cpu().clone().numpy()
-                    y1 = xyxy[1].detach().cpu().clone().numpy()
-                    x2 = xyxy[2].detach().cpu().clone().numpy()
-                    y2 = xyxy[3].detach().cpu().clone().numpy()
-                    prob= conf.detach().cpu().clone().numpy().item()
-                    pred_single_solar_modules.append([float(x1), float(y1), float(x2), float(y2)])
-                    prob_single_solar_modules.append(prob)
-                    
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or save_crop or view_img:  # Add bbox to image
-                        c = int(cls)  # integer class
-                        label = f' {conf:.2f}'
-                        annotator.box_label(xyxy, label, color=colors(c, True))
-                        if save_crop:
-                            save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-
-            pred_single_solar_modules.sort()
-            pred_full_solar_modules.sort()
-            im0 = annotator.result()
-
-            img_detection = cv2.imread(path).copy()
-
-            for im in range(len(pred_full_solar_modules)):
-                img = cv2.imread(path)
-                temp, temp2 = img, img
-                cv2.imshow("output", np.array(temp, dtype=np.uint8))
-                cv2.waitKey(1000)  # Wait for 1 second
-                # adding filled rectangle on each frame
-                print(path, (int(pred_full_solar_modules[im][0]), int(pred_full_solar_modules[im][1])), (int(pred_full_solar_modules[im][2]), int(pred_full_solar_modules[im][3])))
-                cv2.rectangle(temp, (int(pred_full_solar_modules[im][0]), int(pred_full_solar_modules[im][1])), (int(pred_full_solar_modules[im][2]), int(pred_full_solar_modules[im][3])), (0, 255, 0), 5)
-                cv2.imshow("output", temp)
-                cv2.waitKey(1000)  # Wait for 1 second
-
-                for m in range(len(pred_single_solar_modules)):
-                    mid_point_x, mid_point_y = (pred_single_solar_modules[m][0] + pred_single_solar_modules[m][2]) / 2 , (pred_single_solar_modules[m][1] + pred_single_solar_modules[m][3]) / 2
-                    if ((mid_point_x > pred_full_solar_modules[im][0]) and (mid_point_x < pred_full_solar_modules[im][2]) and mid_point_y > pred_full_solar_modules[im][1] and mid_point_y < pred_full_solar_modules[im][3]):
-                        cv2.rectangle(temp, (int(pred_single_solar_modules[m][0]), int(pred_single_solar_modules[m][1])), (int(pred_single_solar_modules[m][2]), int(pred_single_solar_modules[m][3])), (255, 0, 0), 2)
-                        cv2.imshow("output", temp)
-                        cv2.waitKey(1000)  # Wait for 1 second
-
-                        if cv2.waitKey(1) & 0xFF == ord('s'):
-                            break
-                
-                for ml in range(len(pred_fault_solar_modules)):
-                    mid_point_fault_x, mid_point_fault_y = (pred_fault_solar_modules[ml][0] + pred_fault_solar_modules[ml][2]) / 2 , (pred_fault_solar_modules[ml][1] + pred_fault_solar_modules[ml][3]) / 2
-                    if ((mid_point_fault_x > pred_full_solar_modules[im][0]) and (mid_point_fault_x < pred_full_solar_modules[im][2]) and mid_point_fault_y > pred_full_solar_modules[im][1] and mid_point_fault_y < pred_full_solar_modules[im][3]):
-                        cv2.rectangle(temp2, (int(pred_full_solar_modules[im][0]), int(pred_full_solar_modules[im][1])), (int(pred_full_solar_modules[im][2]), int(pred_full_solar_modules[im][3])), (0, 0, 255), -1)
-                        cv2.rectangle(temp2, (int(pred_fault_solar_modules[ml][0]), int(pred_fault_solar_modules[ml][1])), (int(pred_fault_solar_modules[ml][2]), int(pred_fault_solar_modules[ml][3])), (255, 255, 0), 5)
-                        #cv2.putText(temp, str(prob_fault_solar_modules[ml]), (pred_fault_solar_modules[ml][0] - 1, pred_fault_solar_modules[ml][1] - 1), cv2.FONT_HERSHEY_COMPLEX, 1 , color=(255, 0, 0), thickness=1)
-                        cv2.rectangle(img_detection, (int(pred_full_solar_modules[im][0]), int(pred_full_solar_modules[im][1])), (int(pred_full_solar_modules[im][2]), int(pred_full_solar_modules[im][3])), (0, 0, 255), -1)
-                        cv2.rectangle(img_detection, (int(pred_fault_solar_modules[ml][0]), int(pred_fault_solar_modules[ml][1])), (int(pred_fault_solar_modules[ml][2]), int(pred_fault_solar_modules[ml][3])), (255, 255, 0), 5)
-                        #cv2.putText(img_detection, str(prob_fault_solar_modules[ml]), (pred_fault_solar_modules[ml][0] - 1, pred_fault_solar_modules[ml][1] - 1), cv2.FONT_HERSHEY_COMPLEX, 1 , color=(255, 0, 0), thickness=1)
-                        font = cv2.FONT_HERSHEY_SIMPLEX
-                        org = (int(pred_fault_solar_modules[ml][0]) - 30, int(pred_fault_solar_modules[ml][1]) - 1)
-                        fontScale = 1
-                        color = (255, 0, 0)
-                        thickness = 2
-                        cv2.putText(temp2, str((int(prob_fault_solar_modules[ml] * 10000)) / 100) + "%", org, font, fontScale, color, thickness, cv2.LINE_AA)
-                        cv2.putText(img_detection, str((int(prob_fault_solar_modules[ml] * 10000)) / 100) + "%", org, font, fontScale, color, thickness, cv2.LINE_AA)
-                        cv2.imshow("output", temp2)
-                        cv2.waitKey(1000)  # Wait for 1 second
-
-                if cv2.waitKey(1) & 0xFF == ord('s'):
-                    break
-
-            # Save results (image with detections)
+            # Save results (image with detections), encoded and written in the background
             if save_img:
-                if dataset.mode == 'image':
+                if mode == 'image':
                     # Extract the original image name
                     base_name, ext = os.path.splitext(os.path.basename(path))
-                    # Save the image with panels detections
-                    cv2.imwrite(str(save_dir / f'{base_name}_panel_detection{ext}'), im1)
-                    # Save the image with panel blocks detections
-                    cv2.imwrite(str(save_dir / f'{base_name}_panel_block_detection{ext}'), im0)
-                    # Save the image with only anomaly detections
-                    cv2.imwrite(str(save_dir / f'{base_name}_anomaly_detection{ext}'), img_detection)
+                    if 'arrays' in renders:  # Save the image with panels detections
+                        rendered.append(annotators['arrays'].result())
+                        images.imwrite(save_dir / f'{base_name}_panel_detection{ext}', rendered[-1])
+                    if 'modules' in renders:  # Save the image with panel blocks detections
+                        im0 = annotators['modules'].result()
+                        rendered.append(im0)
+                        images.imwrite(save_dir / f'{base_name}_panel_block_detection{ext}', im0)
+                    if 'anomalies' in renders:  # Save the image with only anomaly detections
+                        rendered.append(plot_anomalies(im0s, r))
+                        images.imwrite(save_dir / f'{base_name}_anomaly_detection{ext}', rendered[-1])
                 else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
-                        save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
-
-        # Print time (inference-only)
-        LOGGER.info(f'{s}Done. ({t3 - t2:.3f}s)')
-
-    cv2.destroyAllWindows()
+                    im0 = annotators['modules'].result()
+                    rendered.append(im0)
+                    if vid_cap:  # video
+                        fps = vid_cap.get(cv2.CAP_PROP_FPS)
+                        w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                        h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                    else:  # stream
+                        fps, w, h = 30, im0.shape[1], im0.shape[0]
+                    images.video(i if webcam else 0, save_path, im0, fps, (w, h))  # writer per stream
+
+            # Print time (inference-only)
+            LOGGER.info(f'{s}Done. ({cascade.times[1]:.3f}s)')
+            if progress:
+                progress({
+                    'path': path,
+                    'frame': frame,
+                    'seen': seen,
+                    'total': total,
+                    'fps': seen / max(time.time() - t0, 1E-9),
+                    'result': r,
+                    'images': rendered})
+        labels.flush()
+        if stop is not None and stop.is_set():
+            LOGGER.info(f'Stopped after {seen} frames')
+            break
+
+    labels.close()
+    images.close()
+    if store:
+        store.close()
+    if viewer:
+        viewer.close()
+    if processes:
+        cascade.close()
+    if track:
+        tracks = [x for t in trackers.values() for x in t.close()]
+        with open(save_dir / 'tracks.jsonl', 'w') as f:
+            f.writelines(json.dumps(x) + '\n' for x in tracks)
+        n = sum(t.trackers['faults'].detections for t in trackers.values())
+        LOGGER.info(f"{len(tracks)} tracked faults from {n} fault detections saved to {save_dir / 'tracks.jsonl'}")
 
     # Print results
-    t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
-    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    t = tuple(x / seen * 1E3 for x in cascade.dt)  # speeds per image
+    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(bs, 3, *imgsz)}' % t)
+    if cache:
+        LOGGER.info(cache.report())
+    if webcam:
+        dataset.close()
+        for x in dataset.stats():
+            LOGGER.info(f"{x['source']}: {x['decoded']} frames decoded at {x['fps']:.1f} FPS, {x['dropped']} dropped, "
+                        f"{x['latency_ms']:.1f}ms queue latency, {x['reconnects']} reconnects")
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
+        s = f"\nLabels saved to {labels.jsonl}" if save_jsonl else s
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
     if update:
         strip_optimizer(weights)  # update model (to fix SourceChangeWarning)
@@ -428,17 +377,57 @@ def run(
     saved_txts = None
 
     if save_img:
-        image_files = list(save_dir.glob('*.jpg')) + list(save_dir.glob('*.png'))
+        image_files = [f for x in ('jpg', 'png', 'webp') for f in save_dir.glob(f'*.{x}')]
         if image_files:
             saved_images = image_files
 
-    if save_txt:
-        txt_files = list(save_dir.glob('labels/*.txt'))
+    if save_txt or save_results:
+        txt_files = list(save_dir.glob('labels/*.txt')) + list(save_dir.glob('labels.jsonl')) if save_txt else []
+        txt_files += [store.file] if save_results and store.n else []  # only if rows were written
         if txt_files:
             saved_txts = txt_files
 
     return saved_images, saved_txts
 
+def frame_count(dataset):
+    # Total frames of a LoadImages dataset, images count 1 and videos their frame count
+    n = 0
+    for f, video in zip(dataset.files, dataset.video_flag):
+        if video:
+            cap = cv2.VideoCapture(f)
+            n += int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap.release()
+        else:
+            n += 1
+    return n
+
+
+def infer_batches(cascade, batches, bs=1, save_dir=None, augment=False, visualize=False):
+    # Run batch_loader() batches through the cascade in this process, yields (batch, results)
+    cascade.warmup(bs=1 if cascade.pt else bs)  # warmup
+    for batch in batches:
+        visualize = increment_path(save_dir / Path(batch[0][0]).stem, mkdir=True) if visualize else False
+        yield batch, cascade([x[2] for x in batch], [x[1] for x in batch], augment=augment, visualize=visualize)
+
+
+def batch_loader(dataset, batch_size=1, webcam=False):
+    # Group dataloader output into lists of (path, im, im0, vid_cap, s, mode, frame, temperature) for batched inference.
+    # Mode, frame and temperature are read from the dataset as each item is yielded, they change before results return
+    batch = []
+    for path, im, im0s, vid_cap, s in dataset:
+        if webcam:  # LoadStreams already yields one frame per stream
+            yield [(p, x, x0, None, f'{s}{i}: ', 'stream', dataset.count, None)
+                   for i, (p, x, x0) in enumerate(zip(path, im, im0s))]
+            continue
+        batch.append((path, im, im0s, vid_cap, s, dataset.mode, getattr(dataset, 'frame', 0),
+                      getattr(dataset, 'temperature', None)))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', nargs='+', type=str, default=ROOT / 'best-solar.pt', help='model path(s)')
@@ -449,7 +438,7 @@ def parse_opt():
     parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
     parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
-    parser.add_argument('--view-img', action='store_true', help='show results')
+    parser.add_argument('--view-img', action='store_true', help='replay results in a background viewer')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-conf', action='store_true', help='save confidences in --save-txt labels')
     parser.add_argument('--save-crop', action='store_true', help='save cropped prediction boxes')
@@ -467,6 +456,34 @@ def parse_opt():
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--weights-fault', type=str, default=ROOT / 'best.pt', help='fault model path')
+    parser.add_argument('--weights-single', type=str, default=ROOT / 'best-singlemodule.pt', help='single module model path')
+    parser.add_argument('--batch-size', type=int, default=1, help='frames per cascade batch')
+    parser.add_argument('--parallel', action='store_true', help='run the three models concurrently')
+    parser.add_argument('--save-jsonl', action='store_true', help='save labels to one labels.jsonl, not *.txt files')
+    parser.add_argument('--save-results', action='store_true', help='save all boxes to a results.parquet/db store')
+    parser.add_argument('--image-format', type=str, default=None, help='saved image format, i.e. jpg, png or webp')
+    parser.add_argument('--image-quality', type=int, default=95, help='saved JPEG/WebP image quality')
+    parser.add_argument('--renders', nargs='+', type=str, default=['arrays', 'modules', 'anomalies'],
+                        help='annotated images to save: arrays modules anomalies')
+    parser.add_argument('--workers', type=int, default=4, help='image decode/letterbox threads, 0 for main thread')
+    parser.add_argument('--prefetch', type=int, default=32, help='maximum frames prefetched ahead of inference')
+    parser.add_argument('--fold-scale', action='store_true', help='fold 1/255 input scale into the first conv')
+    parser.add_argument('--processes', type=int, default=0, help='CPU inference worker processes, 0 for in-process')
+    parser.add_argument('--cache', type=str, nargs='?', const=ROOT / 'runs/cache', help='--cache results in [DIR]')
+    parser.add_argument('--cache-mb', type=float, default=CACHE_MB, help='result cache size budget (MB)')
+    parser.add_argument('--stream-policy', default='latest', choices=STREAM_POLICIES, help='stream frames to infer')
+    parser.add_argument('--stream-buffer', type=int, default=8, help='frames queued per stream')
+    parser.add_argument('--tile', type=int, default=0, help='tiled inference tile size (pixels), 0 to disable')
+    parser.add_argument('--tile-overlap', type=float, default=0.2, help='tile overlap, fraction of the tile size')
+    parser.add_argument('--tile-merge', default='nmm', choices=TILE_MERGES, help='tile seam box merging')
+    parser.add_argument('--radiometric', action='store_true', help='read 16-bit/float radiometric image frames')
+    parser.add_argument('--thermal-range', nargs='+', default=['frame'], help='frame, survey or LO HI (°C) range')
+    parser.add_argument('--thermal-scale', type=float, default=1.0, help='radiometric raw value to °C scale')
+    parser.add_argument('--thermal-offset', type=float, default=0.0, help='radiometric raw value to °C offset')
+    parser.add_argument('--hotspots', action='store_true', help='measure module and fault temperatures and ΔT')
+    parser.add_argument('--track', action='store_true', help='track detections across frames, save tracks.jsonl')
+    parser.add_argument('--track-min-hits', type=int, default=3, help='frames a fault must be tracked in')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
@@ -478,12 +495,13 @@ def main(opt):
     run(**vars(opt))
 
 
-def run_detection(*args):
+def run_detection(*args, **kwargs):
     """
     Run the detection process using the provided arguments.
 
     Args:
         *args: Variable number of arguments representing the detection parameters.
+        **kwargs: Additional run() keyword arguments, i.e. progress and stop.
 
     Returns:
         The result of the detection process.
@@ -499,7 +517,7 @@ def run_detection(*args):
         "project", "name", "exist_ok", "line_thickness", "hide_labels", "hide_conf", 
         "half", "dnn"
     ]
-    kwargs = dict(zip(keys, args))
+    kwargs = {**dict(zip(keys, args)), **kwargs}
 
     # Combine height and width into a tuple as imgsz
     imgsz = (int(kwargs['img_height']), int(kwargs['img_width']))
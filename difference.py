@@ -3,6 +3,7 @@ import os
 import sys
 from pathlib import Path
 
+import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 
@@ -12,12 +13,15 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
-from models.common import DetectMultiBackend
+from models.registry import load_model
 from utils.datasets import IMG_FORMATS, VID_FORMATS, LoadImages, LoadStreams
 from utils.general import (LOGGER, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
-                           increment_path, non_max_suppression, print_args, scale_coords, strip_optimizer, xyxy2xywh)
-from utils.plots import Annotator, colors, save_one_box
-from utils.torch_utils import select_device, time_sync
+                           det2numpy, increment_path, non_max_suppression, print_args, scale_coords, strip_optimizer,
+                           xyxy2xywh)
+from utils.plots import Annotator, colors
+from utils.store import ResultsStore
+from utils.torch_utils import Preprocessor, select_device, time_sync
+from utils.writers import ImageWriter, LabelWriter
 
 
 @torch.no_grad()
@@ -48,6 +52,7 @@ def run(
         hide_conf=False,  # hide confidences
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
+        save_results=False,  # save all boxes to a columnar results store
 ):
     """
     Run the automatic faults detection algorithm using thermal images.
@@ -79,6 +84,8 @@ def run(
         hide_conf (bool): Whether to hide confidences.
         half (bool): Whether to use FP16 half-precision inference.
         dnn (bool): Whether to use OpenCV DNN for ONNX inference.
+        save_results (bool): Whether to save every panel and fault box to a results.parquet (results.db without
+            pyarrow) store, see utils/store.py for queries.
 
     Returns:
         None
@@ -100,38 +107,37 @@ def run(
     save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
     (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
-    # Load model
+    # Load models (cached in the process-wide registry)
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+    model = load_model(weights, device=device, dnn=dnn, data=data, fp16=half)
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
 
     weights_fault = "best.pt"
 
-    model_fault = DetectMultiBackend(weights_fault, device=device, dnn=dnn, data=data, fp16=half)
+    model_fault = load_model(weights_fault, device=device, dnn=dnn, data=data, fp16=half)
     stride_fault, names_fault, pt_fault = model_fault.stride, model_fault.names, model_fault.pt
 
     # Dataloader
     if webcam:
-        view_img = check_imshow()
+        view_img = view_img and check_imshow()
         cudnn.benchmark = True  # set True to speed up constant image size inference
         dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt)
         bs = len(dataset)  # batch_size
     else:
         dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt)
         bs = 1  # batch_size
-    vid_path, vid_writer = [None] * bs, [None] * bs
+    images = ImageWriter()  # bounded background encoding
+    labels = LabelWriter(background=True)  # one write per image
+    store = ResultsStore(save_dir, survey=save_dir.name) if save_results else None
 
     # Run inference
     model.warmup(imgsz=(1 if pt else bs, 3, *imgsz))  # warmup
+    preprocess = Preprocessor(device, model.fp16, model=model)  # reused pinned staging and device buffers
     dt, seen = [0.0, 0.0, 0.0], 0
     for path, im, im0s, vid_cap, s in dataset:
         t1 = time_sync()
-        im = torch.from_numpy(im).to(device)
-        im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-        im /= 255  # 0 - 255 to 0.0 - 1.0
-        if len(im.shape) == 3:
-            im = im[None]  # expand for batch dim
+        im = preprocess(im)  # uint8 to normalized fp16/32 batch on device
         t2 = time_sync()
         dt[0] += t2 - t1
 
@@ -164,86 +170,69 @@ def run(
             save_path = str(save_dir / p.name)  # im.jpg
             txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
             s += '%gx%g ' % im.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+            gn = np.array(im0.shape, dtype=np.float32)[[1, 0, 1, 0]]  # normalization gain whwh
             imc = im0.copy() if save_crop else im0  # for save_crop
             image = im0.copy()
             annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
-
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(txt_path + '.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or save_crop or view_img:  # Add bbox to image
-                        c = int(cls)  # integer class
-                        label = f' {conf:.2f}'
-                        annotator.box_label(xyxy, label, color=colors(c, True))
-                        if save_crop:
-                            save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+
+            # Rescale boxes from img_size to im0 size once, then a single device to host copy of panels and faults
+            for d in det, pred_fault[i]:
+                d[:, :4] = scale_coords(im.shape[2:], d[:, :4], im0.shape).round()
+            det, det_fault = det2numpy([det, pred_fault[i]])
+            det = det[::-1]
+            if store:
+                store.add(p, {'arrays': det, 'faults': det_fault}, frame=frame,
+                          names={'arrays': names, 'faults': names_fault})
+
+            # Print results
+            for c, n in zip(*np.unique(det['cls'], return_counts=True)):
+                s += f"{n} {names[c]}{'s' * int(n > 1)}, "  # add to string
+
+            # Write results
+            if save_txt:  # Write to file
+                xywh = xyxy2xywh(det['xyxy']) / gn  # normalized xywh
+                labels.add(txt_path, np.column_stack((det['cls'], xywh, det['conf']) if save_conf else
+                                                     (det['cls'], xywh)))  # label format
+
+            for xyxy, conf, c in det:
+                if save_img or save_crop or view_img:  # Add bbox to image
+                    label = f' {conf:.2f}'
+                    annotator.box_label(xyxy, label, color=colors(c, True))
+                    if save_crop:
+                        images.crop(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
 
             # Stream results
             im1 = annotator.result()
             if view_img:
                 cv2.imshow(str(p), im1)
-                cv2.waitKey(0)  # Wait until a key is pressed or the window is closed
-                cv2.destroyAllWindows()
-
-            if len(det):
-                # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(im.shape[2:], det[:, :4], im0.shape).round()
-
-                # Print results
-                for c in det[:, -1].unique():
-                    n = (det[:, -1] == c).sum()  # detections per class
-                    s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
-
-                # Write results
-                det_numpy = det.detach().cpu().clone().numpy()
-                print(det_numpy)
-                for *xyxy, conf, cls in reversed(det):
-                    crop = save_one_box(xyxy, imc, save=False)
-                    for i_fault, det_fault in enumerate(pred_fault):
-                        if len(det_fault):
-                            annotator = Annotator(im0, line_width=line_thickness, example=str(names_fault))
-                            det_fault[:, :4] = scale_coords(im.shape[2:], det_fault[:, :4], im0.shape).round()
-
-            # Save results (image with detections)
+                cv2.waitKey(1)  # 1 millisecond, never block inference on a key press
+
+            # Save results (image with detections), encoded and written in the background
             if save_img:
                 if dataset.mode == 'image':
                     # Extract the original image name
                     base_name, ext = os.path.splitext(os.path.basename(path))
                     # Save the image with panels detections
-                    cv2.imwrite(str(save_dir / f'{base_name}_panel_detection{ext}'), im1)
+                    images.imwrite(save_dir / f'{base_name}_panel_detection{ext}', im1)
                     # Save the image with panel blocks detections
-                    cv2.imwrite(str(save_dir / f'{base_name}_panel_block_detection{ext}'), im0)
+                    images.imwrite(save_dir / f'{base_name}_panel_block_detection{ext}', im0)
                 else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
-                        save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
+                    if vid_cap:  # video
+                        fps = vid_cap.get(cv2.CAP_PROP_FPS)
+                        w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                        h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                    else:  # stream
+                        fps, w, h = 30, im0.shape[1], im0.shape[0]
+                    images.video(i, save_path, im0, fps, (w, h))
 
         # Print time (inference-only)
         LOGGER.info(f'{s}Done. ({t3 - t2:.3f}s)')
+        labels.flush()
+
+    labels.close()
+    images.close()
+    if store:
+        store.close()
 
     # Print results
     t = tuple(x / seen * 1E3 for x in dt)  # speeds per image
@@ -263,8 +252,9 @@ def run(
         if image_files:
             saved_images = image_files
 
-    if save_txt:
-        txt_files = list(save_dir.glob('labels/*.txt'))
+    if save_txt or save_results:
+        txt_files = list(save_dir.glob('labels/*.txt')) if save_txt else []
+        txt_files += [store.file] if save_results and store.n else []  # only if rows were written
         if txt_files:
             saved_txts = txt_files
 
@@ -298,6 +288,7 @@ def parse_opt():
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--save-results', action='store_true', help='save all boxes to a results.parquet/db store')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
@@ -0,0 +1,265 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+PV fault detection cascade, runs the PV array, fault and single PV module detectors over one letterboxed batch
+
+Usage:
+    from models.cascade import CascadeDetector
+    cascade = CascadeDetector(device='cpu')
+    results = cascade([cv2.imread('test_folder/imgFC30.png')])  # list of CascadeResult, one per frame
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+
+import torch
+
+from models.registry import load_model
+from utils.augmentations import letterbox
+from utils.general import box_assign, check_img_size, det2numpy, non_max_suppression, scale_coords
+from utils.torch_utils import Preprocessor, fold_input_scale, select_device, time_sync
+
+ROOT = Path(__file__).resolve().parents[1]  # YOLOv5 root directory
+TASKS = 'arrays', 'faults', 'modules'  # cascade detectors, in weights order
+
+
+class CascadeResult:
+    # Cascade detections for one frame, DET_DTYPE structured arrays (xyxy, conf, cls) in original image pixels
+    def __init__(self, arrays, faults, modules, shape, names=None, ioa_thres=0.0):
+        self.arrays = arrays  # PV arrays
+        self.faults = faults  # faulty cells and strings
+        self.modules = modules  # single PV modules
+        self.shape = shape  # original image shape (h, w, c)
+        self.names = names or {}  # class names per task
+        self.speed = {}  # ms of the batch this frame ran in, i.e. preprocess, inference, nms
+        self.temperature = None  # (h,w) °C array-like of radiometric frames, see utils/thermal.py
+        self.stats = {}  # {task: STATS_DTYPE} module and fault temperature statistics, see utils/thermal.hotspots()
+        self.ids = {}  # {task: (n,) track IDs} across frames, see utils/tracking.py
+        self.parents = {  # parent PV array index per module and fault, -1 if outside all arrays
+            k: box_assign(self[k]['xyxy'], arrays['xyxy'], ioa_thres)
+            for k in ('faults', 'modules')}
+
+    def __getitem__(self, task):
+        return getattr(self, task)
+
+    def __str__(self):
+        return ', '.join(f'{len(self[k])} {k}' for k in TASKS)
+
+    def to_dict(self, tasks=TASKS):
+        # JSON-serializable {task: [box records]}, modules and faults with their parent PV array index if arrays ran
+        d = {'width': self.shape[1], 'height': self.shape[0], 'speed': self.speed}
+        for k in tasks:
+            names = self.names.get(k)
+            d[k] = [{
+                'id': i,
+                'xmin': float(x[0]),
+                'ymin': float(x[1]),
+                'xmax': float(x[2]),
+                'ymax': float(x[3]),
+                'confidence': float(conf),
+                'class': int(c),
+                'name': names[c] if names else str(c)}
+                    for i, (x, conf, c) in enumerate(self[k].tolist())]
+            if k in self.parents and 'arrays' in tasks:
+                for r, p in zip(d[k], self.parents[k].tolist()):
+                    r['parent'] = p
+            if k in self.stats:
+                for r, x in zip(d[k], self.stats[k].tolist()):
+                    r['temperature'] = dict(zip(self.stats[k].dtype.names, map(float, x)))
+            if k in self.ids:
+                for r, i in zip(d[k], self.ids[k].tolist()):
+                    r['track'] = i
+        return d
+
+
+class CascadeDetector:
+    # PV array / fault / single module detectors sharing one preprocessed batch
+    def __init__(self,
+                 weights=ROOT / 'best-solar.pt',
+                 weights_fault=ROOT / 'best.pt',
+                 weights_single=ROOT / 'best-singlemodule.pt',
+                 device='',
+                 imgsz=(640, 640),
+                 data=None,
+                 half=False,
+                 dnn=False,
+                 conf_thres=0.25,
+                 iou_thres=0.45,
+                 classes=None,
+                 agnostic_nms=False,
+                 max_det=1000,
+                 conf_thres_sub=0.01,
+                 iou_thres_sub=0.01,
+                 ioa_thres=0.0,
+                 parallel=False,
+                 fold_scale=False,
+                 models=None,
+                 cache=None):
+        """
+        Initializes the cascade, models are shared with the rest of the process through the model registry.
+
+        Args:
+            weights (str or Path): PV array model weights.
+            weights_fault (str or Path): Fault model weights.
+            weights_single (str or Path): Single PV module model weights.
+            device (str or torch.device): CUDA device, i.e. 0 or 0,1,2,3 or cpu.
+            imgsz (tuple): Inference size (height, width).
+            data (str or Path): Path to the dataset YAML file.
+            half (bool): Whether to use FP16 half-precision inference.
+            dnn (bool): Whether to use OpenCV DNN for ONNX inference.
+            conf_thres (float): PV array confidence threshold.
+            iou_thres (float): PV array NMS IOU threshold.
+            classes (list): PV array classes to keep.
+            agnostic_nms (bool): Whether to use class-agnostic NMS for PV arrays.
+            max_det (int): Maximum detections per image and model.
+            conf_thres_sub (float): Fault and single module confidence threshold.
+            iou_thres_sub (float): Fault and single module NMS IOU threshold.
+            ioa_thres (float): Minimum intersection over module/fault area to assign it to a PV array.
+            parallel (bool): Run the three models concurrently, on separate CUDA streams or a CPU thread pool.
+            fold_scale (bool): Fold the 1/255 input scale into the first conv of the PyTorch models. Folded models are
+                separate registry entries, given models are folded as private copies, models other consumers
+                normalize inputs for are never modified.
+            models (dict, optional): Loaded {task: DetectMultiBackend} models to use instead of the weights, i.e.
+                shared memory models in worker processes.
+            cache (ResultCache, optional): On-disk cache of per-frame NMS candidates, frames seen before with the
+                same models skip inference.
+        """
+        self.device = device if isinstance(device, torch.device) else select_device(device)
+        load = lambda fold: {
+            k: load_model(w, device=self.device, dnn=dnn, data=data, fp16=half, fold_scale=fold)
+            for k, w in zip(TASKS, (weights, weights_fault, weights_single))}
+        self.models = models or load(fold_scale)
+        self.pt = all(x.pt for x in self.models.values())
+        if fold_scale and not self.pt and not models:  # all models share one input batch, fold all or none
+            self.models = load(False)
+        elif fold_scale and self.pt:  # given models may be shared, fold private copies
+            self.models = {k: x if getattr(x, 'input_scaled', False) else deepcopy(x) for k, x in self.models.items()}
+            for x in self.models.values():
+                fold_input_scale(x)
+        m = self.models['arrays']
+        self.fp16 = m.fp16
+        self.stride = max(x.stride for x in self.models.values())
+        self.names = {k: x.names for k, x in self.models.items()}
+        self.imgsz = check_img_size(imgsz, s=self.stride)  # check image size
+        self.nms = {
+            'arrays': (conf_thres, iou_thres, classes, agnostic_nms),
+            'faults': (conf_thres_sub, iou_thres_sub, None, False),
+            'modules': (conf_thres_sub, iou_thres_sub, None, False)}
+        self.max_det = max_det
+        self.ioa_thres = ioa_thres
+        self.cache = cache
+        self.preprocessor = Preprocessor(self.device, self.fp16, model=m)
+
+        # Concurrency
+        self.streams, self.pool = None, None
+        if parallel and self.device.type != 'cpu':
+            self.streams = [torch.cuda.Stream(self.device) for _ in TASKS]
+        elif parallel:
+            self.pool = ThreadPoolExecutor(len(TASKS), thread_name_prefix='cascade')
+        self.dt, self.times = [0.0, 0.0, 0.0], (0.0, 0.0, 0.0)  # cumulative and last call pre-process, inference, NMS
+
+    def warmup(self, bs=1):
+        for m in self.models.values():
+            m.warmup(imgsz=(bs, self.preprocessor.ch, *self.imgsz))
+
+    def letterbox_batch(self, ims0, ims=None):
+        # Letterboxed CHW RGB frames of one shape, ims if given and all shapes match else ims0 letterboxed to imgsz
+        if ims is None or any(x.shape != ims[0].shape for x in ims):
+            ims = [letterbox(x, self.imgsz, stride=self.stride, auto=False)[0].transpose((2, 0, 1))[::-1] for x in ims0]
+        return ims
+
+    def preprocess(self, ims0, ims=None):
+        # Letterboxed CHW RGB frames to one normalized device batch, letterboxing ims0 if shapes are missing or differ
+        return self.preprocessor(self.letterbox_batch(ims0, ims))  # buffer reused per batch shape
+
+    @torch.no_grad()
+    def infer(self, task, im, augment=False, visualize=False):
+        return self.models[task](im, augment=augment, visualize=visualize if task == 'arrays' else False)
+
+    def forward(self, im, augment=False, visualize=False, tasks=TASKS):
+        # Raw predictions of the requested models, {task: (b, anchors, 5 + nc)}
+        if self.streams:  # CUDA streams
+            main = torch.cuda.current_stream(self.device)
+            y = {}
+            for k, s in zip(TASKS, self.streams):
+                if k not in tasks:
+                    continue
+                s.wait_stream(main)  # input ready
+                with torch.cuda.stream(s):
+                    y[k] = self.infer(k, im, augment, visualize)
+            for s in self.streams:
+                main.wait_stream(s)
+            return y
+        if self.pool:  # CPU threads
+            return dict(zip(tasks, self.pool.map(lambda k: self.infer(k, im, augment, visualize), tasks)))
+        return {k: self.infer(k, im, augment, visualize) for k in tasks}
+
+    def forward_cached(self, ims, augment=False, visualize=False, tasks=TASKS):
+        # NMS candidates per frame {task: [(n, 5+nc)]} from the result cache, only frames missing from it are inferred
+        fp = {k: self.cache.fingerprint(self.models[k], augment) for k in tasks}
+        keys = [self.cache.frame_key(x) for x in ims]
+        y = {k: [self.cache.get(f + fp[k], self.nms[k][0], self.device) for f in keys] for k in tasks}
+        miss = [i for i in range(len(ims)) if any(y[k][i] is None for k in tasks)]
+        if miss:
+            im = self.preprocessor([ims[i] for i in miss] if len(miss) < len(ims) else ims)
+            run = [k for k in tasks if any(y[k][i] is None for i in miss)]
+            for k, p in self.forward(im, augment, visualize, run).items():
+                conf = min(self.nms[k][0], self.cache.conf_floor)
+                for i, x in zip(miss, p):
+                    if y[k][i] is None:
+                        y[k][i] = x[x[:, 4] > conf]  # non_max_suppression() candidates
+                        self.cache.put(keys[i] + fp[k], y[k][i], conf)
+        return y
+
+    def postprocess(self, y, shape, ims0):
+        # NMS and rescale to original image pixels, returns one CascadeResult per frame, no boxes for tasks not in y
+        dets = []
+        for k in TASKS:
+            if k not in y:
+                dets.extend(torch.zeros((0, 6), device=self.device) for _ in ims0)
+                continue
+            pred = y[k] if torch.is_tensor(y[k]) else [x[None] for x in y[k]]  # batch or per-frame cached candidates
+            pred = non_max_suppression(pred, *self.nms[k], max_det=self.max_det) if torch.is_tensor(pred) else \
+                [non_max_suppression(x, *self.nms[k], max_det=self.max_det)[0] for x in pred]
+            for det, im0 in zip(pred, ims0):
+                det[:, :4] = scale_coords(shape, det[:, :4], im0.shape).round()
+                dets.append(det)
+        dets = det2numpy(dets)  # all tasks and frames in one device to host copy, [task * n + frame]
+        n = len(ims0)
+        return [
+            CascadeResult(*dets[i::n], shape=im0.shape, names=self.names, ioa_thres=self.ioa_thres)
+            for i, im0 in enumerate(ims0)]
+
+    def __call__(self, ims0, ims=None, augment=False, visualize=False, tasks=TASKS):
+        """
+        Runs the cascade on a batch of frames.
+
+        Args:
+            ims0 (list): Original HWC BGR frames.
+            ims (list, optional): Letterboxed CHW RGB frames as yielded by LoadImages/LoadStreams, re-used if all
+                shapes match.
+            augment (bool): Whether to use augmented inference.
+            visualize (bool or Path): Feature visualization directory for the PV array model.
+            tasks (tuple): Models to run, results of the others are left empty.
+
+        Returns:
+            list: One CascadeResult per frame.
+        """
+        t1 = time_sync()
+        if self.cache:  # preprocessing and inference of frames missing from the cache count as inference
+            ims = self.letterbox_batch(ims0, ims)
+            t2 = time_sync()
+            y, shape = self.forward_cached(ims, augment, visualize, tasks), ims[0].shape[1:]
+        else:
+            im = self.preprocess(ims0, ims)
+            t2 = time_sync()
+            y, shape = self.forward(im, augment, visualize, tasks), im.shape[2:]
+        t3 = time_sync()
+        results = self.postprocess(y, shape, ims0)
+        t4 = time_sync()
+        self.times = t2 - t1, t3 - t2, t4 - t3
+        self.dt = [a + b for a, b in zip(self.dt, self.times)]
+        speed = dict(zip(('preprocess', 'inference', 'nms'), (t * 1E3 for t in self.times)), batch=len(results))
+        for r in results:
+            r.speed = dict(speed)
+        return results
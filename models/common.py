@@ -3,6 +3,7 @@
 Common modules
 """
 
+import io
 import json
 import math
 import platform
@@ -716,6 +717,10 @@ class DetectMultiBackend(nn.Module):
                 raise Exception('ERROR: YOLOv5 TF.js inference is not supported')
         self.__dict__.update(locals())  # assign all variables to self
 
+    def __getstate__(self):
+        # Picklable state, i.e. for worker processes, without the file handles assigned from locals()
+        return {k: v for k, v in self.__dict__.items() if not isinstance(v, io.IOBase)}
+
     def forward(self, im, augment=False, visualize=False, val=False):
         """
         Forward pass through the model.
@@ -0,0 +1,127 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Process-wide model registry, shares loaded DetectMultiBackend instances between detection, validation and serving
+
+Usage:
+    from models.registry import load_model
+    model = load_model('best-solar.pt', device=device, data='data.yaml', fp16=False)  # cached after first call
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from models.common import DetectMultiBackend
+from utils.general import LOGGER, colorstr
+from utils.torch_utils import fold_input_scale
+
+REGISTRY_MB = float(os.getenv('YOLOv5_REGISTRY_MB', 2048))  # registry memory budget (MB)
+
+
+class ModelRegistry:
+    # LRU cache of DetectMultiBackend instances keyed by (weights, device, fp16, backend, data, input scale folded)
+    def __init__(self, max_mb=REGISTRY_MB):
+        """
+        Initializes the model registry.
+
+        Args:
+            max_mb (float): Memory budget in MB. Least recently used models are evicted once the budget is exceeded,
+                the most recently loaded model is always kept.
+        """
+        self.max_mb = max_mb
+        self.models = OrderedDict()  # key: (stamp, MB, model)
+        self.lock = threading.RLock()
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(weights, device, fp16=False, dnn=False, data=None, fold_scale=False):
+        # Registry key, weights and data resolved to absolute paths, fp16 normalized to what DetectMultiBackend will use
+        weights = weights if isinstance(weights, (list, tuple)) else [weights]
+        w = tuple(str(Path(x).resolve()) for x in weights)
+        fp16 = bool(fp16) and getattr(device, 'type', str(device)) != 'cpu'
+        data = str(Path(data).resolve()) if data else None
+        return w, str(device), fp16, 'dnn' if dnn else 'auto', data, bool(fold_scale)
+
+    @staticmethod
+    def stamp(weights):
+        # Invalidation stamp (mtime, size) per weights file, directories (i.e. *_saved_model) use their own mtime
+        s = []
+        for w in weights:
+            p = Path(w)
+            s.append((p.stat().st_mtime_ns, p.stat().st_size) if p.exists() else None)
+        return tuple(s)
+
+    @staticmethod
+    def memory(model, weights):
+        # Estimated model footprint (MB), tensors for PyTorch backends else weights file size on disk
+        m = getattr(model, 'model', None)
+        if hasattr(m, 'parameters'):
+            b = sum(x.numel() * x.element_size() for x in list(m.parameters()) + list(m.buffers()))
+        else:
+            b = sum(Path(w).stat().st_size for w in weights if Path(w).is_file())
+        return b / (1 << 20)
+
+    def load(self, weights, device, dnn=False, data=None, fp16=False, fold_scale=False):
+        """
+        Returns a cached DetectMultiBackend, loading it on first use or if the weights file changed on disk.
+
+        Args:
+            weights (str or list): Path to the model weights file or a list of paths for ensemble models.
+            device (torch.device): Device to load the model on.
+            dnn (bool): Flag indicating whether to use ONNX OpenCV DNN backend.
+            data (str): Path to the data.yaml file containing class names (optional).
+            fp16 (bool): Flag indicating whether to use FP16 precision.
+            fold_scale (bool): Return a separate instance with the 1/255 input scale folded into its first conv (see
+                fold_input_scale()), never the unfolded instance other consumers normalize their inputs for.
+
+        Returns:
+            DetectMultiBackend: The shared model instance.
+        """
+        k = self.key(weights, device, fp16, dnn, data, fold_scale)
+        with self.lock:
+            if k in self.models:
+                stamp, _, model = self.models[k]
+                if stamp == self.stamp(k[0]):
+                    self.models.move_to_end(k)
+                    self.hits += 1
+                    return model
+                LOGGER.info(f'{colorstr("registry:")} {", ".join(k[0])} changed on disk, reloading')
+                del self.models[k]
+
+            self.misses += 1
+            model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=fp16)
+            if fold_scale:
+                fold_input_scale(model)
+            self.models[k] = (self.stamp(k[0]), self.memory(model, k[0]), model)
+            self.evict()
+            return model
+
+    def evict(self):
+        # Drop least recently used models until the registry fits the memory budget
+        with self.lock:
+            while len(self.models) > 1 and self.size() > self.max_mb:
+                k, _ = self.models.popitem(last=False)
+                LOGGER.info(f'{colorstr("registry:")} evicted {", ".join(k[0])} ({k[1]})')
+
+    def size(self):
+        # Total registry footprint (MB)
+        return sum(mb for _, mb, _ in self.models.values())
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+    def __len__(self):
+        return len(self.models)
+
+    def __str__(self):
+        return f'{len(self)} models, {self.size():.1f}/{self.max_mb:.0f} MB, {self.hits} hits, {self.misses} misses'
+
+
+REGISTRY = ModelRegistry()  # shared by detection.py, difference.py, val.py and the REST API
+
+
+def load_model(weights, device, dnn=False, data=None, fp16=False, fold_scale=False):
+    # Load a DetectMultiBackend through the shared process-wide registry
+    return REGISTRY.load(weights, device=device, dnn=dnn, data=data, fp16=fp16, fold_scale=fold_scale)
@@ -0,0 +1,41 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Gradio app tests
+
+Usage:
+    $ python -m pytest tests/test_app.py
+"""
+
+import importlib.util
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from gradio.helpers import special_args
+
+from utils.serving import FairScheduler
+
+spec = importlib.util.spec_from_file_location('app_block', ROOT / 'app-block.py')
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+
+def test_sessions_get_distinct_tickets():
+    # Gradio injects the session request and a tracked Progress into the detection handlers, one scheduler user each
+    app.SCHEDULER = FairScheduler(workers=0)  # every ticket waits
+    for fn in app.stream_detection, app.queued_diff_detection:
+        runs = []
+        for session in 'a', 'b':
+            inputs, progress, _, _ = special_args(fn, list(app.DETECT_INPUTS), SimpleNamespace(session_hash=session))
+            assert progress == len(app.DETECT_INPUTS) + 1
+            runs.append(fn(*inputs))
+            next(runs[-1])  # queued
+        assert list(app.SCHEDULER.jobs) == ['a', 'b']
+        for x in runs:
+            x.close()  # cancelled while queued
+        assert not app.SCHEDULER.jobs
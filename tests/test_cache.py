@@ -0,0 +1,44 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Result cache tests
+
+Usage:
+    $ python -m pytest tests/test_cache.py
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.cache import SessionCache
+
+
+def test_session_cache_spill_bounded():
+    # Re-runs of the same frames reuse the spill file ranges of superseded entries, the file never exceeds spill_mb
+    rng = np.random.default_rng(0)
+    cache, cached = SessionCache(max_mb=1, spill_mb=4), {}
+    for _ in range(400):
+        k = f'frame{rng.integers(0, 60)}'
+        if k in cached and rng.random() < 0.5:
+            x = cache.get(k, 0.5)
+            assert x is None or torch.equal(x, cached[k])
+            assert x is None or k in cache.entries  # spilled hits move back to memory
+        else:
+            n = int(rng.integers(0, 3000)) if rng.random() > 0.1 else 0  # frames without candidates too
+            cached[k] = torch.from_numpy(rng.random((n, 85), dtype=np.float32))
+            cache.put(k, cached[k], 0.1)
+        assert cache.size <= 4 << 20 and (cache.file is None or os.path.getsize(cache.spill) == cache.size)
+        ranges = sorted([x[:2] for x in cache.spilled.values() if x[1]] + cache.free)
+        assert sum(n for _, n in ranges) == cache.size  # spilled and free ranges tile the file
+        assert all(a[0] + a[1] <= b[0] for a, b in zip(ranges, ranges[1:]))
+    spill = cache.spill
+    cache.close()
+    assert not os.path.exists(spill)
@@ -0,0 +1,56 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Radiometric input tests
+
+Usage:
+    $ python -m pytest tests/test_thermal.py
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils.general import cv2
+from utils.raster import TiffRaster, open_raster
+from utils.thermal import Radiometric, box_stats
+
+
+def test_compressed_16bit_tiff(tmp_path):
+    # LZW compressed 16-bit TIFFs (OpenCV's default) are decoded whole at their bit depth, not as 8-bit BGR
+    raw = (np.arange(64 * 96, dtype=np.uint16).reshape(64, 96) * 7 + 27315).astype(np.uint16)
+    f = str(tmp_path / 'frame.tif')
+    assert cv2.imwrite(f, raw, (cv2.IMWRITE_TIFF_COMPRESSION, 5))  # LZW
+    try:
+        TiffRaster(f)
+        compressed = False
+    except ValueError:  # LZW is not read by window
+        compressed = True
+    assert compressed
+
+    im = open_raster(f)
+    assert im.dtype == np.uint16 and np.array_equal(im, raw)
+
+    gray, temperature = Radiometric(scale=0.01, offset=-273.15).imread(f)
+    assert gray.dtype == np.uint8 and gray.shape == raw.shape and gray.min() == 0 and gray.max() == 255
+    assert temperature is not None
+    assert np.allclose(np.asarray(temperature), raw * 0.01 - 273.15, atol=1E-3)
+
+
+def test_box_stats():
+    # Exact max, mean and p95 like per-box slicing and np.percentile(), mixed box shapes, NaN for empty boxes
+    rng = np.random.default_rng(0)
+    t = rng.normal(30, 5, (120, 160)).astype(np.float32)
+    xy = rng.uniform(0, 100, (200, 2))
+    xyxy = np.concatenate((xy, xy + rng.uniform(1, 40, (200, 2))), 1)
+    xyxy[0] = 10, 10, 10, 20  # empty
+    x = box_stats(t, xyxy)
+    assert x.shape == (200, 3) and np.isnan(x[0]).all()
+    for (x0, y0, x1, y1), s in zip(xyxy[1:].round().astype(int), x[1:]):
+        v = t[y0:y1, x0:x1]
+        assert np.allclose(s, (v.max(), v.mean(), np.percentile(v, 95)), atol=1E-4)
@@ -23,14 +23,20 @@ Requirements:
 
 Usage:
     $ python utils/benchmarks.py --weights yolov5s.pt --img 640
+    $ python utils/benchmarks.py --postprocess --device 0  # per-frame detection post-processing at 10/100/1000 boxes
+    $ python utils/benchmarks.py --processes 1 2 4 8  # CPU cascade throughput per worker process count, default sweep
+    $ python utils/benchmarks.py --hotspots  # per-box max/mean/p95 temperatures of thousands of boxes per frame
 """
 
 import argparse
+import os
 import sys
 import time
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import torch
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[1]  # YOLOv5 root directory
@@ -40,9 +46,14 @@ if str(ROOT) not in sys.path:
 
 import export
 import val
+from models.cascade import CascadeDetector
 from utils import notebook_init
-from utils.general import LOGGER, print_args
-from utils.torch_utils import select_device
+from utils.datasets import LoadImages
+from utils.general import LOGGER, det2numpy, print_args, xyxy2xywh
+from utils.plots import Annotator
+from utils.serving import ProcessDetector
+from utils.thermal import box_stats
+from utils.torch_utils import select_device, time_sync
 
 
 def run(
@@ -125,6 +136,130 @@ def test(
     return py
 
 
+def postprocess(
+        imgsz=640,  # image size (pixels)
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        counts=(10, 100, 1000),  # detections per frame
+        n=20,  # frames per measurement
+        **kwargs,  # unused run() arguments
+):
+    # Per-frame post-processing (labels + annotation) with per-scalar .cpu() copies vs one det2numpy() copy
+    device = select_device(device)
+    im0 = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+    gn = np.array(im0.shape, dtype=np.float32)[[1, 0, 1, 0]]
+
+    def per_scalar(det):
+        annotator, lines = Annotator(im0.copy()), []
+        for *xyxy, conf, cls in reversed(det):
+            x1, y1, x2, y2, c = (v.detach().cpu().clone().numpy() for v in (*xyxy, conf))
+            b = xyxy2xywh(np.array([[x1, y1, x2, y2]], dtype=np.float32)) / gn
+            lines.append(('%g ' * 5).rstrip() % (int(cls), *b[0]))
+            annotator.box_label((x1, y1, x2, y2), f' {c:.2f}')
+        return lines
+
+    def single_copy(det):
+        annotator, det = Annotator(im0.copy()), det2numpy(det)[::-1]
+        lines = [('%g ' * 5).rstrip() % (c, *b) for c, b in zip(det['cls'], xyxy2xywh(det['xyxy']) / gn)]
+        for xyxy, conf, _ in det:
+            annotator.box_label(xyxy, f' {conf:.2f}')
+        return lines
+
+    y = []
+    for k in counts:
+        xy = torch.rand(k, 2, device=device) * imgsz * 0.9
+        wh = torch.rand(k, 2, device=device) * imgsz * 0.1
+        det = torch.cat((xy, xy + wh, torch.rand(k, 1, device=device), torch.randint(0, 3, (k, 1), device=device)), 1)
+        assert per_scalar(det) == single_copy(det), 'label mismatch'
+        t = []
+        for f in per_scalar, single_copy:
+            t0 = time_sync()
+            for _ in range(n):
+                f(det)
+            t.append((time_sync() - t0) / n * 1E3)
+        y.append([k, round(t[0], 2), round(t[1], 2), round(t[0] / t[1], 1)])
+
+    py = pd.DataFrame(y, columns=['Detections', 'Per-scalar .cpu() (ms)', 'det2numpy (ms)', 'Speedup'])
+    LOGGER.info(f'\nPost-processing benchmarks on {device}\n{py}')
+    return py
+
+
+def processes(
+        imgsz=640,  # image size (pixels)
+        ks=(),  # worker process counts K, default powers of 2 up to the core count
+        source=ROOT / 'test_folder',  # benchmark images, cycled
+        n=64,  # frames per measurement
+        **kwargs,  # unused run() arguments
+):
+    # CPU cascade throughput per worker process count K, each process with cores // K intra-op threads
+    cores = os.cpu_count() or 1
+    ks = ks or [k for k in (1, 2, 4, 8, 16, 32, 64) if k <= cores]
+    dataset = list(LoadImages(source, img_size=imgsz, stride=32, auto=False))
+    batches = [[(*dataset[i % len(dataset)], 'image', 0, None)] for i in range(n)]  # batch_loader() batches of 1 frame
+
+    cascade, t = CascadeDetector(device='cpu', imgsz=(imgsz, imgsz)), time_sync()
+    cascade.warmup()
+    for b in batches:
+        cascade([x[2] for x in b], [x[1] for x in b])
+    y = [[0, torch.get_num_threads(), n / (time_sync() - t)]]  # in-process baseline, default threads
+    for k in ks:
+        with ProcessDetector(k, threads=max(cores // k, 1), imgsz=(imgsz, imgsz), device='cpu') as pool:
+            for _ in pool.imap(batches[:2 * k]):  # workers started and warmed up
+                pass
+            t = time_sync()
+            for _ in pool.imap(batches):
+                pass
+            y.append([k, max(cores // k, 1), n / (time_sync() - t)])
+
+    py = pd.DataFrame(y, columns=['Processes', 'Threads', 'FPS'])
+    py['Speedup'] = (py['FPS'] / py['FPS'][0]).round(2)
+    py['FPS'] = py['FPS'].round(2)
+    k = py['Processes'][py['FPS'].idxmax()]
+    LOGGER.info(f'\nCPU cascade benchmarks at {imgsz} on {cores} cores, 0 processes is in-process\n{py}\n'
+                f'Optimum: --processes {k}')
+    return py
+
+
+def hotspots(
+        n=10,  # calls per measurement
+        **kwargs,  # unused run() arguments
+):
+    # utils/thermal.box_stats() vs per-box slicing and np.percentile() on module grids tiling frames, grids with the
+    # jittered box edges of real detections (nearly unique shapes) and random boxes overlapping each other
+    rng = np.random.default_rng(0)
+    cases = []
+    for (h, w), (gh, gw), jitter in ((512, 640), (40, 50), 0), ((512, 640), (40, 50), 2), ((1024, 1280), (50, 60), 2):
+        x, y = np.meshgrid(np.linspace(0, w, gw + 1), np.linspace(0, h, gh + 1))
+        xyxy = np.stack((x[:-1, :-1], y[:-1, :-1], x[1:, 1:] - 2, y[1:, 1:] - 2), -1).reshape(-1, 4)  # 2 px gaps
+        xyxy += rng.uniform(-jitter, jitter, xyxy.shape)
+        cases.append(((h, w), 'jittered grid' if jitter else 'grid', xyxy.clip(0, (w, h, w, h))))
+    for (h, w), k, (bw, bh) in ((512, 640), 2000, ((20, 61), (15, 46))), ((2000, 3000), 3000, ((40, 41), (40, 41))):
+        wh = np.stack((rng.integers(*bw, k), rng.integers(*bh, k)), 1)
+        xy = rng.uniform(0, 1, (k, 2)) * ((w, h) - wh)
+        cases.append(((h, w), f'random {bw[0]}-{bw[1] - 1}x{bh[0]}-{bh[1] - 1}', np.concatenate((xy, xy + wh), 1)))
+
+    y = []
+    for (h, w), name, xyxy in cases:
+        t = rng.normal(30, 5, (h, w)).astype(np.float32)
+        b = xyxy.round().astype(int)
+        per_box = lambda: [(t[y0:y1, x0:x1].max(), t[y0:y1, x0:x1].mean(), np.percentile(t[y0:y1, x0:x1], 95))
+                           for x0, y0, x1, y1 in b]
+        assert np.allclose(box_stats(t, xyxy), per_box(), atol=1E-4), 'statistics mismatch'
+        dt = []
+        for f in per_box, lambda: box_stats(t, xyxy):
+            t0 = time_sync()
+            for _ in range(n):
+                f()
+            dt.append((time_sync() - t0) / n * 1E3)
+        wh = b[:, 2:] - b[:, :2]
+        y.append([f'{w}x{h}', name, len(b), len(np.unique(wh, axis=0)), round(wh.prod(1).sum() / 1E6, 2),
+                  round(dt[0], 2), round(dt[1], 2), round(dt[0] / dt[1], 1)])
+
+    py = pd.DataFrame(y, columns=['Frame', 'Layout', 'Boxes', 'Shapes', 'Box pixels (M)', 'Per-box (ms)',
+                                  'box_stats (ms)', 'Speedup'])
+    LOGGER.info(f'\nHotspot statistics benchmarks on 1 CPU thread, exact max/mean/p95\n{py}')
+    return py
+
+
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='weights path')
@@ -135,13 +270,24 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--test', action='store_true', help='test exports only')
     parser.add_argument('--pt-only', action='store_true', help='test PyTorch only')
+    parser.add_argument('--postprocess', action='store_true', help='benchmark detection post-processing only')
+    parser.add_argument('--processes', nargs='*', type=int, help='benchmark CPU worker process counts, i.e. 1 2 4')
+    parser.add_argument('--hotspots', action='store_true', help='benchmark per-box hotspot temperature statistics only')
     opt = parser.parse_args()
     print_args(vars(opt))
     return opt
 
 
 def main(opt):
-    test(**vars(opt)) if opt.test else run(**vars(opt))
+    ks = vars(opt).pop('processes')
+    if vars(opt).pop('hotspots'):
+        hotspots(**vars(opt))
+    elif vars(opt).pop('postprocess'):
+        postprocess(**vars(opt))
+    elif ks is not None:
+        processes(ks=ks, **vars(opt))
+    else:
+        test(**vars(opt)) if opt.test else run(**vars(opt))
 
 
 if __name__ == "__main__":
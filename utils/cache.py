@@ -0,0 +1,296 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+On-disk result cache, per-frame NMS candidates keyed by letterboxed frame content and model fingerprint
+
+Entries hold the raw predictions of one model on one frame that pass the confidence threshold they were computed with.
+Re-runs with cosmetic changes or stricter thresholds re-run NMS on the cached candidates instead of the models, a lower
+confidence threshold than the cached one re-infers the frame and replaces the entry. SessionCache keeps the candidates
+of one interactive session in memory down to a low confidence floor, so threshold tuning only ever re-runs NMS.
+
+Usage:
+    from utils.cache import ResultCache
+    cache = ResultCache('runs/cache', max_mb=1024)
+    cascade = CascadeDetector(cache=cache)  # or $ python detection.py --cache runs/cache
+    print(cache.report())  # hits, misses, entries and size
+
+    session = SessionCache(max_mb=256)  # in memory, spilled to a temporary file beyond 256 MB
+    detection.run(source='survey/', conf_thres=0.4, cache=session)  # infers
+    detection.run(source='survey/', conf_thres=0.1, iou_thres=0.3, cache=session)  # NMS only
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from utils.general import ROOT, colorstr
+
+CACHE_MB = float(os.getenv('YOLOv5_CACHE_MB', 1024))  # result cache size budget (MB)
+
+
+class ResultCache:
+    # LRU directory of {key}.npz files, each the (n, 5+nc) NMS candidates of one model on one frame and their threshold
+    def __init__(self, path=ROOT / 'runs/cache', max_mb=CACHE_MB, conf_floor=1.0):
+        """
+        Opens or creates the cache directory.
+
+        Args:
+            path (str or Path): Cache directory, shared between runs.
+            max_mb (float): Size budget in MB, least recently used entries are deleted once it is exceeded.
+            conf_floor (float): Candidates are kept above the lower of the run confidence threshold and conf_floor,
+                lower floors let later runs lower the threshold without re-inference at the cost of larger entries.
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes, self.conf_floor = max_mb * (1 << 20), conf_floor
+        self.lock = threading.Lock()
+        files = sorted(self.path.glob('*.npz'), key=lambda f: f.stat().st_mtime)  # mtime is the last use
+        self.entries = OrderedDict((f.stem, f.stat().st_size) for f in files)  # key: bytes, least recent first
+        self.bytes = sum(self.entries.values())
+        self.fingerprints = {}  # (weights, mtime, size, fp16, augment): fingerprint
+        self.hits, self.misses, self.stale, self.evicted = 0, 0, 0, 0
+
+    def fingerprint(self, model, augment=False):
+        # Model fingerprint, weights content hash with the settings that change raw predictions
+        w = Path(model.w)
+        s = w.stat() if w.is_file() else None
+        k = str(w.resolve()), s and s.st_mtime_ns, s and s.st_size, model.fp16, augment
+        if k not in self.fingerprints:
+            h = hashlib.blake2b(digest_size=8)
+            if s:
+                with open(w, 'rb') as f:
+                    for b in iter(lambda: f.read(1 << 20), b''):
+                        h.update(b)
+            else:  # directory backends, i.e. *_saved_model
+                h.update(str(k[:3]).encode())
+            h.update(f'{model.fp16}{augment}'.encode())
+            self.fingerprints[k] = h.hexdigest()
+        return self.fingerprints[k]
+
+    @staticmethod
+    def frame_key(im):
+        # Content hash of one letterboxed uint8 (3,h,w) frame, shape included
+        im = np.ascontiguousarray(im)
+        h = hashlib.blake2b(im.data, digest_size=16)
+        h.update(str(im.shape).encode())
+        return h.hexdigest()
+
+    def get(self, key, conf_thres, device=None):
+        """
+        Looks up cached candidates.
+
+        Args:
+            key (str): Frame key + model fingerprint.
+            conf_thres (float): Confidence threshold the candidates are for, entries cached at a higher threshold miss.
+            device (torch.device, optional): Device of the returned tensor.
+
+        Returns:
+            torch.Tensor or None: (n, 5+nc) candidates with objectness > the cached threshold, None on a miss.
+        """
+        f = self.path / f'{key}.npz'
+        try:
+            with np.load(f) as x:
+                if x['conf'] > conf_thres:
+                    with self.lock:
+                        self.stale += 1
+                    return None
+                y = torch.from_numpy(x['x']).to(device)
+            os.utime(f)  # recency survives across runs
+        except (OSError, KeyError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return y
+
+    def put(self, key, x, conf_thres):
+        # Store candidates x (n, 5+nc) with objectness > conf_thres, then evict least recently used entries
+        f = self.path / f'{key}.npz'
+        tmp = f.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp, 'wb') as fo:
+            np.savez(fo, x=x.cpu().numpy(), conf=np.float32(conf_thres))
+        os.replace(tmp, f)  # atomic, concurrent runs never read a partial entry
+        with self.lock:
+            self.bytes += f.stat().st_size - self.entries.pop(key, 0)
+            self.entries[key] = f.stat().st_size
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                k, b = self.entries.popitem(last=False)
+                f = self.path / f'{k}.npz'
+                if f.exists():
+                    f.unlink()
+                self.bytes -= b
+                self.evicted += 1
+
+    def stats(self):
+        # Lookup and size statistics of this session
+        with self.lock:
+            n = self.hits + self.misses + self.stale
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,  # cached at a higher confidence threshold
+                'hit_rate': self.hits / n if n else 0.0,
+                'entries': len(self.entries),
+                'MB': self.bytes / (1 << 20),
+                'evicted': self.evicted}
+
+    def report(self):
+        # One line summary for the run log
+        s, mb = self.stats(), self.max_bytes / (1 << 20)
+        return (f"{colorstr('cache:')} {s['hits']} hits, {s['misses']} misses, {s['stale']} stale "
+                f"({s['hit_rate']:.0%} hit rate), {s['entries']} entries {s['MB']:.1f}/{mb:.0f} MB, "
+                f"{s['evicted']} evicted, {self.path}")
+
+
+class SessionCache(ResultCache):
+    # In-memory NMS candidates of one interactive session, least recently used entries spill to a bounded file
+    def __init__(self, max_mb=256, conf_floor=0.001, spill=None, spill_mb=1024):
+        """
+        Initializes an empty session cache.
+
+        Args:
+            max_mb (float): In-memory budget in MB, least recently used entries beyond it are moved to the spill file.
+            conf_floor (float): Candidates are kept above the lower of the run confidence threshold and conf_floor.
+            spill (str or Path, optional): Spill file, a temporary file deleted by close() if None.
+            spill_mb (float): Spill file size cap in MB, the oldest spilled entries are dropped beyond it.
+        """
+        self.max_bytes, self.conf_floor, self.max_spill = max_mb * (1 << 20), conf_floor, spill_mb * (1 << 20)
+        self.spill, self.owner = spill, spill is None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key: (candidates np.ndarray, conf), least recent first
+        self.spilled = OrderedDict()  # key: (offset, nbytes, shape, dtype, conf) in the spill file, oldest first
+        self.free = []  # (offset, nbytes) unused ranges of the spill file by offset, reused by later spills
+        self.file = None  # spill file, opened on first spill
+        self.bytes, self.size = 0, 0  # in memory, spill file
+        self.fingerprints = {}
+        self.hits, self.misses, self.stale, self.evicted, self.dropped = 0, 0, 0, 0, 0
+
+    def get(self, key, conf_thres, device=None):
+        # Candidates cached at or below conf_thres as a tensor on device, None on a miss, see ResultCache.get()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                x, conf = self.entries[key]
+            elif key in self.spilled:
+                x, conf = None, self.spilled[key][-1]
+            else:
+                self.misses += 1
+                return None
+            if conf > conf_thres:
+                self.stale += 1
+                return None
+            if x is None:
+                x = self.unspill(key)  # hits move back to memory
+            self.hits += 1
+        return torch.tensor(x, device=device)  # copy, entries stay valid
+
+    def put(self, key, x, conf_thres):
+        # Store candidates x (n, 5+nc) with objectness > conf_thres, spilling least recently used entries to disk
+        x = x.cpu().numpy()
+        with self.lock:
+            if key in self.spilled:  # superseded
+                self.release(*self.spilled.pop(key)[:2])
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[0].nbytes
+            self.entries[key] = x, conf_thres
+            self.bytes += x.nbytes
+            self.shrink()
+
+    def shrink(self):
+        # Move least recently used entries beyond the memory budget to the spill file, dropping the oldest spilled
+        # entries beyond the spill file cap
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            k, (y, conf) = self.entries.popitem(last=False)
+            self.bytes -= y.nbytes
+            self.evicted += 1
+            fits = lambda: any(n >= y.nbytes for _, n in self.free) or self.size + y.nbytes <= self.max_spill
+            while self.spilled and not fits():
+                self.release(*self.spilled.popitem(last=False)[1][:2])
+                self.dropped += 1
+            if not fits():  # larger than the cap
+                self.dropped += 1
+                continue
+            if self.file is None:
+                if self.owner:
+                    fd, self.spill = tempfile.mkstemp(suffix='.spill')
+                    os.close(fd)
+                self.file = open(self.spill, 'w+b')
+            offset = self.allocate(y.nbytes)
+            self.file.seek(offset)
+            self.file.write(y.tobytes())
+            self.spilled[k] = offset, y.nbytes, y.shape, y.dtype.str, conf
+
+    def unspill(self, key):
+        # Read a spilled entry back into memory as the most recent entry, freeing its range of the spill file
+        offset, nbytes, shape, dtype, conf = self.spilled.pop(key)
+        x = np.empty(shape, dtype=dtype)
+        if nbytes:
+            self.file.seek(offset)
+            self.file.readinto(x.data.cast('B'))
+        self.release(offset, nbytes)
+        self.entries[key] = x, conf
+        self.bytes += nbytes
+        self.shrink()
+        return x
+
+    def allocate(self, nbytes):
+        # Offset of nbytes in the spill file, first fit in the free ranges else appended
+        for i, (o, n) in enumerate(self.free):
+            if n >= nbytes:
+                self.free[i:i + 1] = [(o + nbytes, n - nbytes)] if n > nbytes else []
+                return o
+        self.size += nbytes
+        return self.size - nbytes
+
+    def release(self, offset, nbytes):
+        # Return a range to the free ranges, merged with its neighbours, truncating the file if it was the last one
+        if not nbytes:
+            return
+        free = []
+        for o, n in sorted(self.free + [(offset, nbytes)]):
+            if free and free[-1][0] + free[-1][1] == o:
+                free[-1] = free[-1][0], free[-1][1] + n
+            else:
+                free.append((o, n))
+        if free[-1][0] + free[-1][1] == self.size:
+            self.size = free.pop()[0]
+            self.file.truncate(self.size)
+        self.free = free
+
+    def stats(self):
+        # Lookup and size statistics, entries in memory and spilled
+        s = super().stats()
+        with self.lock:
+            s['entries'] += len(self.spilled)
+            s['spilled'] = len(self.spilled)
+            s['spill_MB'] = self.size / (1 << 20)
+            s['dropped'] = self.dropped
+        return s
+
+    def report(self):
+        # One line summary for the run log
+        s, mb = self.stats(), self.max_bytes / (1 << 20)
+        return (f"{colorstr('cache:')} {s['hits']} hits, {s['misses']} misses, {s['stale']} stale "
+                f"({s['hit_rate']:.0%} hit rate), {s['entries']} entries {s['MB']:.1f}/{mb:.0f} MB in memory, "
+                f"{s['spilled']} spilled {s['spill_MB']:.1f} MB, {s['dropped']} dropped")
+
+    def close(self):
+        # Drop all entries and the spill file
+        with self.lock:
+            self.entries.clear()
+            self.spilled.clear()
+            self.free = []
+            self.bytes, self.size = 0, 0
+            if self.file:
+                self.file.close()
+                self.file = None
+                if self.owner and os.path.exists(self.spill):
+                    os.remove(self.spill)
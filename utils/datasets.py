@@ -8,13 +8,15 @@ import hashlib
 import json
 import math
 import os
+import queue
 import random
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import repeat
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Event, Thread
 from urllib.parse import urlparse
 from zipfile import ZipFile
 
@@ -29,6 +31,8 @@ from tqdm import tqdm
 from utils.augmentations import Albumentations, augment_hsv, copy_paste, letterbox, mixup, random_perspective
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, check_dataset, check_requirements, check_yaml, clean_str,
                            cv2, segments2boxes, xyn2xy, xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
+from utils.raster import RASTER_FORMATS, open_raster
+from utils.thermal import Radiometric
 from utils.torch_utils import torch_distributed_zero_first
 
 # Parameters
@@ -37,6 +41,8 @@ IMG_FORMATS = 'bmp', 'dng', 'jpeg', 'jpg', 'mpo', 'png', 'tif', 'tiff', 'webp'
 VID_FORMATS = 'asf', 'avi', 'gif', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg', 'ts', 'wmv'  # include video suffixes
 BAR_FORMAT = '{l_bar}{bar:10}{r_bar}{bar:-10b}'  # tqdm bar format
 LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
+STREAM_POLICIES = 'latest', 'every'  # LoadStreams frame policies, newest frame only or every decoded frame
+STREAM_BACKOFF = 0.5, 30.0  # LoadStreams reconnect delay, initial and maximum seconds, doubled per failed attempt
 
 # Get orientation exif tag
 for orientation in ExifTags.TAGS.keys():
@@ -177,7 +183,7 @@ class _RepeatSampler:
 
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True):
+    def __init__(self, path, img_size=640, stride=32, auto=True, radiometric=None):
         p = str(Path(path).resolve())  # os-agnostic absolute path
         if '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
@@ -188,7 +194,8 @@ class LoadImages:
         else:
             raise Exception(f'ERROR: {p} does not exist')
 
-        images = [x for x in files if x.split('.')[-1].lower() in IMG_FORMATS]
+        formats = IMG_FORMATS + ('npy',) if radiometric else IMG_FORMATS  # .npy temperature arrays
+        images = [x for x in files if x.split('.')[-1].lower() in formats]
         videos = [x for x in files if x.split('.')[-1].lower() in VID_FORMATS]
         ni, nv = len(images), len(videos)
 
@@ -199,6 +206,8 @@ class LoadImages:
         self.video_flag = [False] * ni + [True] * nv
         self.mode = 'image'
         self.auto = auto
+        self.radiometric = radiometric  # Radiometric normalization of 16-bit/float image frames, None for 8-bit BGR
+        self.temperature = None  # °C view of the last frame if radiometric
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -230,23 +239,32 @@ class LoadImages:
                     ret_val, img0 = self.cap.read()
 
             self.frame += 1
+            self.temperature = None
             s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.frames}) {path}: '
 
         else:
             # Read image
             self.count += 1
-            img0 = cv2.imread(path)  # BGR
-            assert img0 is not None, f'Image Not Found {path}'
+            img0, self.temperature = self.imread(path)
             s = f'image {self.count}/{self.nf} {path}: '
 
-        # Padded resize
-        img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
+        img, img0 = self.letterbox(img0)
+        return path, img, img0, self.cap, s
 
-        # Convert
-        img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-        img = np.ascontiguousarray(img)
+    def imread(self, path):
+        # BGR image, or (h,w) normalized radiometric frame and its °C view
+        if self.radiometric:
+            return self.radiometric.imread(path)
+        img0 = cv2.imread(path)  # BGR
+        assert img0 is not None, f'Image Not Found {path}'
+        return img0, None
 
-        return path, img, img0, self.cap, s
+    def letterbox(self, img0):
+        # Padded resize to contiguous CHW RGB, radiometric frames letterboxed as 1 channel and displayed as BGR
+        img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]
+        if img0.ndim == 2:
+            return np.ascontiguousarray(img[None]), cv2.cvtColor(img0, cv2.COLOR_GRAY2BGR)
+        return np.ascontiguousarray(img.transpose((2, 0, 1))[::-1]), img0  # HWC to CHW, BGR to RGB
 
     def new_video(self, path):
         self.frame = 0
@@ -257,6 +275,87 @@ class LoadImages:
         return self.nf  # number of files
 
 
+class LoadImagesPrefetch(LoadImages):
+    # LoadImages with image decoding and letterboxing on a thread pool, up to `depth` frames prefetched in order
+    def __init__(self, path, img_size=640, stride=32, auto=True, workers=4, depth=32, radiometric=None):
+        super().__init__(path, img_size, stride, auto, radiometric)
+        if self.cap:
+            self.cap.release()  # videos are opened by the prefetch thread
+        self.workers, self.depth = max(workers, 1), max(depth, 1)
+        self.thread = None
+
+    def __iter__(self):
+        self.close()
+        self.count, self.frame, self.cap = 0, 0, None
+        self.queue = queue.Queue(self.depth)  # futures, in order
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='prefetch')
+        self.stop = Event()
+        self.thread = Thread(target=self.prefetch, daemon=True)
+        self.thread.start()
+        return self
+
+    def prefetch(self):
+        # Read video frames in order and submit decode/letterbox jobs, blocking while `depth` frames are queued
+        try:
+            for i, (path, video) in enumerate(zip(self.files, self.video_flag)):
+                if not video:
+                    self.put(self.pool.submit(self.prepare, path, None, None, f'image {i + 1}/{self.nf} {path}: ',
+                                              'image', 0, i + 1))
+                    continue
+                cap = cv2.VideoCapture(path)
+                frames, frame = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0
+                while not self.stop.is_set():
+                    ret_val, img0 = cap.read()
+                    if not ret_val:
+                        break
+                    frame += 1
+                    s = f'video {i + 1}/{self.nf} ({frame}/{frames}) {path}: '
+                    self.put(self.pool.submit(self.prepare, path, img0, cap, s, 'video', frame, i))
+                if self.stop.is_set():
+                    break
+        finally:
+            self.put(None)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                return self.queue.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def prepare(self, path, img0, cap, s, mode, frame, count):
+        temperature = None
+        if img0 is None:
+            img0, temperature = self.imread(path)
+        img, img0 = self.letterbox(img0)
+        return path, img, img0, cap, s, mode, frame, count, temperature
+
+    def __next__(self):
+        future = self.queue.get()
+        if future is None:
+            self.close()
+            raise StopIteration
+        path, img, img0, cap, s, self.mode, self.frame, self.count, self.temperature = future.result()
+        if self.cap is not cap and self.cap is not None:
+            self.cap.release()  # previous video finished
+        self.cap = cap
+        return path, img, img0, cap, s
+
+    def close(self):
+        # Stop prefetching and release the current video
+        if self.thread:
+            self.stop.set()
+            self.thread.join()
+            while not self.queue.empty():
+                future = self.queue.get_nowait()
+                if future:
+                    future.cancel()
+            self.pool.shutdown()
+            self.thread = None
+        if self.cap:
+            self.cap.release()
+
+
 class LoadWebcam:  # for inference
     # YOLOv5 local webcam dataloader, i.e. `python detect.py --source 0`
     def __init__(self, pipe='0', img_size=640, stride=32):
@@ -301,10 +400,14 @@ class LoadWebcam:  # for inference
 
 class LoadStreams:
     # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True):
+    # One reader thread and bounded frame queue per stream, the 'latest' policy drops the oldest queued frame when the
+    # queue is full and yields only new frames, 'every' blocks the reader so every decoded frame is yielded
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True, policy='latest', buffer=8, workers=4):
+        assert policy in STREAM_POLICIES, f'invalid stream policy {policy}, valid policies are {STREAM_POLICIES}'
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.policy = policy
 
         if os.path.isfile(sources):
             with open(sources) as f:
@@ -316,6 +419,11 @@ class LoadStreams:
         self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         self.auto = auto
+        self.queues = [queue.Queue(max(buffer, 1)) for _ in range(n)]  # (frame, decode time), None once ended
+        self.ended = [False] * n
+        self.stream_stats = [StreamStats() for _ in range(n)]
+        self.stop, self.fresh = Event(), Event()  # stop readers, a frame was queued
+        self.pool = ThreadPoolExecutor(max(min(workers, n), 1), thread_name_prefix='letterbox')
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
@@ -333,6 +441,8 @@ class LoadStreams:
             self.fps[i] = max((fps if math.isfinite(fps) else 0) % 100, 0) or 30  # 30 FPS fallback
 
             _, self.imgs[i] = cap.read()  # guarantee first frame
+            self.queues[i].put((self.imgs[i], time.time()))
+            self.stream_stats[i].decoded = 1
             self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=True)
             LOGGER.info(f"{st} Success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)")
             self.threads[i].start()
@@ -345,21 +455,73 @@ class LoadStreams:
             LOGGER.warning('WARNING: Stream shapes differ. For optimal performance supply similarly-shaped streams.')
 
     def update(self, i, cap, stream):
-        # Read stream `i` frames in daemon thread
-        n, f, read = 0, self.frames[i], 1  # frame number, frame array, inference every 'read' frame
-        while cap.isOpened() and n < f:
-            n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n % read == 0:
+        # Read stream `i` frames in daemon thread, reconnecting with exponential backoff while the signal is lost
+        n, f, stats = 1, self.frames[i], self.stream_stats[i]  # frame number, frames, stats
+        t0, delay = time.time(), STREAM_BACKOFF[0]
+        while not self.stop.is_set() and n < f:
+            if cap.isOpened() and cap.grab():
                 success, im = cap.retrieve()
                 if success:
-                    self.imgs[i] = im
-                else:
-                    LOGGER.warning('WARNING: Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] = np.zeros_like(self.imgs[i])
-                    cap.open(stream)  # re-open stream if signal was lost
-            time.sleep(1 / self.fps[i])  # wait time
+                    n += 1
+                    delay = STREAM_BACKOFF[0]  # connected
+                    stats.decoded += 1
+                    self.put(i, im)
+                    if f != float('inf') and self.policy == 'latest':  # pace finite videos at their FPS like live feeds
+                        self.stop.wait(max(t0 + n / self.fps[i] - time.time(), 0))
+                    continue
+            elif f != float('inf') and cap.isOpened():
+                break  # end of a finite video
+            LOGGER.warning(f'WARNING: Video stream {self.sources[i]} unresponsive, reconnecting in {delay:.1f}s')
+            cap.release()
+            if self.stop.wait(delay):
+                break
+            cap.open(stream)  # re-open stream if signal was lost
+            stats.reconnects += 1
+            delay = min(delay * 2, STREAM_BACKOFF[1])
+        cap.release()
+        self.put(i, None)
+
+    def put(self, i, im):
+        # Queue a decoded frame (None at the end of the stream) per the stream policy
+        q, item = self.queues[i], None if im is None else (im, time.time())
+        while not self.stop.is_set():
+            try:
+                q.put(item, block=self.policy == 'every' or item is None, timeout=0.1)
+                self.fresh.set()
+                return
+            except queue.Full:
+                if self.policy == 'latest':
+                    try:
+                        q.get_nowait()  # drop the oldest frame
+                        self.stream_stats[i].dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def get(self, i, block=True):
+        # Next queued frame of stream `i` or None if there is none yet, marks the stream ended at its end
+        while not self.stop.is_set():
+            try:
+                item = self.queues[i].get(block=block, timeout=0.1 if block else None)
+            except queue.Empty:
+                if block:
+                    continue
+                return None
+            if item is None:
+                self.ended[i] = True
+                return None
+            self.stream_stats[i].latency(time.time() - item[1])
+            if self.policy == 'latest':  # newest queued frame, older queued frames are dropped
+                while True:
+                    try:
+                        newer = self.queues[i].get_nowait()
+                    except queue.Empty:
+                        break
+                    if newer is None:
+                        self.ended[i] = True
+                        break
+                    self.stream_stats[i].dropped += 1
+                    item = newer
+            return item[0]
 
     def __iter__(self):
         self.count = -1
@@ -367,13 +529,30 @@ class LoadStreams:
 
     def __next__(self):
         self.count += 1
-        if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
+        if any(self.ended) or cv2.waitKey(1) == ord('q'):  # q to quit
+            self.close()
             cv2.destroyAllWindows()
             raise StopIteration
 
-        # Letterbox
+        # Frames, every stream's next frame, or the latest frames once at least one stream has a new one
+        if self.policy == 'every':
+            new = [self.get(i) for i in range(len(self.sources))]
+        else:
+            while True:
+                self.fresh.clear()
+                new = [self.get(i, block=False) for i in range(len(self.sources))]
+                if any(x is not None for x in new) or any(self.ended) or self.stop.is_set():
+                    break
+                self.fresh.wait(0.1)
+        if any(self.ended) or self.stop.is_set():
+            self.close()
+            raise StopIteration
+        self.imgs = [x if x is not None else im for x, im in zip(new, self.imgs)]  # streams without a new frame repeat
         img0 = self.imgs.copy()
-        img = [letterbox(x, self.img_size, stride=self.stride, auto=self.rect and self.auto)[0] for x in img0]
+
+        # Letterbox
+        auto = self.rect and self.auto
+        img = list(self.pool.map(lambda x: letterbox(x, self.img_size, stride=self.stride, auto=auto)[0], img0))
 
         # Stack
         img = np.stack(img, 0)
@@ -384,10 +563,41 @@ class LoadStreams:
 
         return self.sources, img, img0, None, ''
 
+    def stats(self):
+        # Per-stream decoded FPS, dropped frames, queue latency and reconnects
+        return [{'source': s, **x.as_dict()} for s, x in zip(self.sources, self.stream_stats)]
+
+    def close(self):
+        # Stop the reader threads and release the streams
+        self.stop.set()
+        for t in self.threads:
+            if t:
+                t.join(timeout=5)  # a reader blocked in a stalled network read is left to exit on its own
+        self.pool.shutdown()
+
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
 
+class StreamStats:
+    # Decoded, dropped and reconnect counts and mean decode to yield latency of one LoadStreams stream
+    def __init__(self):
+        self.t0 = time.time()
+        self.decoded, self.dropped, self.reconnects, self.yielded, self.total_latency = 0, 0, 0, 0, 0.0
+
+    def latency(self, dt):
+        self.yielded += 1
+        self.total_latency += dt
+
+    def as_dict(self):
+        return {
+            'decoded': self.decoded,
+            'fps': self.decoded / max(time.time() - self.t0, 1E-9),
+            'dropped': self.dropped,
+            'latency_ms': self.total_latency / max(self.yielded, 1) * 1E3,
+            'reconnects': self.reconnects}
+
+
 def img2label_paths(img_paths):
     # Define label paths as a function of image paths
     sa, sb = os.sep + 'images' + os.sep, os.sep + 'labels' + os.sep  # /images/, /labels/ substrings
@@ -659,10 +869,20 @@ class LoadImagesAndLabels(Dataset):
         if im is None:  # not cached in RAM
             if fn.exists():  # load npy
                 im = np.load(fn)
+                h0, w0 = im.shape[:2]  # orig hw
+            elif f.split('.')[-1].lower() in RASTER_FORMATS:  # large rasters by window, strided down to about img_size
+                im = open_raster(f)
+                h0, w0 = im.shape[:2]  # orig hw
+                k = max(max(h0, w0) // (2 * self.img_size), 1)  # read stride, INTER_AREA resize below does the rest
+                im = np.ascontiguousarray(im[::k, ::k])
+                if im.dtype != np.uint8:  # 16-bit/float radiometric frames, per-frame range
+                    im = Radiometric()(im[..., 0] if im.ndim == 3 else im)
+                if im.ndim == 2:
+                    im = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
             else:  # read image
                 im = cv2.imread(f)  # BGR
                 assert im is not None, f'Image Not Found {f}'
-            h0, w0 = im.shape[:2]  # orig hw
+                h0, w0 = im.shape[:2]  # orig hw
             r = self.img_size / max(h0, w0)  # ratio
             if r != 1:  # if sizes are not equal
                 im = cv2.resize(im, (int(w0 * r), int(h0 * r)),
@@ -816,7 +1036,7 @@ class LoadImagesAndLabels(Dataset):
         im, label, path, shapes = zip(*batch)  # transposed
         for i, lb in enumerate(label):
             lb[:, 0] = i  # add target image index for build_targets()
-        return torch.stack(im, 0), torch.cat(label, 0), path, shapes
+        return dataloader.default_collate(im), torch.cat(label, 0), path, shapes  # shared memory batch in workers
 
     @staticmethod
     def collate_fn4(batch):
@@ -842,7 +1062,7 @@ class LoadImagesAndLabels(Dataset):
         for i, lb in enumerate(label4):
             lb[:, 0] = i  # add target image index for build_targets()
 
-        return torch.stack(im4, 0), torch.cat(label4, 0), path4, shapes4
+        return dataloader.default_collate(im4), torch.cat(label4, 0), path4, shapes4
 
 
 # Ancillary functions --------------------------------------------------------------------------------------------------
@@ -1,19 +1,21 @@
 # YOLOv5 🚀 by Ultralytics, GPL-3.0 license
 """
-Perform test request
+Perform test requests
 """
 
 import pprint
 
 import requests
 
-DETECTION_URL = "http://localhost:5000/v1/object-detection/yolov5s"
-IMAGE = "zidane.jpg"
+DETECTION_URL = "http://localhost:5000/v1/pv/cascade"  # or /v1/pv/arrays, /v1/pv/modules, /v1/pv/faults
+IMAGE = "test_folder/imgFC30.png"
 
 # Read image
 with open(IMAGE, "rb") as f:
     image_data = f.read()
 
-response = requests.post(DETECTION_URL, files={"image": image_data}).json()
-
+response = requests.post(DETECTION_URL, files={"image": image_data}).json()  # multipart upload
 pprint.pprint(response)
+
+response = requests.post(DETECTION_URL, data=image_data).json()  # raw image bytes
+pprint.pprint(response["results"][0]["speed"])
@@ -0,0 +1,96 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Load test a local REST API instance, reports throughput and latency percentiles per concurrency level
+
+Usage:
+    $ python utils/flask_rest_api/restapi.py --workers 2 &
+    $ python utils/flask_rest_api/load_test.py --image test_folder/imgFC30.png --task cascade --concurrency 1 2 4 8
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import requests
+
+ROOT = Path(__file__).resolve().parents[2]  # YOLOv5 root directory
+
+
+def request(session, url, data, raw=False):
+    # POST one image, returns (latency seconds, HTTP status code)
+    t = time.perf_counter()
+    try:
+        r = session.post(url, data=data) if raw else session.post(url, files={"image": ("image.png", data)})
+        code = r.status_code
+    except requests.RequestException:
+        code = 0  # connection error
+    return time.perf_counter() - t, code
+
+
+def run(url="http://localhost:5000", task="cascade", image=ROOT / "test_folder/imgFC30.png", concurrency=(1, 2, 4),
+        requests_=32, raw=False, warmup=2):
+    """
+    Sends requests_ requests at each concurrency level and prints throughput and latency statistics.
+
+    Args:
+        url (str): REST API base URL.
+        task (str): Endpoint, 'arrays', 'modules', 'faults' or 'cascade'.
+        image (str or Path): Image file sent with every request.
+        concurrency (tuple): Concurrent client counts to test.
+        requests_ (int): Requests per concurrency level.
+        raw (bool): Send raw image bytes instead of a multipart upload.
+        warmup (int): Untimed requests sent first.
+
+    Returns:
+        list: One dict of statistics per concurrency level.
+    """
+    endpoint = f"{url.rstrip('/')}/v1/pv/{task}"
+    data = Path(image).read_bytes()
+    session = requests.Session()
+    for _ in range(warmup):
+        request(session, endpoint, data, raw)
+
+    results = []
+    print(f"{'clients':>8}{'requests':>10}{'errors':>8}{'req/s':>10}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}"
+          f"{'p99 ms':>10}")
+    for c in concurrency:
+        with ThreadPoolExecutor(c) as pool:
+            sessions = [requests.Session() for _ in range(c)]
+            t = time.perf_counter()
+            y = list(pool.map(lambda i: request(sessions[i % c], endpoint, data, raw), range(requests_)))
+            dt = time.perf_counter() - t
+        lat = np.array([x[0] for x in y if x[1] == 200]) * 1E3
+        errors = sum(x[1] != 200 for x in y)
+        p50, p90, p99 = np.percentile(lat, (50, 90, 99)) if len(lat) else (np.nan,) * 3
+        r = {
+            'clients': c,
+            'requests': requests_,
+            'errors': errors,
+            'throughput': (requests_ - errors) / dt,
+            'mean': lat.mean() if len(lat) else np.nan,
+            'p50': p50,
+            'p90': p90,
+            'p99': p99}
+        results.append(r)
+        print(f"{c:>8}{requests_:>10}{errors:>8}{r['throughput']:>10.2f}{r['mean']:>10.1f}{p50:>10.1f}{p90:>10.1f}"
+              f"{p99:>10.1f}")
+    return results
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser(description="Load test the PV fault detection REST API")
+    parser.add_argument("--url", default="http://localhost:5000", help="REST API base URL")
+    parser.add_argument("--task", default="cascade", choices=("arrays", "modules", "faults", "cascade"), help="endpoint")
+    parser.add_argument("--image", default=ROOT / "test_folder/imgFC30.png", help="image sent with every request")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 2, 4], help="concurrent clients to test")
+    parser.add_argument("--requests", dest="requests_", type=int, default=32, help="requests per concurrency level")
+    parser.add_argument("--raw", action="store_true", help="send raw image bytes instead of multipart uploads")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed warmup requests")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    run(**vars(opt))
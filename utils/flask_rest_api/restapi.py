@@ -1,46 +1,137 @@
 # YOLOv5 🚀 by Ultralytics, GPL-3.0 license
 """
-Run a Flask REST API exposing a YOLOv5s model
+Run a Flask REST API exposing the PV array, single PV module and fault detectors and the full cascade
+
+Models are loaded once at startup from local checkpoints, no network access is required. Concurrent requests are
+micro-batched, frames are queued and run in batches of up to --max-batch frames collected for up to --max-wait ms by
+--workers batch workers, each with its own CascadeDetector sharing the models through the model registry.
+
+Usage:
+    $ python utils/flask_rest_api/restapi.py --port 5000 --workers 1 --max-batch 8 --max-wait 5
+    $ curl -X POST -F image=@test_folder/imgFC30.png http://localhost:5000/v1/pv/cascade  # multipart upload(s)
+    $ curl -X POST --data-binary @test_folder/imgFC30.png http://localhost:5000/v1/pv/faults  # raw image bytes
+
+    $ gunicorn -w 1 --threads 8 -b 0.0.0.0:5000 'utils.flask_rest_api.restapi:create_app(workers=2)'  # WSGI server
 """
 
 import argparse
-import io
+import sys
+from pathlib import Path
 
-import torch
-from flask import Flask, request
-from PIL import Image
+import cv2
+import numpy as np
+from flask import Flask, jsonify, request
 
-app = Flask(__name__)
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[2]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
 
-DETECTION_URL = "/v1/object-detection/yolov5s"
+from models.cascade import TASKS
+from utils.general import LOGGER, colorstr, print_args
+from utils.serving import MicroBatcher
+from utils.torch_utils import select_device
 
+DETECTION_URL = "/v1/pv/<task>"  # task: arrays, modules, faults or cascade
+ENDPOINTS = {**{k: (k,) for k in TASKS}, "cascade": TASKS}  # endpoint: models run
 
-@app.route(DETECTION_URL, methods=["POST"])
-def predict():
-    if not request.method == "POST":
-        return
 
-    if request.files.get("image"):
-        # Method 1
-        # with request.files["image"] as f:
-        #     im = Image.open(io.BytesIO(f.read()))
+def read_images():
+    # Decode the request images, multipart 'image' file fields or the raw request body. Returns [(name, im)]
+    if request.mimetype == "multipart/form-data":
+        files = request.files.getlist("image") or list(request.files.values())
+        data = [(f.filename or f"image{i}", f.read()) for i, f in enumerate(files)]
+    else:  # raw bytes, any content type
+        data = [("image0", request.get_data())]
+    if not data:
+        raise ValueError("no image, send multipart 'image' files or raw image bytes")
+    ims = []
+    for name, b in data:
+        im = cv2.imdecode(np.frombuffer(b, np.uint8), cv2.IMREAD_COLOR) if b else None
+        if im is None:
+            raise ValueError(f"could not decode image {name!r}")
+        ims.append((name, im))
+    return ims
 
-        # Method 2
-        im_file = request.files["image"]
-        im_bytes = im_file.read()
-        im = Image.open(io.BytesIO(im_bytes))
 
-        results = model(im, size=640)  # reduce size=320 for faster inference
-        return results.pandas().xyxy[0].to_json(orient="records")
+def create_app(timeout=60.0, device="", **kwargs):
+    """
+    Creates the Flask app and loads the models.
 
+    Args:
+        timeout (float): Seconds a request may wait for its results before failing with 504.
+        device (str): CUDA device, i.e. 0 or 0,1,2,3 or cpu.
+        **kwargs: MicroBatcher and CascadeDetector arguments, i.e. workers, max_batch, max_wait (seconds), max_queue,
+            weights, weights_fault, weights_single, imgsz, half, conf_thres.
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Flask API exposing YOLOv5 model")
+    Returns:
+        Flask: The application, with the micro-batcher at app.config['batcher'].
+    """
+    app = Flask(__name__)
+    batcher = MicroBatcher(device=select_device(device), **kwargs)
+    app.config["batcher"] = batcher
+
+    @app.route("/v1/health", methods=["GET"])
+    def health():
+        return jsonify(status="ok",
+                       endpoints=[DETECTION_URL.replace("<task>", k) for k in ENDPOINTS],
+                       names=batcher.names,
+                       workers=len(batcher.threads),
+                       metrics=batcher.metrics())
+
+    @app.route("/v1/metrics", methods=["GET"])
+    def metrics():
+        return jsonify(batcher.metrics())
+
+    @app.route(DETECTION_URL, methods=["POST"])
+    def predict(task):
+        if task not in ENDPOINTS:
+            return jsonify(error=f"unknown endpoint {task!r}, valid endpoints are {list(ENDPOINTS)}"), 404
+        try:
+            ims = read_images()
+            results = batcher([x[1] for x in ims], tasks=ENDPOINTS[task], timeout=timeout)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        except OverflowError as e:
+            return jsonify(error=f"server busy, {e}"), 503
+        except TimeoutError as e:
+            return jsonify(error=str(e)), 504
+        return jsonify(results=[{"image": name, **r.to_dict(ENDPOINTS[task])} for (name, _), r in zip(ims, results)])
+
+    return app
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser(description="Flask API exposing the PV fault detection cascade")
+    parser.add_argument("--host", default="0.0.0.0", help="host to listen on")
     parser.add_argument("--port", default=5000, type=int, help="port number")
+    parser.add_argument("--weights", default=ROOT / "best-solar.pt", help="PV array model path")
+    parser.add_argument("--weights-fault", default=ROOT / "best.pt", help="fault model path")
+    parser.add_argument("--weights-single", default=ROOT / "best-singlemodule.pt", help="single module model path")
+    parser.add_argument("--imgsz", "--img", "--img-size", nargs="+", type=int, default=[640], help="inference size h,w")
+    parser.add_argument("--conf-thres", type=float, default=0.25, help="PV array confidence threshold")
+    parser.add_argument("--device", default="", help="cuda device, i.e. 0 or 0,1,2,3 or cpu")
+    parser.add_argument("--half", action="store_true", help="use FP16 half-precision inference")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent batch workers")
+    parser.add_argument("--max-batch", type=int, default=8, help="maximum frames per batch")
+    parser.add_argument("--max-wait", type=float, default=5.0, help="maximum ms a batch waits for more frames")
+    parser.add_argument("--max-queue", type=int, default=64, help="maximum queued frames before 503")
+    parser.add_argument("--timeout", type=float, default=60.0, help="request timeout in seconds")
     opt = parser.parse_args()
+    opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
+    print_args(vars(opt))
+    opt.max_wait /= 1E3  # ms to seconds
+    return opt
 
-    # Fix known issue urllib.error.HTTPError 403: rate limit exceeded https://github.com/ultralytics/yolov5/pull/7210
-    torch.hub._validate_not_a_forked_repo = lambda a, b, c: True
 
-    model = torch.hub.load("ultralytics/yolov5", "yolov5s", force_reload=True)  # force_reload to recache
-    app.run(host="0.0.0.0", port=opt.port)  # debug=True causes Restarting with stat
+def main(opt):
+    kwargs = vars(opt)
+    host, port = kwargs.pop("host"), kwargs.pop("port")
+    app = create_app(**kwargs)
+    LOGGER.info(f"{colorstr('restapi:')} serving {', '.join(ENDPOINTS)} at http://{host}:{port}/v1/pv/")
+    app.run(host=host, port=port, threaded=True)  # debug=True causes Restarting with stat
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    main(opt)
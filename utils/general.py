@@ -43,6 +43,7 @@ NUM_THREADS = min(8, max(1, os.cpu_count() - 1))  # number of YOLOv5 multiproces
 AUTOINSTALL = str(os.getenv('YOLOv5_AUTOINSTALL', True)).lower() == 'true'  # global auto-install mode
 VERBOSE = str(os.getenv('YOLOv5_VERBOSE', True)).lower() == 'true'  # global verbose mode
 FONT = 'Arial.ttf'  # https://ultralytics.com/assets/Arial.ttf
+DET_DTYPE = np.dtype([('xyxy', np.float32, (4,)), ('conf', np.float32), ('cls', np.int32)])  # host-side detection
 
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
 np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
@@ -734,6 +735,97 @@ def clip_coords(boxes, shape):
         boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, shape[0])  # y1, y2
 
 
+def det2numpy(dets):
+    # Convert (n,6) [xyxy, conf, cls] detection tensor(s) to DET_DTYPE structured arrays in one device to host copy
+    if isinstance(dets, torch.Tensor):
+        return det2numpy([dets])[0]
+    y = torch.cat(dets).float().cpu().numpy() if dets else np.zeros((0, 6), dtype=np.float32)  # single sync
+    x = np.empty(len(y), dtype=DET_DTYPE)
+    x['xyxy'], x['conf'], x['cls'] = y[:, :4], y[:, 4], y[:, 5]
+    return np.split(x, np.cumsum([len(d) for d in dets])[:-1])
+
+
+def box_contain(boxes, containers, ioa_thres=0.0, eps=1E-7):
+    # Returns the (n,m) bool matrix of boxes(n,4) whose midpoint lies inside containers(m,4) and whose intersection
+    # over box area is >= ioa_thres. Boxes are x1y1x2y2, np.array or torch.Tensor
+    b, c = boxes[:, None], containers[None]
+    xc, yc = (b[..., 0] + b[..., 2]) / 2, (b[..., 1] + b[..., 3]) / 2  # box midpoints
+    inside = (xc > c[..., 0]) & (xc < c[..., 2]) & (yc > c[..., 1]) & (yc < c[..., 3])
+    if ioa_thres > 0:
+        mn, mx = (torch.min, torch.max) if isinstance(boxes, torch.Tensor) else (np.minimum, np.maximum)
+        inter = (mn(b[..., 2], c[..., 2]) - mx(b[..., 0], c[..., 0])).clip(0) * \
+                (mn(b[..., 3], c[..., 3]) - mx(b[..., 1], c[..., 1])).clip(0)
+        inside &= inter / ((b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1]) + eps) >= ioa_thres
+    return inside
+
+
+def box_grid_pairs(points, containers, cell=None, max_entries=None):
+    # Candidate (point, container) index pairs from a uniform grid index of containers(m,4) x1y1x2y2 and points(n,2)
+    # Containers are bucketed into every grid cell they cover, each point is paired with the containers of its cell.
+    # The cell size doubles until the buckets hold at most max_entries (default 16 * (n + m)) entries, so a few large
+    # containers among many small ones can't blow up the index
+    n, m = len(points), len(containers)
+    if not n or not m:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    max_entries = max_entries or 16 * (n + m)
+    cell = cell or max(float(np.median(containers[:, 2:] - containers[:, :2])), 1.0)  # grid cell size (pixels)
+    while True:
+        lo, hi = (np.floor(containers[:, i:i + 2] / cell).astype(np.int64) for i in (0, 2))
+        nx, ny = hi[:, 0] - lo[:, 0] + 1, hi[:, 1] - lo[:, 1] + 1
+        k = nx * ny  # cells per container
+        if k.sum() <= max_entries or k.max() == 1:
+            break
+        cell *= 2
+    pc = np.floor(points / cell).astype(np.int64)  # point cells
+    g0 = np.minimum(lo.min(0), pc.min(0))  # grid origin
+    gw = max(hi[:, 0].max(), pc[:, 0].max()) - g0[0] + 1  # grid width (cells)
+
+    # Bucket containers, one (cell, container) entry per covered cell
+    j = np.repeat(np.arange(m), k)
+    r = np.arange(k.sum()) - np.repeat(np.cumsum(k) - k, k)  # cell offset within each container
+    cells = (lo[j, 1] + r // nx[j] - g0[1]) * gw + (lo[j, 0] + r % nx[j] - g0[0])
+    order = cells.argsort(kind='stable')
+    cells, j = cells[order], j[order]
+
+    # Look up point cells
+    pcells = (pc[:, 1] - g0[1]) * gw + (pc[:, 0] - g0[0])
+    start, end = np.searchsorted(cells, pcells, 'left'), np.searchsorted(cells, pcells, 'right')
+    cnt = end - start
+    i = np.repeat(np.arange(n), cnt)
+    r = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+    return i, j[np.repeat(start, cnt) + r]
+
+
+def box_assign(boxes, containers, ioa_thres=0.0, max_pairs=int(4E6), eps=1E-7):
+    # Assigns boxes(n,4) to the container(m,4) holding their midpoint, i.e. PV modules and faults to PV arrays
+    # The container with the highest intersection over box area wins (lowest index on ties), boxes below ioa_thres or
+    # outside all containers get -1. Dense (n,m) join up to max_pairs, grid index beyond. Returns (n,) int64 indices
+    tensor = isinstance(boxes, torch.Tensor)
+    if tensor:
+        device = boxes.device
+        boxes, containers = boxes.cpu().numpy(), containers.cpu().numpy()
+    boxes, containers = np.asarray(boxes, dtype=np.float64)[:, :4], np.asarray(containers, dtype=np.float64)[:, :4]
+    n, m = len(boxes), len(containers)
+    out = np.full(n, -1, dtype=np.int64)
+    if n and m:
+        if n * m <= max_pairs:  # dense
+            i, j = np.nonzero(box_contain(boxes, containers))
+        else:  # grid index
+            i, j = box_grid_pairs((boxes[:, :2] + boxes[:, 2:]) / 2, containers)
+        b, c = boxes[i], containers[j]  # candidate pairs
+        xc, yc = (b[:, 0] + b[:, 2]) / 2, (b[:, 1] + b[:, 3]) / 2
+        inter = (np.minimum(b[:, 2], c[:, 2]) - np.maximum(b[:, 0], c[:, 0])).clip(0) * \
+                (np.minimum(b[:, 3], c[:, 3]) - np.maximum(b[:, 1], c[:, 1])).clip(0)
+        ioa = inter / ((b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]) + eps)
+        k = (xc > c[:, 0]) & (xc < c[:, 2]) & (yc > c[:, 1]) & (yc < c[:, 3]) & (ioa >= ioa_thres)
+        i, j, ioa = i[k], j[k], ioa[k]
+        order = np.lexsort((j, -ioa, i))  # by box, best ioa first, lowest container index on ties
+        i, j = i[order], j[order]
+        first = np.unique(i, return_index=True)[1]
+        out[i[first]] = j[first]
+    return torch.from_numpy(out).to(device) if tensor else out
+
+
 def non_max_suppression(prediction,
                         conf_thres=0.25,
                         iou_thres=0.45,
@@ -962,9 +1054,9 @@ def imread(path, flags=cv2.IMREAD_COLOR):
     return cv2.imdecode(np.fromfile(path, np.uint8), flags)
 
 
-def imwrite(path, im):
+def imwrite(path, im, params=()):
     try:
-        cv2.imencode(Path(path).suffix, im)[1].tofile(path)
+        cv2.imencode(Path(path).suffix, im, params)[1].tofile(path)
         return True
     except Exception:
         return False
@@ -5,6 +5,8 @@ Plotting utils
 
 import math
 import os
+import queue
+import threading
 from copy import copy
 from pathlib import Path
 from urllib.error import URLError
@@ -486,3 +488,95 @@ def save_one_box(xyxy, im, file=Path('im.jpg'), gain=1.02, pad=10, square=False,
         # cv2.imwrite(f, crop)  # https://github.com/ultralytics/yolov5/issues/7007 chroma subsampling issue
         Image.fromarray(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)).save(f, quality=95, subsampling=0)
     return crop
+
+
+def draw_fault(im, array, fault, conf):
+    # Fill the parent PV array red and box the fault with its confidence, in place
+    cv2.rectangle(im, (int(array[0]), int(array[1])), (int(array[2]), int(array[3])), (0, 0, 255), -1)
+    cv2.rectangle(im, (int(fault[0]), int(fault[1])), (int(fault[2]), int(fault[3])), (255, 255, 0), 5)
+    cv2.putText(im, f'{int(conf * 10000) / 100}%', (int(fault[0]) - 30, int(fault[1]) - 1), cv2.FONT_HERSHEY_SIMPLEX, 1,
+                (255, 0, 0), 2, cv2.LINE_AA)
+
+
+def plot_anomalies(im, r):
+    # Anomaly image for one CascadeResult, PV arrays holding faults filled red with the faults boxed on top
+    im = im.copy()
+    j = r.parents['faults']
+    for i in np.argsort(j, kind='stable')[np.sort(j) >= 0]:  # faults grouped by PV array, in order
+        draw_fault(im, r.arrays['xyxy'][j[i]], r.faults['xyxy'][i], r.faults['conf'][i])
+    return im
+
+
+def replay_frames(im, r):
+    # Yield the PV array -> module -> fault association of one CascadeResult step by step, one frame per step
+    for j, a in enumerate(r.arrays['xyxy']):
+        frame = im.copy()
+        yield frame
+        cv2.rectangle(frame, (int(a[0]), int(a[1])), (int(a[2]), int(a[3])), (0, 255, 0), 5)
+        yield frame
+        for m in r.modules['xyxy'][r.parents['modules'] == j]:
+            cv2.rectangle(frame, (int(m[0]), int(m[1])), (int(m[2]), int(m[3])), (255, 0, 0), 2)
+            yield frame
+        for f in r.faults[r.parents['faults'] == j]:
+            draw_fault(frame, a, f['xyxy'], f['conf'])
+            yield frame
+
+
+class ReplayViewer:
+    # Animate cascade results in a background thread, frames are dropped rather than stalling the caller
+    def __init__(self, delay=1000, maxsize=8):
+        """
+        Initializes the replay viewer.
+
+        Args:
+            delay (int): Milliseconds per replay step, press 's' to skip to the next frame and 'q' to stop viewing.
+            maxsize (int): Maximum number of frames waiting to be replayed, older frames are dropped when full.
+        """
+        self.delay = delay
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, name, im, r):
+        # Queue one original frame and its CascadeResult for replay, drops the oldest queued frame instead of blocking
+        while not self.stop.is_set():
+            try:
+                self.queue.put_nowait((name, im, r))
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def run(self):
+        while not self.stop.is_set():
+            item = self.queue.get()
+            if item is None:
+                break
+            name, im, r = item
+            for frame in replay_frames(im, r):
+                cv2.imshow(name, frame)
+                key = cv2.waitKey(self.delay) & 0xFF
+                if key == ord('q'):  # stop viewing
+                    self.stop.set()
+                if key == ord('s') or self.stop.is_set():  # skip to next frame
+                    break
+        cv2.destroyAllWindows()
+
+    def close(self, wait=True):
+        # Stop the viewer, by default once the frames already queued have been replayed
+        if not wait:
+            self.stop.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        if self.dropped:
+            LOGGER.info(f'Replay viewer dropped {self.dropped} frames')
@@ -0,0 +1,221 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Windowed readers for rasters larger than RAM, i.e. multi-gigabyte thermal orthomosaics
+
+open_raster() returns an array-like (h,w[,c]) image that reads only the requested window. .npy files are
+memory-mapped, tiled and stripped TIFFs are parsed in numpy and read one tile or strip at a time, any other image is
+decoded whole. Uncompressed TIFF chunks are zero-copy memory-mapped views, deflate compressed chunks are decoded once
+into a process-wide LRU chunk cache shared by all open rasters.
+
+Usage:
+    from utils.raster import open_raster
+    r = open_raster('orthomosaic.tif')  # TiffRaster, nothing decoded yet
+    r.shape, r.dtype  # (h, w, 3), uint8
+    window = r[8192:8832, 4096:4736]  # (640, 640, 3) BGR, only the chunks under the window are read
+    overview = r[::32, ::32]  # strided, 1/32 of the rows of uncompressed rasters are touched
+"""
+
+import mmap
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.general import LOGGER, cv2
+
+RASTER_FORMATS = 'npy', 'tif', 'tiff'  # formats read by window instead of decoded whole
+RASTER_CACHE_MB = float(os.getenv('YOLOv5_RASTER_CACHE_MB', 256))  # decoded chunk cache size budget (MB)
+
+# TIFF tag value types {type: (numpy dtype, items per value)}, https://www.awaresystems.be/imaging/tiff/specification
+TIFF_TYPES = {
+    1: ('u1', 1), 2: ('u1', 1), 3: ('u2', 1), 4: ('u4', 1), 5: ('u4', 2), 6: ('i1', 1), 7: ('u1', 1), 8: ('i2', 1),
+    9: ('i4', 1), 10: ('i4', 2), 11: ('f4', 1), 12: ('f8', 1), 13: ('u4', 1), 16: ('u8', 1), 17: ('i8', 1),
+    18: ('u8', 1)}
+TIFF_DEFLATE = 8, 32946  # compression tags decoded with zlib, 1 is uncompressed
+
+
+class ChunkCache:
+    # Thread-safe LRU cache of decoded raster chunks {(file, chunk): np.ndarray} within a byte budget
+    def __init__(self, max_mb=RASTER_CACHE_MB):
+        self.max_bytes = max_mb * (1 << 20)
+        self.lock = threading.Lock()
+        self.chunks = OrderedDict()  # least recent first
+        self.bytes, self.hits, self.misses = 0, 0, 0
+
+    def get(self, key):
+        with self.lock:
+            x = self.chunks.get(key)
+            if x is None:
+                self.misses += 1
+            else:
+                self.chunks.move_to_end(key)
+                self.hits += 1
+            return x
+
+    def put(self, key, x):
+        with self.lock:
+            if key not in self.chunks:
+                self.chunks[key] = x
+                self.bytes += x.nbytes
+            while self.bytes > self.max_bytes and len(self.chunks) > 1:
+                self.bytes -= self.chunks.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+            self.bytes = 0
+
+
+CHUNK_CACHE = ChunkCache()  # shared by all rasters of the process
+
+
+class TiffRaster:
+    # First (full resolution) image of a tiled or stripped, chunky, uncompressed or deflate TIFF/BigTIFF, read by window
+    def __init__(self, path, cache=None):
+        """
+        Parses the TIFF header and first image file directory, no pixels are read.
+
+        Args:
+            path (str or Path): TIFF file.
+            cache (ChunkCache, optional): Decoded chunk cache, the process-wide CHUNK_CACHE if None.
+
+        Raises:
+            ValueError: Not a TIFF, or a layout this reader does not support (i.e. LZW or JPEG compression, planar
+                configuration 2, sub-byte samples), open_raster() decodes these whole instead.
+        """
+        self.path, self.cache = str(path), cache or CHUNK_CACHE
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        b = self.mm
+        if b[:2] not in (b'II', b'MM'):
+            raise ValueError('not a TIFF file')
+        self.bo = '<' if b[:2] == b'II' else '>'  # byte order
+        version = self.value(2, 'u2')
+        if version == 42:  # TIFF
+            offset, n, entry, inline, count = self.value(4, 'u4'), 'u2', 12, 4, 'u4'
+        elif version == 43:  # BigTIFF
+            offset, n, entry, inline, count = self.value(8, 'u8'), 'u8', 20, 8, 'u8'
+        else:
+            raise ValueError(f'unknown TIFF version {version}')
+
+        # First image file directory, {tag: np.ndarray}
+        tags = {}
+        start = offset + np.dtype(n).itemsize
+        for i in range(self.value(offset, n)):
+            e = start + i * entry
+            tag, typ, cnt = self.value(e, 'u2'), self.value(e + 2, 'u2'), self.value(e + 4, count)
+            if typ not in TIFF_TYPES:
+                continue
+            dtype, k = TIFF_TYPES[typ]
+            size = np.dtype(dtype).itemsize * k * cnt
+            at = e + 4 + np.dtype(count).itemsize  # value inline or its offset
+            at = at if size <= inline else self.value(at, 'u4' if inline == 4 else 'u8')
+            tags[tag] = np.frombuffer(b, self.bo + dtype, cnt * k, at)
+
+        def tag(t, default=None):
+            return tags[t] if t in tags else default
+
+        w, h = int(tag(256)[0]), int(tag(257)[0])
+        spp = int(tag(277, [1])[0])  # samples per pixel
+        bits, fmt = int(tag(258, [8])[0]), int(tag(339, [1])[0])
+        self.compression, self.predictor = int(tag(259, [1])[0]), int(tag(317, [1])[0])
+        if bits % 8 or fmt not in (1, 2, 3):
+            raise ValueError(f'unsupported {bits}-bit sample format {fmt}')
+        if self.compression != 1 and self.compression not in TIFF_DEFLATE:
+            raise ValueError(f'unsupported compression {self.compression}')
+        if self.predictor not in (1, 2) or int(tag(284, [1])[0]) != 1:
+            raise ValueError('unsupported predictor or planar configuration')
+        self.file_dtype = np.dtype(f"{self.bo}{'uif'[fmt - 1]}{bits // 8}")
+        self.dtype = self.file_dtype.newbyteorder('=')  # of windows read
+        if 322 in tags:  # tiles
+            self.chunk_shape = int(tag(323)[0]), int(tag(322)[0])
+            self.offsets, self.counts = tags[324], tags[325]
+        else:  # strips, full width chunks
+            self.chunk_shape = min(int(tag(278, [h])[0]), h), w
+            self.offsets, self.counts = tags[273], tags[279]
+        self.grid = -(-h // self.chunk_shape[0]), -(-w // self.chunk_shape[1])  # chunk rows, columns
+        self.spp, self.bgr = spp, spp >= 3 and int(tag(262, [2])[0]) == 2  # RGB(A) samples returned as BGR
+        self.shape = (h, w, 3) if self.bgr else (h, w) if spp == 1 else (h, w, spp)
+        self.ndim, self.size = len(self.shape), int(np.prod(self.shape))
+
+    def value(self, offset, dtype):
+        # One integer of dtype at offset
+        return int(np.frombuffer(self.mm, self.bo + dtype, 1, offset)[0])
+
+    def chunk(self, j):
+        # Chunk j (rows, columns, spp), a view of the file if uncompressed else decoded through the chunk cache
+        th, tw = self.chunk_shape
+        rows = min(th, self.shape[0] - j // self.grid[1] * th)  # last strip may be short
+        offset, n = int(self.offsets[j]), int(self.counts[j])
+        if self.compression == 1 and self.predictor == 1:
+            return np.frombuffer(self.mm, self.file_dtype, rows * tw * self.spp, offset).reshape(rows, tw, self.spp)
+        key = self.path, j
+        x = self.cache.get(key)
+        if x is None:
+            b = self.mm[offset:offset + n]
+            x = np.frombuffer(zlib.decompress(b) if self.compression in TIFF_DEFLATE else b, self.file_dtype)
+            x = x[:rows * tw * self.spp].reshape(rows, tw, self.spp)
+            if self.predictor == 2:  # horizontal differencing
+                x = np.cumsum(x, axis=1, dtype=self.file_dtype)
+            self.cache.put(key, x)
+        return x
+
+    def __getitem__(self, key):
+        # Window of (y, x[, channel]) ints or positive step slices, reads only the chunks holding selected pixels
+        key = key if isinstance(key, tuple) else (key,)
+        yx = [k if isinstance(k, slice) else slice(k % n, k % n + 1) for k, n in zip(key[:2], self.shape)]
+        yx += [slice(None)] * (2 - len(yx))
+        (ys, sy), (xs, sx) = ((np.arange(*k.indices(n)), k.indices(n)[2]) for k, n in zip(yx, self.shape))
+        assert sy > 0 and sx > 0, 'raster windows support positive steps only'
+        out = np.empty((len(ys), len(xs), self.spp), dtype=self.dtype)
+        (th, tw), nx = self.chunk_shape, self.grid[1]
+        for r in np.unique(ys // th):
+            i0, i1 = np.searchsorted(ys, (r * th, (r + 1) * th))
+            rows = slice(ys[i0] - r * th, ys[i1 - 1] - r * th + 1, sy)
+            for c in np.unique(xs // tw):
+                j0, j1 = np.searchsorted(xs, (c * tw, (c + 1) * tw))
+                out[i0:i1, j0:j1] = self.chunk(r * nx + c)[rows, xs[j0] - c * tw:xs[j1 - 1] - c * tw + 1:sx]
+        out = out[..., 2::-1] if self.bgr else out[..., 0] if self.spp == 1 else out
+        out = out[tuple(0 if isinstance(k, (int, np.integer)) else slice(None) for k in key[:2])]  # drop int axes
+        return out[(..., key[2])] if len(key) > 2 else out
+
+    def __array__(self, dtype=None, copy=None):
+        x = self[:, :]
+        return x.astype(dtype) if dtype else x
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        try:
+            self.mm.close()
+        except BufferError:  # uncompressed chunk views still referenced, unmapped once they are released
+            pass
+
+
+def open_raster(path, cache=None):
+    """
+    Opens an image for windowed reads.
+
+    Args:
+        path (str or Path): .npy (h,w[,c]) array, TIFF or any image format OpenCV reads.
+        cache (ChunkCache, optional): Decoded TIFF chunk cache, the process-wide CHUNK_CACHE if None.
+
+    Returns:
+        np.ndarray or TiffRaster: (h,w[,c]) array-like sliced by window, memory-mapped for .npy, read by chunk for
+            TIFFs and decoded whole at its bit depth ((h,w) grayscale or BGR) for other formats and TIFF layouts
+            TiffRaster does not support, i.e. LZW compressed 16-bit TIFFs.
+    """
+    suffix = str(path).split('.')[-1].lower()
+    if suffix == 'npy':
+        return np.load(path, mmap_mode='r')
+    if suffix in ('tif', 'tiff'):
+        try:
+            return TiffRaster(path, cache)
+        except (ValueError, KeyError) as e:
+            LOGGER.warning(f'WARNING: {path}: {e}, decoding the whole image')
+    im = cv2.imread(str(path), cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)  # BGR or grayscale, 16-bit/float kept
+    assert im is not None, f'Image Not Found {path}'
+    return im
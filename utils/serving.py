@@ -0,0 +1,605 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Dynamic micro-batching for inference servers, concurrent single-frame requests run as batched cascade forward passes
+
+Requests are queued and collected by batch workers for up to max_wait seconds or max_batch frames, letterboxed to the
+cascade inference shape, run through one batched forward pass and NMS, and scattered back to the waiting futures.
+AsyncDetector exposes the same queue to asyncio code, model execution stays on the batch worker threads.
+
+Usage:
+    from utils.serving import AsyncDetector, MicroBatcher
+    batcher = MicroBatcher(workers=1, max_batch=8, max_wait=0.005, device='cpu')
+    future = batcher.submit(cv2.imread('test_folder/imgFC30.png'))  # concurrent.futures.Future of a CascadeResult
+    results = batcher([im1, im2], tasks=('faults',), timeout=10)  # blocking, list of CascadeResult
+    print(batcher.metrics())  # queue depth, batch sizes and queue latency percentiles
+
+    async with AsyncDetector(batcher) as detector:
+        results = await detector.detect([im1, im2])  # list of CascadeResult, queued frames cancelled on cancellation
+        async for (path, im, im0s, vid_cap, s), r in detector.stream(LoadImages('test_folder'), frame=lambda x: x[2]):
+            print(path, r)  # per-frame results in order as they complete
+
+    scheduler = FairScheduler(workers=2)  # UI jobs, one worker slot per concurrent run, round robin between users
+    with scheduler.ticket(user) as t:
+        t.wait()  # t.position() while queued
+
+    with ProcessDetector(processes=4, device='cpu') as pool:  # CPU worker processes sharing one copy of the models
+        for batch, results in pool.imap(batches):  # batches of LoadImages/LoadStreams items, results in order
+            ...  # letterboxed frames reach the workers through a shared memory FrameRing, not pickled
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+try:
+    from multiprocessing import shared_memory  # Python>=3.8
+except ImportError:
+    shared_memory = None
+
+from models.cascade import TASKS, CascadeDetector
+from utils.augmentations import letterbox
+from utils.general import LOGGER, colorstr
+from utils.torch_utils import select_device
+
+CPU_THREADS_PER_WORKER = 4  # intra-op threads per inference worker on CPU-only hosts with automatic worker count
+
+
+class MicroBatcher:
+    # Request queue in front of CascadeDetector, batch workers run queued frames in batches of up to max_batch
+    def __init__(self, workers=1, max_batch=8, max_wait=0.005, max_queue=64, window=1000, **kwargs):
+        """
+        Initializes the batcher and starts and warms up its batch workers.
+
+        Args:
+            workers (int): Batch worker threads, each with its own CascadeDetector sharing the registry models.
+            max_batch (int): Maximum frames per batch.
+            max_wait (float): Maximum seconds a batch waits for more frames after its first frame arrived.
+            max_queue (int): Maximum queued frames, submit() raises OverflowError beyond it.
+            window (int): Number of most recent frames and batches the latency and batch size metrics cover.
+            **kwargs: CascadeDetector arguments, i.e. weights, device, imgsz, half, conf_thres.
+        """
+        self.max_batch, self.max_wait, self.max_queue = max(max_batch, 1), max_wait, max_queue
+        self.kwargs = kwargs
+        self.queue = queue.Queue(max_queue)  # (future, im, tasks, submit time)
+        self.waits, self.sizes = deque(maxlen=window), deque(maxlen=window)  # queue seconds, batch sizes
+        self.requests, self.batches, self.rejected = 0, 0, 0
+        self.lock = threading.Lock()
+        self.names, self.error = None, None
+        self.ready = [threading.Event() for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self.worker, args=(e,), name=f'batcher{i}', daemon=True)
+            for i, e in enumerate(self.ready)]
+        for t in self.threads:
+            t.start()
+        for e in self.ready:
+            e.wait()  # models loaded and warmed up
+        if self.error:
+            self.close()
+            raise self.error
+
+    def worker(self, ready):
+        try:
+            cascade = CascadeDetector(**self.kwargs)
+            cascade.warmup(bs=1 if cascade.pt else self.max_batch)
+            self.names = cascade.names
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            ready.set()
+        while True:
+            batch = self.collect()
+            if batch is None:
+                break
+            self.run(cascade, batch)
+
+    def collect(self):
+        # Block for the first frame, then collect until max_batch frames or max_wait after it. None on close()
+        item = self.queue.get()
+        if item is None:
+            self.queue.put(None)  # stop the other workers too
+            return None
+        batch, deadline = [item], time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.perf_counter(), 0)) if self.max_wait else \
+                    self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)  # leave the stop signal for the next collect()
+                break
+            batch.append(item)
+        return batch
+
+    def run(self, cascade, batch):
+        # Run one collected batch per requested task set and resolve its futures, skipping cancelled requests
+        t = time.perf_counter()
+        batch = [x for x in batch if x[0].set_running_or_notify_cancel()]
+        groups = {}
+        for x in batch:
+            groups.setdefault(x[2], []).append(x)
+        for tasks, items in groups.items():
+            try:
+                results = cascade([x[1] for x in items], tasks=tasks)
+            except Exception as e:
+                for x in items:
+                    x[0].set_exception(e)
+                continue
+            for (future, _, _, t0), r in zip(items, results):
+                r.speed['queue'] = (t - t0) * 1E3
+                future.set_result(r)
+            with self.lock:
+                self.sizes.append(len(items))
+                self.batches += 1
+        with self.lock:
+            self.waits.extend(t - x[3] for x in batch)
+
+    def submit(self, im, tasks=TASKS, count=True):
+        """
+        Queues one frame.
+
+        Args:
+            im (np.ndarray): HWC BGR frame, must not be modified until the future is done.
+            tasks (tuple): Models to run, frames are only batched with frames requesting the same models.
+            count (bool): Count a full queue as a rejected request, False for callers that wait and retry.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the frame's CascadeResult. Raises OverflowError if the queue is full.
+        """
+        future = Future()
+        try:
+            self.queue.put_nowait((future, im, tuple(tasks), time.perf_counter()))
+        except queue.Full:
+            if count:
+                with self.lock:
+                    self.rejected += 1
+            raise OverflowError(f'{self.max_queue} frames queued') from None
+        with self.lock:
+            self.requests += 1
+        return future
+
+    def __call__(self, ims, tasks=TASKS, timeout=None):
+        # Queue frames and wait for their CascadeResults, cancelling the rest on overflow or timeout
+        futures = []
+        try:
+            for im in ims:
+                futures.append(self.submit(im, tasks))
+            return [f.result(timeout=timeout) for f in futures]
+        except FutureTimeoutError as e:
+            raise TimeoutError(f'no result within {timeout}s') from e
+        finally:
+            for f in futures:
+                f.cancel()  # no-op once running or done
+
+    def metrics(self):
+        # Queue depth, throughput counters, batch sizes and queue latency (ms) over the metrics window
+        with self.lock:
+            waits, sizes = np.array(self.waits) * 1E3, np.array(self.sizes)
+            m = {
+                'depth': self.queue.qsize(),
+                'max_queue': self.max_queue,
+                'max_batch': self.max_batch,
+                'max_wait': self.max_wait * 1E3,
+                'requests': self.requests,
+                'batches': self.batches,
+                'rejected': self.rejected}
+        m['batch_size'] = float(sizes.mean()) if len(sizes) else 0.0
+        m.update(zip(('queue_p50', 'queue_p90', 'queue_p99'),
+                     (float(x) for x in np.percentile(waits, (50, 90, 99))) if len(waits) else (0.0,) * 3))
+        return m
+
+    def close(self):
+        # Stop the batch workers once queued frames are done
+        self.queue.put(None)  # stop signal, passed on from worker to worker
+        for t in self.threads:
+            t.join()
+        LOGGER.info(f"{colorstr('batcher:')} {self.requests} frames in {self.batches} batches")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncDetector:
+    # asyncio front end of a MicroBatcher, awaiting frames does not hold an OS thread per request
+    def __init__(self, batcher=None, depth=8, **kwargs):
+        """
+        Initializes the async detector.
+
+        Args:
+            batcher (MicroBatcher, optional): Shared batcher, created from kwargs if omitted and closed with this
+                detector.
+            depth (int): Maximum frames in flight per stream().
+            **kwargs: MicroBatcher and CascadeDetector arguments used if batcher is omitted.
+        """
+        self.batcher, self.owner = batcher or MicroBatcher(**kwargs), batcher is None
+        self.depth = depth
+        self.names = self.batcher.names
+
+    async def submit(self, im, tasks=TASKS):
+        # Queue one frame, waiting for queue space instead of raising OverflowError, waits are not counted as rejected.
+        # Returns an asyncio future, cancelling it cancels the queued frame
+        while True:
+            try:
+                return asyncio.wrap_future(self.batcher.submit(im, tasks, count=False))
+            except OverflowError:
+                await asyncio.sleep(self.batcher.max_wait or 1E-3)
+
+    async def detect(self, frames, tasks=TASKS):
+        """
+        Detects frames, i.e. results = await detector.detect(frames).
+
+        Args:
+            frames (list): HWC BGR frames, must not be modified until done.
+            tasks (tuple): Models to run.
+
+        Returns:
+            list: One CascadeResult per frame. If the awaiting task is cancelled, i.e. on client disconnect, frames not
+                yet running are removed from the queue.
+        """
+        futures = []
+        try:
+            for im in frames:
+                futures.append(await self.submit(im, tasks))
+            return list(await asyncio.gather(*futures))
+        finally:
+            for f in futures:
+                f.cancel()  # no-op once done
+
+    async def stream(self, items, tasks=TASKS, frame=None, depth=None):
+        """
+        Streams per-frame results in order, keeping up to depth frames in flight.
+
+        Args:
+            items (iterable or async iterable): Frames or items holding frames, i.e. a LoadImages dataset. Blocking
+                iterables are advanced in the default executor.
+            tasks (tuple): Models to run.
+            frame (callable, optional): Returns the HWC BGR frame of an item, default the item itself.
+            depth (int, optional): Maximum frames in flight, default self.depth.
+
+        Yields:
+            (item, CascadeResult): Each item with its result. Closing or cancelling the iterator cancels queued frames.
+        """
+        pending = deque()
+        try:
+            async for item in iterate(items):
+                pending.append((item, await self.submit(frame(item) if frame else item, tasks)))
+                if len(pending) >= (depth or self.depth):
+                    item, f = pending.popleft()
+                    yield item, await f
+            while pending:
+                item, f = pending.popleft()
+                yield item, await f
+        finally:
+            for _, f in pending:
+                f.cancel()
+
+    async def close(self):
+        # Close the batcher if owned, without blocking the event loop
+        if self.owner:
+            await asyncio.get_running_loop().run_in_executor(None, self.batcher.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+async def iterate(items):
+    # Async iterator over an async or blocking iterable, blocking next() calls run in the default executor
+    if hasattr(items, '__aiter__'):
+        async for x in items:
+            yield x
+        return
+    it, loop, end = iter(items), asyncio.get_running_loop(), object()
+    while True:
+        x = await loop.run_in_executor(None, next, it, end)
+        if x is end:
+            break
+        yield x
+
+
+class Ticket:
+    # Place of one job in a FairScheduler, wait() for a worker slot, release() (or leave the with block) when done
+    def __init__(self, scheduler, user):
+        self.scheduler, self.user = scheduler, user
+        self.slot = None  # worker slot index once granted
+        self.granted = threading.Event()
+
+    def wait(self, timeout=None):
+        # True once a worker slot is granted
+        return self.granted.wait(timeout)
+
+    def position(self):
+        # 1-based queue position, 0 once running
+        return self.scheduler.position(self)
+
+    def release(self):
+        self.scheduler.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class FairScheduler:
+    # Bounded job queue granting a fixed number of worker slots round robin between users, FIFO per user
+    def __init__(self, workers=1, max_queue=32):
+        """
+        Initializes the scheduler.
+
+        Args:
+            workers (int): Worker slots, jobs running at once.
+            max_queue (int): Maximum jobs waiting, ticket() raises OverflowError beyond it.
+        """
+        self.workers, self.max_queue = workers, max_queue
+        self.free = list(range(workers))  # free worker slots
+        self.users = deque()  # users with waiting jobs, in turn order
+        self.jobs = {}  # user: deque of waiting tickets
+        self.lock = threading.Lock()
+
+    def ticket(self, user=None):
+        # Queue a job of user (i.e. a session id), returns its Ticket
+        with self.lock:
+            if sum(len(x) for x in self.jobs.values()) >= self.max_queue:
+                raise OverflowError(f'{self.max_queue} jobs queued')
+            t = Ticket(self, user)
+            if user not in self.jobs:
+                self.jobs[user] = deque()
+                self.users.append(user)
+            self.jobs[user].append(t)
+            self.dispatch()
+        return t
+
+    def dispatch(self):
+        # Grant free slots to the next waiting job of each user in turn, users move to the back once served
+        while self.free and self.users:
+            user = self.users.popleft()
+            t = self.jobs[user].popleft()
+            if self.jobs[user]:
+                self.users.append(user)
+            else:
+                del self.jobs[user]
+            t.slot = self.free.pop(0)
+            t.granted.set()
+
+    def release(self, t):
+        # Free the slot of a running job or remove a waiting one, i.e. cancelled
+        with self.lock:
+            if t.slot is not None:
+                self.free.append(t.slot)
+                t.slot = None
+            elif t.user in self.jobs and t in self.jobs[t.user]:
+                self.jobs[t.user].remove(t)
+                if not self.jobs[t.user]:
+                    del self.jobs[t.user]
+                    self.users.remove(t.user)
+            self.dispatch()
+
+    def position(self, t):
+        # Jobs granted before t in round robin order, +1. 0 if t is not waiting
+        with self.lock:
+            jobs = self.jobs.get(t.user)
+            if t.granted.is_set() or not jobs or t not in jobs:
+                return 0
+            k, u = jobs.index(t), self.users.index(t.user)  # t is its user's k-th job, its user has turn u
+            return 1 + k + sum(min(len(self.jobs[x]), k + (i < u)) for i, x in enumerate(self.users) if x != t.user)
+
+    def __len__(self):
+        return sum(len(x) for x in self.jobs.values())
+
+
+def cpu_workers(workers=0, threads=CPU_THREADS_PER_WORKER):
+    """
+    Partitions the CPU cores between concurrent inference workers on CPU-only hosts.
+
+    Args:
+        workers (int): Inference workers, 0 for one per threads cores.
+        threads (int): Intra-op threads per worker used to derive the automatic worker count.
+
+    Returns:
+        (int, int): Workers and torch intra-op threads per worker. torch.set_num_threads() is process wide, so
+            setting it to the per-worker count keeps the workers running at once from oversubscribing the cores.
+    """
+    cores = os.cpu_count() or 1
+    workers = workers or max(cores // threads, 1)
+    return workers, max(cores // workers, 1)
+
+
+class FrameRing:
+    # Ring of shared memory slots each holding one uint8 (b,3,h,w) letterboxed batch, passed between processes by name
+    def __init__(self, slots, shape, name=None):
+        """
+        Creates the shared memory block, or attaches to an existing one by name.
+
+        Args:
+            slots (int): Batches in flight at once, one slot each.
+            shape (tuple): Slot capacity (b,3,h,w), batches of at most b frames of at most h x w pixels fit.
+            name (str, optional): Shared memory block to attach to, created and owned by this ring if None.
+        """
+        self.slots, self.shape, self.owner = slots, tuple(shape), name is None
+        size = int(np.prod(self.shape))
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=slots * size if self.owner else 0)
+        self.buffer = np.ndarray((slots, size), dtype=np.uint8, buffer=self.shm.buf)
+        self.free = deque(range(slots)) if self.owner else None  # owner side slot allocation
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def fits(self, ims):
+        # Whether frames (list of (3,h,w) arrays of one shape) fit one slot
+        b, c, h, w = self.shape
+        return bool(self.free) and len(ims) <= b and ims[0].shape[0] == c and ims[0].shape[1] <= h and \
+            ims[0].shape[2] <= w
+
+    def put(self, ims):
+        # Copy frames into a free slot, returns (slot, batch shape) to send to the reading process
+        slot, shape = self.free.popleft(), (len(ims), *ims[0].shape)
+        view = self.view(slot, shape)
+        for x, y in zip(ims, view):
+            np.copyto(y, x)  # also makes letterbox transpose()[::-1] views contiguous
+        return slot, shape
+
+    def view(self, slot, shape):
+        # uint8 batch in slot, a view of the shared memory, torch.from_numpy() of it does not copy
+        return self.buffer[slot, :int(np.prod(shape))].reshape(shape)
+
+    def release(self, slot):
+        # Slot may be overwritten, its batch has been read
+        self.free.append(slot)
+
+    def close(self):
+        self.buffer = None  # drop the view before closing the mapping
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ProcessDetector:
+    # CPU cascade worker processes sharing one shared memory copy of the models, fed from a common frame queue
+    def __init__(self, processes=0, threads=0, depth=2, **kwargs):
+        """
+        Loads the models once, moves their weights to shared memory and starts the worker processes.
+
+        Args:
+            processes (int): Worker processes, 0 for one per CPU_THREADS_PER_WORKER cores.
+            threads (int): torch intra-op threads per process, 0 for cores // processes.
+            depth (int): Batches queued per process, more hides queueing latency at the cost of memory.
+            **kwargs: CascadeDetector arguments, i.e. weights, weights_fault, weights_single, imgsz, conf_thres.
+        """
+        device = select_device(kwargs.pop('device', 'cpu'))
+        assert device.type == 'cpu', 'ProcessDetector runs on CPU, use CascadeDetector(parallel=True) on CUDA'
+        cascade = CascadeDetector(device=device, **kwargs)
+        assert cascade.pt, 'ProcessDetector requires PyTorch *.pt models'
+        for m in cascade.models.values():
+            m.model.share_memory()  # workers map the same weights instead of copying them
+        self.stride, self.names, self.pt, self.imgsz = cascade.stride, cascade.names, cascade.pt, cascade.imgsz
+        self.processes, threads = cpu_workers(processes) if not threads else (processes or 1, threads)
+        self.depth = depth
+        self.dt, self.times = [0.0, 0.0, 0.0], (0.0, 0.0, 0.0)  # cumulative and last batch pre-process, inference, NMS
+
+        ctx = mp.get_context('spawn')  # fork is unsafe once torch threads are running
+        self.inputs, self.outputs = ctx.Queue(self.processes * depth), ctx.Queue()
+        kwargs = {**kwargs, 'device': device, 'models': cascade.models}
+        self.workers = [
+            ctx.Process(target=process_worker, args=(kwargs, threads, self.inputs, self.outputs), daemon=True)
+            for _ in range(self.processes)]
+        for p in self.workers:
+            p.start()
+        self.index, self.done = 0, {}  # next batch index, finished batches not yet returned
+        self.ring, self.slots = None, {}  # shared memory FrameRing for letterboxed batches, batch index: ring slot
+        LOGGER.info(f"{colorstr('ProcessDetector:')} {self.processes} processes x {threads} threads")
+
+    def submit(self, ims0, ims=None, tasks=TASKS):
+        # Queue one batch of HWC BGR frames (and letterboxed CHW RGB frames), returns its index for result()
+        i, self.index = self.index, self.index + 1
+        shapes = [x.shape for x in ims0]  # workers only need the original shapes, the frames stay in this process
+        if ims is None or any(x.shape != ims[0].shape for x in ims):
+            ims = [letterbox(x, self.imgsz, stride=self.stride, auto=False)[0].transpose((2, 0, 1))[::-1] for x in ims0]
+        if shared_memory:
+            if self.ring is None:  # sized for the first batch, larger batches are pickled
+                self.ring = FrameRing(self.processes * self.depth, (len(ims), 3, *self.imgsz))
+            if self.ring.fits(ims):
+                slot, shape = self.ring.put(ims)
+                self.slots[i] = slot
+                ims = (self.ring.name, self.ring.slots, self.ring.shape, slot, shape)
+        self.inputs.put((i, shapes, ims, tasks))
+        return i
+
+    def result(self, i):
+        # Wait for the results of batch i, a list of CascadeResult
+        while i not in self.done:
+            try:
+                j, y = self.outputs.get(timeout=1)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.workers):
+                    raise RuntimeError('ProcessDetector worker process died')
+                continue
+            self.done[j] = y
+        y = self.done.pop(i)
+        if i in self.slots:
+            self.ring.release(self.slots.pop(i))
+        if isinstance(y, BaseException):
+            raise y
+        self.times = tuple(y[0].speed[k] / 1E3 for k in ('preprocess', 'inference', 'nms')) if y else self.times
+        self.dt = [a + b for a, b in zip(self.dt, self.times)]
+        return y
+
+    def imap(self, batches, tasks=TASKS):
+        """
+        Runs batches of LoadImages/batch_loader() items (path, im, im0s, vid_cap, s, ...) in the worker processes.
+
+        Args:
+            batches (iterable): Lists of items, im (letterboxed CHW RGB) at index 1 and im0s (HWC BGR) at index 2.
+            tasks (tuple): Models to run.
+
+        Yields:
+            (list, list): Each batch with its CascadeResults, in order, with up to processes * depth batches in flight.
+                The dataset is read that far ahead of the results, per-frame state (i.e. batch_loader() mode and frame)
+                must be carried in the items, not read from the dataset.
+        """
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, self.submit([x[2] for x in batch], [x[1] for x in batch], tasks)))
+            if len(pending) >= self.processes * self.depth:
+                batch, i = pending.popleft()
+                yield batch, self.result(i)
+        while pending:
+            batch, i = pending.popleft()
+            yield batch, self.result(i)
+
+    def close(self):
+        # Stop the worker processes once queued batches are done
+        for _ in self.workers:
+            self.inputs.put(None)
+        for p in self.workers:
+            p.join()
+        if self.ring:
+            self.ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def process_worker(kwargs, threads, inputs, outputs):
+    # ProcessDetector worker process, runs queued batches with its own CascadeDetector on the shared models
+    torch.set_num_threads(threads)
+    cascade = CascadeDetector(**kwargs)
+    cascade.warmup()
+    rings = {}  # attached FrameRings by name
+    while True:
+        x = inputs.get()
+        if x is None:
+            break
+        i, shapes, ims, tasks = x
+        try:
+            if isinstance(ims, tuple):  # FrameRing slot, read in place
+                name, slots, shape, slot, batch = ims
+                if name not in rings:
+                    rings[name] = FrameRing(slots, shape, name=name)
+                ims = torch.from_numpy(rings[name].view(slot, batch))
+            ims0 = [np.broadcast_to(np.uint8(0), s) for s in shapes]  # one-byte stand-ins, only their shapes are read
+            outputs.put((i, cascade(ims0, ims, tasks=tasks)))
+        except Exception as e:
+            outputs.put((i, e))
+    for ring in rings.values():
+        ring.close()
@@ -0,0 +1,169 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Columnar results store, every PV array, module and fault box of a run in one queryable file
+
+Results are written in row groups while the run streams, to results.parquet if pyarrow is installed else to a
+results.db SQLite table. Both can be queried without re-reading any image.
+
+Usage:
+    from utils.store import ResultsStore, query
+    with ResultsStore('runs/detect/exp', survey='site-a') as store:
+        store.add('im.jpg', {'arrays': arrays, 'faults': faults}, parents={'faults': parents})  # DET_DTYPE arrays
+    df = query('runs/detect', task='faults', conf=0.5, survey='site-a')  # pandas DataFrame
+"""
+
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.general import LOGGER, colorstr
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+SCHEMA = {  # column: dtype
+    'survey': str,  # survey (run) name
+    'source': str,  # source image/video/stream
+    'frame': np.int64,  # video frame, 0 for images
+    'timestamp': np.float64,  # UNIX time the frame was processed
+    'task': str,  # arrays, faults or modules
+    'id': np.int32,  # box index within (source, frame, task)
+    'parent': np.int32,  # parent PV array id within (source, frame), -1 if none
+    'cls': np.int32,  # class index
+    'name': str,  # class name
+    'conf': np.float32,  # confidence
+    'x1': np.float32,  # box in original image pixels
+    'y1': np.float32,
+    'x2': np.float32,
+    'y2': np.float32}
+SQL_TYPES = {str: 'TEXT', np.int64: 'INTEGER', np.int32: 'INTEGER', np.float64: 'REAL', np.float32: 'REAL'}
+
+
+class ResultsStore:
+    # Detections of one run buffered in columns and written in row groups, Parquet with a SQLite fallback
+    def __init__(self, save_dir, survey='', batch_rows=65536, backend=None):
+        """
+        Initializes the results store.
+
+        Args:
+            save_dir (str or Path): Directory for results.parquet or results.db.
+            survey (str): Survey name stored with every row.
+            batch_rows (int): Rows buffered before a row group is written.
+            backend (str, optional): 'parquet' or 'sqlite', default parquet if pyarrow is installed.
+        """
+        self.backend = backend or ('parquet' if pa else 'sqlite')
+        assert self.backend in ('parquet', 'sqlite'), f'invalid results store backend {self.backend}'
+        assert self.backend == 'sqlite' or pa, 'parquet results store requires pyarrow, pip install pyarrow'
+        self.file = Path(save_dir) / ('results.parquet' if self.backend == 'parquet' else 'results.db')
+        self.survey, self.batch_rows = survey, batch_rows
+        self.columns, self.rows, self.n = {k: [] for k in SCHEMA}, 0, 0
+        self.writer = None
+        if self.backend == 'sqlite':
+            self.writer = sqlite3.connect(self.file, check_same_thread=False)
+            fields = ', '.join(f'{k} {SQL_TYPES[v]}' for k, v in SCHEMA.items())
+            self.writer.execute(f'CREATE TABLE IF NOT EXISTS results ({fields})')
+            self.writer.execute('CREATE INDEX IF NOT EXISTS results_query ON results (survey, task, conf)')
+
+    def add(self, source, dets, frame=0, parents=None, names=None, timestamp=None):
+        """
+        Buffers the detections of one frame, writing a row group once batch_rows rows are buffered.
+
+        Args:
+            source (str or Path): Source image/video/stream of the frame.
+            dets (dict): {task: DET_DTYPE structured array} in original image pixels.
+            frame (int): Video frame index.
+            parents (dict, optional): {task: (n,) parent PV array index, -1 if none}.
+            names (dict, optional): {task: class names}.
+            timestamp (float, optional): UNIX time of the frame, defaults to now.
+        """
+        parents, names, timestamp = parents or {}, names or {}, timestamp or time.time()
+        for task, det in dets.items():
+            n = len(det)
+            if not n:
+                continue
+            cls, xyxy = det['cls'].astype(np.int32), det['xyxy']
+            c = self.columns
+            c['survey'].append(np.full(n, self.survey, dtype=object))
+            c['source'].append(np.full(n, str(source), dtype=object))
+            c['frame'].append(np.full(n, frame, dtype=np.int64))
+            c['timestamp'].append(np.full(n, timestamp, dtype=np.float64))
+            c['task'].append(np.full(n, task, dtype=object))
+            c['id'].append(np.arange(n, dtype=np.int32))
+            c['parent'].append(np.asarray(parents.get(task, np.full(n, -1)), dtype=np.int32))
+            c['cls'].append(cls)
+            c['name'].append(np.array([names[task][i] for i in cls] if task in names else [''] * n, dtype=object))
+            c['conf'].append(det['conf'].astype(np.float32))
+            for i, k in enumerate(('x1', 'y1', 'x2', 'y2')):
+                c[k].append(xyxy[:, i].astype(np.float32))
+            self.rows += n
+        if self.rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        # Write buffered rows as one row group (Parquet) or one transaction (SQLite)
+        if not self.rows:
+            return
+        df = pd.DataFrame({k: np.concatenate(v) for k, v in self.columns.items()})
+        if self.backend == 'parquet':
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.file, table.schema)
+            self.writer.write_table(table, row_group_size=len(table))
+        else:
+            with self.writer:
+                self.writer.executemany(f"INSERT INTO results VALUES ({', '.join('?' * len(SCHEMA))})",
+                                        df.itertuples(index=False, name=None))
+        self.n += self.rows
+        self.columns, self.rows = {k: [] for k in SCHEMA}, 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            LOGGER.info(f"{colorstr('results:')} {self.n} boxes saved to {self.file}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def query(path, task=None, conf=0.0, survey=None, source=None, columns=None):
+    """
+    Queries results stores without re-reading images, i.e. all faults above conf 0.5 in survey 'site-a'.
+
+    Args:
+        path (str or Path): results.parquet/results.db file or a directory searched recursively for them.
+        task (str, optional): 'arrays', 'faults' or 'modules'.
+        conf (float): Minimum confidence.
+        survey (str, optional): Survey name.
+        source (str, optional): Source image/video/stream.
+        columns (list, optional): Columns to return, default all.
+
+    Returns:
+        pandas.DataFrame: Matching rows.
+    """
+    path = Path(path)
+    files = [path] if path.is_file() else sorted(path.rglob('results.parquet')) + sorted(path.rglob('results.db'))
+    where = {'task': task, 'survey': survey, 'source': source if source is None else str(source)}
+    where = {k: v for k, v in where.items() if v is not None}
+    columns = list(columns or SCHEMA)
+    dfs = []
+    for f in files:
+        if f.suffix == '.parquet':
+            assert pa, 'reading a parquet results store requires pyarrow, pip install pyarrow'
+            filters = [('conf', '>=', conf)] + [(k, '=', v) for k, v in where.items()]
+            dfs.append(pq.read_table(f, columns=columns, filters=filters).to_pandas())
+        else:
+            sql = f"SELECT {', '.join(columns)} FROM results WHERE conf >= ?" + ''.join(f' AND {k} = ?' for k in where)
+            with sqlite3.connect(f) as con:
+                dfs.append(pd.read_sql_query(sql, con, params=(conf, *where.values())))
+    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=columns)
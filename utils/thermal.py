@@ -0,0 +1,281 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Radiometric thermal input, 16-bit and float temperature frames instead of 8-bit false-color palettes
+
+Raw radiometric values (i.e. 16-bit TIFF counts or .npy temperature arrays) are mapped linearly to 8-bit grayscale over
+a temperature range taken per frame, per survey (fitted once on a sample of the survey frames) or fixed in °C. Integer
+frames go through a 64K-entry lookup table and float frames through one saturating OpenCV pass, so normalization costs
+about as much as decoding an 8-bit image. Frames are fed to the models as 1-channel tensors, broadcast on device to the
+3 input channels of the shipped models, and the raw array is kept as a lazily converted °C view for measurements.
+
+Usage:
+    from utils.thermal import Radiometric
+    radiometric = Radiometric('frame', scale=0.01, offset=-273.15)  # centikelvin counts, per-frame range
+    im, temperature = radiometric.imread('DJI_0001_R.tif')  # (h,w) uint8, °C view of the raw frame
+    temperature[100:120, 200:240].max()  # °C
+    hotspots(result, im0)  # result.stats per module and fault, max/mean/p95 and ΔT vs modules of the same PV array
+    $ python detection.py --source survey/ --radiometric --thermal-range survey --thermal-scale 0.01 \
+        --thermal-offset -273.15
+"""
+
+import numpy as np
+
+from utils.general import LOGGER, colorstr, cv2
+from utils.raster import RASTER_FORMATS, open_raster
+
+THERMAL_RANGES = 'frame', 'survey'  # per-frame min-max or one range fitted on the survey, else (lo, hi) in °C
+HOTSPOT_WINDOW = 2048  # boxes outside PV arrays of lazily read rasters are measured in windows of this size
+STATS_DTYPE = np.dtype([('max', np.float32), ('mean', np.float32), ('p95', np.float32), ('ref', np.float32),
+                        ('dt', np.float32)])  # per-box temperatures, reference and max - reference ΔT
+
+
+class RasterView:
+    # Lazily mapped (h,w) array-like, windows of raw are read and passed through fn on indexing
+    def __init__(self, raw, fn, dtype):
+        self.raw, self.fn, self.dtype = raw, fn, np.dtype(dtype)
+        self.shape, self.ndim = tuple(raw.shape[:2]), 2
+
+    def __getitem__(self, key):
+        return self.fn(self.raw[key])
+
+    def __array__(self, dtype=None, copy=None):
+        x = self[:, :]
+        return x.astype(dtype) if dtype else x
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class Radiometric:
+    # Linear normalization of single-channel radiometric frames to uint8 over a per-frame, per-survey or fixed range
+    def __init__(self, span='frame', scale=1.0, offset=0.0):
+        """
+        Initializes the normalization.
+
+        Args:
+            span (str or tuple): 'frame' for the min-max of each frame, 'survey' for one range fitted by fit(), or a
+                fixed (lo, hi) range in °C.
+            scale (float): Raw value to °C scale, i.e. 0.01 for centikelvin counts.
+            offset (float): Raw value to °C offset, i.e. -273.15 for centikelvin counts.
+        """
+        assert isinstance(span, (tuple, list)) or span in THERMAL_RANGES, \
+            f'invalid thermal range {span}, valid ranges are {THERMAL_RANGES} or (lo, hi) in °C'
+        self.span, self.scale, self.offset = span, scale, offset
+        self.range = tuple(map(float, span)) if isinstance(span, (tuple, list)) else None  # °C, fixed or fitted
+        self.lut = None  # (dtype, lo, hi, table) of the last integer range
+
+    def celsius(self, raw):
+        # Raw values to float32 °C
+        t = np.multiply(raw, self.scale, dtype=np.float32)
+        t += self.offset
+        return t
+
+    def raw_range(self, raw):
+        # (lo, hi) of this frame in raw units, the fixed or fitted range if set
+        if self.range:
+            return tuple(sorted((t - self.offset) / self.scale for t in self.range))
+        return float(raw.min()), float(raw.max())
+
+    def normalize(self, raw, lo, hi):
+        # (h,w) raw frame to uint8, lo to 0 and hi to 255, saturating
+        a = 255 / max(hi - lo, 1E-6)
+        if raw.dtype.kind in 'ui' and raw.dtype.itemsize <= 2:  # lookup table indexed by the unsigned bit pattern
+            u, lut = np.dtype(f'u{raw.dtype.itemsize}'), self.lut  # local, loader threads share the table
+            if lut is None or lut[:3] != (raw.dtype, lo, hi):
+                v = np.arange(1 << 8 * u.itemsize, dtype=u).view(raw.dtype.newbyteorder('=')).astype(np.float32)
+                self.lut = lut = raw.dtype, lo, hi, ((v - lo) * a + 0.5).clip(0, 255).astype(np.uint8)
+            return lut[3][raw.view(u.newbyteorder(raw.dtype.byteorder))]
+        raw = np.ascontiguousarray(raw, dtype=np.float32 if raw.dtype != np.float64 else None)
+        return cv2.convertScaleAbs(cv2.max(raw, lo), alpha=a, beta=-lo * a)  # >= lo, rounded and saturated to 255
+
+    def __call__(self, raw):
+        return self.normalize(raw, *self.raw_range(raw))
+
+    @staticmethod
+    def read(path, size=None):
+        # Raw frame of an image file, .npy and TIFF rasters strided down to about size on the long side if given
+        if str(path).split('.')[-1].lower() in RASTER_FORMATS:
+            raw = open_raster(path)
+            k = max(max(raw.shape[:2]) // size, 1) if size else 1
+            return np.asarray(raw[::k, ::k])
+        raw = cv2.imread(str(path), cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)  # 16-bit PNGs keep their depth
+        assert raw is not None, f'Image Not Found {path}'
+        return raw
+
+    def imread(self, path):
+        """
+        Reads one image file.
+
+        Args:
+            path (str): Image, .npy or TIFF file.
+
+        Returns:
+            (np.ndarray, RasterView or None): (h,w) uint8 normalized 16-bit/float frame and its °C view, or the 8-bit
+                (h,w) grayscale or (h,w,3) BGR image and None.
+        """
+        raw = self.read(path)
+        raw = raw[..., 0] if raw.ndim == 3 and raw.shape[2] == 1 else raw
+        if raw.dtype == np.uint8:  # palette or grayscale
+            return raw, None
+        raw = raw[..., 0] if raw.ndim == 3 else raw  # radiometric frames are single channel
+        return self(raw), RasterView(raw, self.celsius, np.float32)
+
+    def frame(self, raw):
+        # Normalization with a fixed range for raw, i.e. the per-frame range of a raster read tile by tile
+        if self.range:
+            return self
+        k = max(max(raw.shape[:2]) // 2048, 1)  # range of an overview, not the whole raster
+        lo, hi = (self.celsius(x) for x in self.raw_range(np.asarray(raw[::k, ::k])))
+        return Radiometric((lo, hi), self.scale, self.offset)
+
+    def fit(self, files, n=32):
+        """
+        Fits the survey range, the min-max over up to n frames evenly spaced through the survey.
+
+        Args:
+            files (list): Survey image files.
+            n (int): Frames to sample.
+
+        Returns:
+            tuple: (lo, hi) range in °C.
+        """
+        files = [files[i] for i in np.linspace(0, len(files) - 1, min(n, len(files))).round().astype(int)]
+        r = [(float(x.min()), float(x.max())) for x in (self.read(f, 1024) for f in files) if x.dtype != np.uint8]
+        if r:
+            lo, hi = min(x[0] for x in r), max(x[1] for x in r)
+            self.range = tuple(sorted(map(float, self.celsius(np.array((lo, hi))))))
+            LOGGER.info(f"{colorstr('radiometric:')} survey range {self.range[0]:.2f} to {self.range[1]:.2f} °C "
+                        f"fitted on {len(r)} frames")
+        return self.range
+
+
+def box_stats(t, xyxy):
+    """
+    Exact max, mean and p95 of the pixels inside each box, vectorized over all boxes whatever their shapes.
+
+    The mean comes from the summed-area table of one window covering the boxes. max and p95 are rank selections: the
+    window is quantized once to 16-256 monotonic bins (about 8 pixels per bin of the mean box), per-box histograms of
+    the box row spans (one np.bincount(), spans gathered by width) locate the bins holding the ranks, and only the
+    pixels of those bins are sorted to read the exact values. p95 interpolates linearly between its neighbouring ranks
+    like np.percentile(). Work grows with the box pixels, not the box count or shapes, see utils/benchmarks.py
+    --hotspots.
+
+    Args:
+        t (np.ndarray or RasterView): (h,w) temperature or intensity array, only the window covering the boxes is read.
+        xyxy (np.ndarray): (n,4) boxes in t pixels.
+
+    Returns:
+        np.ndarray: (n,3) float32 max, mean, p95, NaN for boxes without pixels.
+    """
+    n = len(xyxy)
+    out = np.full((n, 3), np.nan, dtype=np.float32)
+    b = np.asarray(xyxy).round().astype(np.int64).reshape(-1, 4)
+    b[:, [0, 2]], b[:, [1, 3]] = b[:, [0, 2]].clip(0, t.shape[1]), b[:, [1, 3]].clip(0, t.shape[0])
+    bw, bh = (b[:, 2] - b[:, 0]).clip(0), (b[:, 3] - b[:, 1]).clip(0)
+    k = np.nonzero(bw * bh > 0)[0]
+    if not len(k):
+        return out
+    b, bw, bh, m = b[k], bw[k], bh[k], len(k)
+    area = bw * bh
+    (x0, y0), (x1, y1) = b[:, :2].min(0), b[:, 2:].max(0)
+    win = np.asarray(t[y0:y1, x0:x1], dtype=np.float32)
+    bx0, by0, bx1, by1 = (b - [x0, y0, x0, y0]).T
+
+    # Mean
+    s = cv2.integral(win, sdepth=cv2.CV_64F)  # summed-area table
+    mean = (s[by1, bx1] - s[by0, bx1] - s[by1, bx0] + s[by0, bx0]) / area
+
+    # Per-box histograms of the window quantized once, monotonic so bins keep the pixel order
+    lo, hi = cv2.minMaxLoc(win)[:2]
+    e = int(np.clip(np.log2(area.mean() / 8), 4, 8))  # 2 ** e bins, about 8 pixels per bin
+    a = ((1 << e) - 1) / max(hi - lo, 1E-6)
+    q = cv2.convertScaleAbs(win, alpha=a, beta=-lo * a)  # (h,w) uint8 bins, rounded
+    box = np.repeat(np.arange(m), bh)  # box of each row span
+    ry, rx = by0[box] + np.arange(len(box)) - np.repeat(np.cumsum(bh) - bh, bh), bx0[box]
+    order = np.argsort(bw[box], kind='stable')
+    widths, starts = np.unique(bw[box][order], return_index=True)
+    spans = [(w, i, np.lib.stride_tricks.sliding_window_view(q, w, axis=1)[ry[i], rx[i]])
+             for w, i in zip(widths.tolist(), np.split(order, starts[1:]))]  # (rows, w) bins of spans of width w
+    keys, p = np.empty(area.sum(), dtype=np.int64), 0  # box * 2 ** e + bin of every box pixel
+    for w, i, x in spans:
+        np.add((box[i] << e)[:, None], x, out=keys[p:p + x.size].reshape(x.shape))
+        p += x.size
+    cdf = np.bincount(keys, minlength=m << e).reshape(m, 1 << e).cumsum(1)
+
+    # Bins of the ranks, p95 neighbours and max, from one np.searchsorted() over the row-offset cdfs
+    r = 0.95 * (area - 1)  # p95 rank
+    r0 = r.astype(np.int64)
+    ranks = np.stack((r0, np.minimum(r0 + 1, area - 1), area - 1), 1)
+    offset = np.arange(m)[:, None] * (area.max() + 1)  # cdfs of all boxes ascending in one array
+    j = np.searchsorted((cdf + offset).ravel(), ranks + offset, 'right') - (np.arange(m) << e)[:, None]
+    below = np.where(j[:, 0] > 0, cdf[np.arange(m), j[:, 0] - 1], 0)  # pixels in bins below the p95
+    j0, dj, top = j[:, 0].astype(np.uint8), (j[:, 1] - j[:, 0]).astype(np.uint8), j[:, 2].astype(np.uint8)
+
+    # Exact values, sorting only the pixels of the p95 bins and the top bin of each box
+    cy, cx, cb = [], [], []
+    for w, i, x in spans:
+        bi = box[i]
+        c = (x - j0[bi][:, None]) <= dj[bi][:, None]  # j0 <= x <= j1, uint8 wrap-around
+        c |= x == top[bi][:, None]
+        f = np.flatnonzero(c)
+        u = i[f // w]
+        cy.append(ry[u]), cx.append(rx[u] + f % w), cb.append(box[u])
+    cb = np.concatenate(cb)
+    cv = win[np.concatenate(cy), np.concatenate(cx)]
+    u = cv.view(np.int32)
+    cv = cv[np.argsort((u ^ ((u >> 31) & 0x7FFFFFFF)) + (cb << 32))]  # by box, then value as order-preserving int
+    cnt = np.bincount(cb, minlength=m)
+    start = np.cumsum(cnt) - cnt
+    v0, v1 = cv[start + ranks[:, 0] - below], cv[start + ranks[:, 1] - below]
+    out[k] = np.stack((cv[start + cnt - 1], mean, v0 + (v1 - v0) * (r - r0)), 1)
+    return out
+
+
+def hotspots(result, im0=None):
+    """
+    Measures the modules and faults of one CascadeResult, sets result.stats to {task: STATS_DTYPE array}.
+
+    ΔT is each box max minus the reference of its PV array, the median module mean temperature of the array. Boxes
+    outside all arrays are referenced against the modules outside all arrays.
+
+    Args:
+        result (CascadeResult): Cascade result with parents, measured on result.temperature if set.
+        im0 (np.ndarray, optional): BGR frame, its grayscale intensity is measured instead of 8-bit frames without a
+            radiometric temperature.
+
+    Returns:
+        dict: result.stats.
+    """
+    t = result.temperature
+    if t is None:
+        assert im0 is not None, 'hotspots() needs a radiometric result temperature or the frame'
+        gray = lambda x: cv2.cvtColor(np.ascontiguousarray(x), cv2.COLOR_BGR2GRAY) if x.ndim == 3 else x
+        t = gray(im0) if type(im0) is np.ndarray else RasterView(im0, gray, np.uint8)  # rasters read by window
+    stats = {}
+    for k in ('modules', 'faults'):
+        xyxy, parents = result[k]['xyxy'], result.parents[k]
+        x = np.empty((len(xyxy), 3), dtype=np.float32)
+        if isinstance(t, np.ndarray):  # frame, one pass
+            x[:] = box_stats(t, xyxy)
+        else:  # lazily read raster, one window per PV array
+            c = (xyxy[:, :2] + xyxy[:, 2:]) / 2 // HOTSPOT_WINDOW
+            groups = np.where(parents >= 0, parents, -1 - (c[:, 1] * 1E5 + c[:, 0])) if len(xyxy) else parents
+            for g in np.unique(groups):
+                i = groups == g
+                x[i] = box_stats(t, xyxy[i])
+        stats[k] = np.zeros(len(xyxy), dtype=STATS_DTYPE)
+        for j, name in enumerate(('max', 'mean', 'p95')):
+            stats[k][name] = x[:, j]
+
+    # ΔT against the median module mean of the same PV array
+    m, pm = stats['modules']['mean'], result.parents['modules']
+    for k in ('modules', 'faults'):
+        ref, p = stats[k]['ref'], result.parents[k]
+        ref[:] = np.nanmedian(m) if np.isfinite(m).any() else np.nan
+        for a in np.unique(p):
+            i = pm == a
+            if np.isfinite(m[i]).any():
+                ref[p == a] = np.nanmedian(m[i])
+        stats[k]['dt'] = stats[k]['max'] - ref
+    result.stats = stats
+    return stats
@@ -0,0 +1,196 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Tiled (sliced) cascade inference for high-resolution orthomosaics
+
+Overlapping tiles are read lazily from a windowed raster (utils/raster.py), run through the cascade in batches and
+shifted to global image coordinates. Boxes crossing tile seams, the only ones that can be cut or detected twice, are
+merged greedily by intersection over the smaller box: 'nmm' replaces each group by its union (stitching truncated
+modules and PV arrays spanning several tiles), 'nms' keeps the most confident box and 'wbf' fuses the group weighted by
+confidence.
+
+Usage:
+    from utils.tiling import LoadRasters, TiledDetector
+    tiler = TiledDetector(CascadeDetector(device='cpu'), tile=640, overlap=0.2, batch_size=8)
+    result = tiler(open_raster('orthomosaic.tif'))  # CascadeResult in mosaic pixels
+    $ python detection.py --source orthomosaic.tif --tile 640 --tile-overlap 0.2 --batch-size 8 --save-txt
+"""
+
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from models.cascade import TASKS, CascadeResult
+from utils.datasets import IMG_FORMATS
+from utils.general import DET_DTYPE, cv2
+from utils.raster import RASTER_FORMATS, open_raster
+from utils.thermal import Radiometric, RasterView
+
+TILE_MERGES = 'nmm', 'nms', 'wbf'  # seam box merging methods
+
+
+def tile_starts(n, tile, step):
+    # Tile offsets along one axis, every step pixels with the last tile flush with the image edge
+    if n <= tile:
+        return np.zeros(1, dtype=np.int64)
+    return np.unique(np.append(np.arange(0, n - tile, step), n - tile))
+
+
+class LoadRasters:
+    # Image files for tiled inference, yields (path, shape-only im, lazily read im0, None, s) like LoadImages
+    def __init__(self, path, radiometric=None):
+        p = str(Path(path).resolve())  # os-agnostic absolute path
+        if '*' in p:
+            files = sorted(glob.glob(p, recursive=True))  # glob
+        elif os.path.isdir(p):
+            files = sorted(glob.glob(os.path.join(p, '*.*')))  # dir
+        elif os.path.isfile(p):
+            files = [p]  # files
+        else:
+            raise Exception(f'ERROR: {p} does not exist')
+        self.files = [x for x in files if x.split('.')[-1].lower() in IMG_FORMATS + RASTER_FORMATS]
+        self.nf = len(self.files)
+        self.video_flag = [False] * self.nf
+        self.mode, self.frame = 'image', 0
+        self.radiometric = radiometric or Radiometric()  # 16-bit/float rasters, per-raster range by default
+        self.temperature = None  # °C view of the last raster if radiometric
+        assert self.nf > 0, f'No images found in {p}. Supported formats are: {IMG_FORMATS + RASTER_FORMATS}'
+
+    def __iter__(self):
+        self.count = 0
+        return self
+
+    def __next__(self):
+        if self.count == self.nf:
+            raise StopIteration
+        path = self.files[self.count]
+        self.count += 1
+        im0, self.temperature = open_raster(path), None
+        if im0.dtype != np.uint8:  # radiometric, tiles normalized as they are read with one range for the raster
+            im0 = im0 if im0.ndim == 2 else RasterView(im0, lambda x: x[..., 0], im0.dtype)  # single channel
+            radiometric = self.radiometric.frame(im0)
+            self.temperature = RasterView(im0, radiometric.celsius, np.float32)
+            im0 = RasterView(im0, radiometric, np.uint8)
+        im = np.broadcast_to(np.uint8(0), (3, *im0.shape[:2]))  # shape-only, the image is never decoded whole
+        return path, im, im0, None, f'image {self.count}/{self.nf} {path}: '
+
+    def __len__(self):
+        return self.nf
+
+
+class TiledDetector:
+    # CascadeDetector over overlapping tiles of one large image, results merged to one CascadeResult in image pixels
+    def __init__(self, cascade, tile=640, overlap=0.2, batch_size=8, merge='nmm', merge_thres=0.5):
+        """
+        Initializes the tiler.
+
+        Args:
+            cascade (CascadeDetector): Cascade the tiles are run through.
+            tile (int): Tile size in pixels, tiles are letterboxed to the cascade imgsz, equal sizes avoid resampling.
+            overlap (float): Overlap between neighbouring tiles as a fraction of the tile size, at least the size of
+                the largest single module or fault so every one of them is whole in some tile.
+            batch_size (int): Tiles per cascade batch.
+            merge (str): Seam box merging, 'nmm' (union), 'nms' (most confident box) or 'wbf' (weighted box fusion).
+            merge_thres (float): Minimum intersection over the smaller box for seam boxes of one class to merge.
+        """
+        assert merge in TILE_MERGES, f'invalid tile merge {merge}, valid methods are {TILE_MERGES}'
+        self.cascade, self.tile, self.batch_size = cascade, tile, max(batch_size, 1)
+        self.step = max(tile - int(tile * overlap), 1)
+        self.merge, self.merge_thres = merge, merge_thres
+        self.stride, self.names, self.pt, self.imgsz = cascade.stride, cascade.names, cascade.pt, cascade.imgsz
+        self.reader = ThreadPoolExecutor(1, thread_name_prefix='tiles')  # reads the next batch during inference
+        self.dt, self.times = [0.0, 0.0, 0.0], (0.0, 0.0, 0.0)  # cumulative and last image pre-process, inference, NMS
+
+    def windows(self, h, w):
+        # (n,4) x0, y0, x1, y1 tiles covering an h x w image, row-major
+        ys, xs = tile_starts(h, self.tile, self.step), tile_starts(w, self.tile, self.step)
+        x0, y0 = np.meshgrid(xs, ys)
+        x0, y0 = x0.ravel(), y0.ravel()
+        return np.stack((x0, y0, np.minimum(x0 + self.tile, w), np.minimum(y0 + self.tile, h)), 1)
+
+    @staticmethod
+    def read(im, windows):
+        # Tiles of im as contiguous HWC BGR arrays, only the windows are read from memory-mapped sources
+        tiles = []
+        for x0, y0, x1, y1 in windows:
+            x = np.ascontiguousarray(im[y0:y1, x0:x1])
+            tiles.append(cv2.cvtColor(x, cv2.COLOR_GRAY2BGR) if x.ndim == 2 else x)
+        return tiles
+
+    def seams(self, det, windows):
+        # Boxes intersecting more than one tile, the only ones that can be truncated or detected twice
+        b = det['xyxy']
+        xs, ys = np.unique(windows[:, [0, 2]], axis=0), np.unique(windows[:, [1, 3]], axis=0)
+        nx = ((b[:, None, 0] < xs[None, :, 1]) & (b[:, None, 2] > xs[None, :, 0])).sum(1)
+        ny = ((b[:, None, 1] < ys[None, :, 1]) & (b[:, None, 3] > ys[None, :, 0])).sum(1)
+        return (nx > 1) | (ny > 1)
+
+    def fuse(self, det, eps=1E-7):
+        # Greedy merge of boxes in descending confidence, groups of one class with intersection over the smaller box
+        # >= merge_thres. One row of the overlap matrix at a time, memory stays linear in the number of boxes
+        det = det[np.argsort(-det['conf'], kind='stable')]
+        b, conf, cls = det['xyxy'], det['conf'], det['cls']
+        area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+        done, keep = np.zeros(len(det), dtype=bool), []
+        for i in range(len(det)):
+            if done[i]:
+                continue
+            inter = (np.minimum(b[i, 2:], b[:, 2:]) - np.maximum(b[i, :2], b[:, :2])).clip(0).prod(1)
+            ios = inter / (np.minimum(area[i], area) + eps)  # intersection over the smaller box
+            g = np.flatnonzero(~done & (cls == cls[i]) & (ios >= self.merge_thres))
+            done[g] = True
+            x = det[i].copy()
+            if self.merge == 'nmm':  # union
+                x['xyxy'] = np.concatenate((b[g, :2].min(0), b[g, 2:].max(0)))
+            elif self.merge == 'wbf':  # confidence weighted mean
+                x['xyxy'] = (b[g] * conf[g, None]).sum(0) / conf[g].sum()
+                x['conf'] = conf[g].mean()
+            keep.append(x)
+        return np.array(keep, dtype=DET_DTYPE)
+
+    def __call__(self, im, tasks=TASKS):
+        """
+        Runs the cascade over the tiles of one image.
+
+        Args:
+            im (np.ndarray or TiffRaster): (h,w) or (h,w,3) BGR uint8 image, i.e. open_raster(), read one batch of
+                tiles at a time.
+            tasks (tuple): Models to run.
+
+        Returns:
+            CascadeResult: Merged detections in image pixels, speed with the tile count.
+        """
+        h, w = im.shape[:2]
+        windows = self.windows(h, w)
+        batches = [windows[i:i + self.batch_size] for i in range(0, len(windows), self.batch_size)]
+        dets, dt = {k: [] for k in TASKS}, [0.0, 0.0, 0.0]
+        future = self.reader.submit(self.read, im, batches[0])
+        for i, wb in enumerate(batches):
+            tiles = future.result()
+            if i + 1 < len(batches):
+                future = self.reader.submit(self.read, im, batches[i + 1])
+            for x, r in zip(wb, self.cascade(tiles, tasks=tasks)):
+                for k in TASKS:
+                    d = r[k].copy()
+                    d['xyxy'] += x[[0, 1, 0, 1]]  # tile to image pixels
+                    dets[k].append(d)
+            dt = [a + b for a, b in zip(dt, self.cascade.times)]
+
+        # Merge seam boxes
+        for k in TASKS:
+            d = np.concatenate(dets[k])
+            seam = self.seams(d, windows)
+            dets[k] = np.concatenate((d[~seam], self.fuse(d[seam])))
+        r = CascadeResult(*(dets[k] for k in TASKS), shape=(h, w, 3), names=self.names,
+                          ioa_thres=self.cascade.ioa_thres)
+        self.times = tuple(dt)
+        self.dt = [a + b for a, b in zip(self.dt, self.times)]
+        r.speed = {**dict(zip(('preprocess', 'inference', 'nms'), (t * 1E3 for t in dt))), 'tiles': len(windows)}
+        return r
+
+    def imap(self, batches, tasks=TASKS):
+        # Run batch_loader() batches of LoadRasters items, yields (batch, results) like ProcessDetector.imap()
+        for batch in batches:
+            yield batch, [self(x[2], tasks) for x in batch]
@@ -9,10 +9,12 @@ import platform
 import subprocess
 import time
 import warnings
+from collections import OrderedDict
 from contextlib import contextmanager
 from copy import deepcopy
 from pathlib import Path
 
+import numpy as np
 import torch
 import torch.distributed as dist
 import torch.nn as nn
@@ -256,6 +258,89 @@ def copy_attr(a, b, include=(), exclude=()):
             setattr(a, k, v)
 
 
+def fold_input_scale(model, scale=1 / 255):
+    # Fold a constant input scale into the first Conv2d of a PyTorch DetectMultiBackend, returns True once folded.
+    # Exact as convolution is linear and zero padding is unaffected, models then take 0-255 inputs (model.input_scaled)
+    if getattr(model, 'input_scaled', False):
+        return True
+    conv = next((m for m in getattr(model, 'model', model).modules() if isinstance(m, nn.Conv2d)), None)
+    if not getattr(model, 'pt', False) or conv is None:
+        return False  # non-PyTorch backend
+    with torch.no_grad():
+        conv.weight.mul_(scale)
+    model.input_scaled = True
+    return True
+
+
+class Preprocessor:
+    # uint8 images to normalized device tensors via reusable pinned staging and device buffers per batch shape
+    def __init__(self, device, fp16=False, model=None, max_shapes=4):
+        """
+        Initializes the preprocessor.
+
+        Args:
+            device (torch.device): Inference device, CUDA uploads are staged through pinned memory and non-blocking.
+            fp16 (bool): Output FP16 instead of FP32.
+            model (DetectMultiBackend, optional): Model the batches are for, inputs are left in 0-255 if its input
+                scale was folded by fold_input_scale(), 1-channel batches are broadcast to its input channels.
+            max_shapes (int): Batch shapes buffers are kept for, least recently used shapes are released.
+        """
+        self.device, self.fp16 = device, fp16
+        self.scale = None if getattr(model, 'input_scaled', False) else 255  # divisor
+        self.ch = getattr(getattr(model, 'model', None), 'yaml', {}).get('ch', 3)  # model input channels
+        self.cuda = device.type == 'cuda'
+        self.buffers = OrderedDict()  # shape: (host uint8, device uint8, output, upload done event), LRU order
+        self.max_shapes = max(max_shapes, 1)
+
+    def __call__(self, im):
+        """
+        Uploads and normalizes one batch. The returned tensor is overwritten by the next call with the same shape.
+
+        Args:
+            im (np.ndarray or torch.Tensor or list): uint8 (b,c,h,w) batch, (c,h,w) image or list of (c,h,w) images,
+                c the model input channels or 1.
+
+        Returns:
+            torch.Tensor: (b,ch,h,w) FP16/32 tensor on device, 0.0-1.0 unless the model input scale is folded.
+        """
+        shape = (len(im), *im[0].shape) if isinstance(im, (list, tuple)) else \
+            tuple(im.shape) if im.ndim == 4 else (1, *im.shape)
+        if shape not in self.buffers:
+            dtype = torch.half if self.fp16 else torch.float
+            self.buffers[shape] = (torch.empty(shape, dtype=torch.uint8, pin_memory=True) if self.cuda else None,
+                                   torch.empty(shape, dtype=torch.uint8, device=self.device) if self.cuda else None,
+                                   torch.empty(shape, dtype=dtype, device=self.device),
+                                   torch.cuda.Event() if self.cuda else None)
+            while len(self.buffers) > self.max_shapes:
+                event = self.buffers.popitem(last=False)[1][3]
+                if event:
+                    event.synchronize()  # pending upload from the released staging buffer
+        self.buffers.move_to_end(shape)
+        host, dev, out, event = self.buffers[shape]
+        tensor = lambda x: torch.from_numpy(np.ascontiguousarray(x)) if isinstance(x, np.ndarray) else x
+        if isinstance(im, (list, tuple)):  # frames, written one by one instead of np.stack()
+            ims, outs = [tensor(x) for x in im], out
+        else:  # batch
+            ims, outs = [tensor(im).view(shape)], [out]
+
+        # CUDA, stage uint8 in pinned memory and upload without blocking the host
+        if self.cuda and ims[0].device.type == 'cpu':
+            if len(ims) == 1 and ims[0].is_pinned():
+                dev.copy_(ims[0], non_blocking=True)  # DataLoader pin_memory batches upload directly
+            else:
+                event.synchronize()  # previous upload from this staging buffer finished
+                for x, h in zip(ims, host if len(ims) > 1 else [host]):
+                    h.copy_(x)
+                dev.copy_(host, non_blocking=True)
+                event.record()
+            ims, outs = [dev], [out]
+
+        # Cast and scale in one kernel into the reused output
+        for x, y in zip(ims, outs):
+            torch.div(x, self.scale, out=y) if self.scale else y.copy_(x)
+        return out.expand(-1, self.ch, -1, -1) if shape[1] == 1 else out  # single channel frames broadcast on device
+
+
 class EarlyStopping:
     # YOLOv5 simple early stopper
     def __init__(self, patience=30):
@@ -0,0 +1,226 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+SORT-like multi-object tracking of cascade detections across ordered survey frames and videos
+
+Every task keeps a set of constant-velocity Kalman box tracks, all predicted and updated at once as (n,7) states and
+(n,7,7) covariances. Detections are assigned to the predicted tracks of the same class by the Hungarian algorithm on
+the box_iou() matrix, the camera motion between frames (drone survey frames overlap 60-80%) is estimated by phase
+correlation and applied to all tracks before the assignment. Tracks get stable IDs, finished fault tracks seen in at
+least min_hits frames are consolidated to one record per physical fault.
+
+Usage:
+    from utils.tracking import CascadeTracker
+    tracker = CascadeTracker()
+    for path, im, im0, cap, s in LoadImages('survey/'):
+        r = cascade([im0], [im])[0]
+        tracker.update(r, im0, path)  # r.ids {task: (n,) track IDs}
+    records = tracker.close()  # one dict per tracked fault
+    $ python detection.py --source survey/ --track
+"""
+
+import numpy as np
+import torch
+
+from models.cascade import TASKS
+from utils.general import cv2
+from utils.metrics import box_iou
+
+# Constant velocity model of (cx, cy, area, aspect, vx, vy, varea), https://arxiv.org/abs/1602.00763
+KF_F = np.eye(7) + np.eye(7, k=4)  # transition
+KF_H = np.eye(4, 7)  # measurement
+KF_R = np.diag([1.0, 1.0, 10.0, 10.0])  # measurement noise
+KF_P = np.diag([10.0, 10.0, 10.0, 10.0, 1E4, 1E4, 1E4])  # initial covariance, unknown velocity
+KF_Q = np.diag([1.0, 1.0, 1.0, 1.0, 1E-2, 1E-2, 1E-4])  # process noise
+
+
+def xyxy2z(x):
+    # (n,4) boxes to (n,4) Kalman measurements cx, cy, area, aspect
+    w, h = x[:, 2] - x[:, 0], x[:, 3] - x[:, 1]
+    return np.stack(((x[:, 0] + x[:, 2]) / 2, (x[:, 1] + x[:, 3]) / 2, w * h, w / np.maximum(h, 1E-6)), 1)
+
+
+def z2xyxy(z):
+    # (n,>=4) Kalman states to (n,4) boxes
+    w = np.sqrt(np.maximum(z[:, 2] * z[:, 3], 0))
+    h = z[:, 2] / np.maximum(w, 1E-6)
+    return np.stack((z[:, 0] - w / 2, z[:, 1] - h / 2, z[:, 0] + w / 2, z[:, 1] + h / 2), 1)
+
+
+class SortTracker:
+    # Kalman box tracks of one task, batched predict/update and Hungarian IoU assignment per frame
+    def __init__(self, iou_thres=0.3, max_age=3, min_hits=3):
+        self.iou_thres, self.max_age, self.min_hits = iou_thres, max_age, min_hits
+        self.x, self.P = np.zeros((0, 7)), np.zeros((0, 7, 7))  # states, covariances
+        self.id, self.cls = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        self.age, self.hits = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)  # frames since update, updates
+        self.first, self.last, self.best = (np.zeros(0, dtype=np.int64) for _ in range(3))  # frame indices
+        self.conf, self.box = np.zeros(0), np.zeros((0, 4))  # best confidence and its box
+        self.dt = np.zeros(0)  # max ΔT, NaN without hotspot statistics
+        self.next_id, self.detections = 0, 0  # IDs and detections so far
+        self.finished = []  # finished tracks, (id, cls, hits, first, last, best, conf, box, dt)
+
+    def predict(self, shift=(0.0, 0.0)):
+        # Advance all tracks one frame, shifted by the camera motion, returns (n,4) predicted boxes
+        x, P = self.x, self.P
+        x[(x[:, 2] + x[:, 6]) <= 0, 6] = 0  # area never below 0
+        x[:] = x @ KF_F.T
+        x[:, :2] += shift
+        P[:] = KF_F @ P @ KF_F.T + KF_Q
+        self.age += 1
+        return z2xyxy(x)
+
+    def correct(self, i, z):
+        # Kalman update of tracks i with measurements z (m,4)
+        x, P = self.x[i], self.P[i]
+        S = KF_H @ P @ KF_H.T + KF_R
+        K = P @ KF_H.T @ np.linalg.inv(S)  # (m,7,4)
+        self.x[i] = x + (K @ (z - x @ KF_H.T)[..., None])[..., 0]
+        self.P[i] = (np.eye(7) - K @ KF_H) @ P
+
+    def assign(self, pred, det):
+        # Hungarian assignment on the IoU of same-class predictions and detections, returns (track, detection) pairs
+        from scipy.optimize import linear_sum_assignment
+
+        iou = box_iou(torch.from_numpy(pred), torch.from_numpy(det['xyxy'].astype(np.float64))).numpy()
+        iou[self.cls[:, None] != det['cls'][None]] = 0
+        rows, cols = np.nonzero((iou >= self.iou_thres).any(1))[0], np.nonzero((iou >= self.iou_thres).any(0))[0]
+        if not len(rows):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        i, j = linear_sum_assignment(iou[np.ix_(rows, cols)], maximize=True)  # only rows/columns with candidates
+        i, j = rows[i], cols[j]
+        k = iou[i, j] >= self.iou_thres
+        return i[k], j[k]
+
+    def update(self, det, frame, shift=(0.0, 0.0), dt=None):
+        """
+        Tracks one frame of detections.
+
+        Args:
+            det (np.ndarray): DET_DTYPE detections.
+            frame (int): Frame index, for the first, last and best frame of each track.
+            shift (tuple): Camera motion (dx, dy) in pixels since the previous frame.
+            dt (np.ndarray, optional): (n,) ΔT of the detections, see utils/thermal.hotspots().
+
+        Returns:
+            np.ndarray: (n,) track ID of every detection.
+        """
+        self.detections += len(det)
+        pred = self.predict(shift)
+        i, j = self.assign(pred, det) if len(self.x) and len(det) else (np.zeros(0, dtype=np.int64),) * 2
+        z = xyxy2z(det['xyxy'].astype(np.float64))
+        self.correct(i, z[j])
+        conf = det['conf'].astype(np.float64)
+        better = conf[j] > self.conf[i]
+        self.best[i[better]], self.conf[i[better]], self.box[i[better]] = frame, conf[j][better], det['xyxy'][j][better]
+        self.age[i], self.hits[i], self.last[i] = 0, self.hits[i] + 1, frame
+        if dt is not None:
+            self.dt[i] = np.fmax(self.dt[i], dt[j])
+
+        # New tracks for unassigned detections
+        new = np.setdiff1d(np.arange(len(det)), j)
+        n = len(new)
+        x = np.zeros((n, 7))
+        x[:, :4] = z[new]
+        ids = np.arange(self.next_id, self.next_id + n)
+        self.next_id += n
+        ones, frames = np.ones(n, dtype=np.int64), np.full(n, frame, dtype=np.int64)
+        self.x, self.P = np.concatenate((self.x, x)), np.concatenate((self.P, np.broadcast_to(KF_P, (n, 7, 7))))
+        self.id, self.cls = np.concatenate((self.id, ids)), np.concatenate((self.cls, det['cls'][new]))
+        self.age, self.hits = np.concatenate((self.age, ones - 1)), np.concatenate((self.hits, ones))
+        self.first, self.last, self.best = (np.concatenate((a, frames)) for a in (self.first, self.last, self.best))
+        self.conf, self.box = np.concatenate((self.conf, conf[new])), np.concatenate((self.box, det['xyxy'][new]))
+        self.dt = np.concatenate((self.dt, dt[new] if dt is not None else np.full(n, np.nan)))
+
+        out = np.empty(len(det), dtype=np.int64)
+        out[j], out[new] = self.id[i], ids
+        self.prune(self.age > self.max_age)
+        return out
+
+    def prune(self, k):
+        # Remove tracks k, keeping those seen in at least min_hits frames as finished
+        f = k & (self.hits >= self.min_hits)
+        self.finished.extend(zip(*(x[f].tolist() for x in (self.id, self.cls, self.hits, self.first, self.last,
+                                                               self.best, self.conf, self.box, self.dt))))
+        for a in ('x', 'P', 'id', 'cls', 'age', 'hits', 'first', 'last', 'best', 'conf', 'box', 'dt'):
+            setattr(self, a, getattr(self, a)[~k])
+
+
+class CascadeTracker:
+    # One SortTracker per cascade task over one ordered frame sequence, consolidated records of finished fault tracks
+    def __init__(self, iou_thres=0.3, max_age=3, min_hits=3, cmc=True, names=None, records=('faults',)):
+        """
+        Initializes the trackers.
+
+        Args:
+            iou_thres (float): Minimum IoU of a detection and a predicted track to assign them.
+            max_age (int): Frames a track is kept without detections.
+            min_hits (int): Frames a track must be detected in to be reported.
+            cmc (bool): Compensate camera motion between frames, estimated by phase correlation of the frames.
+            names (dict, optional): Class names per task, i.e. CascadeDetector.names.
+            records (tuple): Tasks consolidated to one record per track.
+        """
+        self.trackers = {k: SortTracker(iou_thres, max_age, min_hits) for k in TASKS}
+        self.cmc, self.names, self.tasks = cmc, names or {}, records
+        self.frames = []  # (path, frame) per update
+        self.prev = None  # previous frame, downscaled grayscale for phase correlation
+
+    def motion(self, im0, size=256):
+        # Camera motion (dx, dy) in im0 pixels since the previous frame, (0, 0) if unknown
+        g = im0 if im0.ndim == 2 else cv2.cvtColor(im0, cv2.COLOR_BGR2GRAY)
+        s = size / max(g.shape)
+        g = np.float32(cv2.resize(g, (round(g.shape[1] * s), round(g.shape[0] * s)), interpolation=cv2.INTER_AREA))
+        prev, self.prev = self.prev, g
+        if prev is None or prev.shape != g.shape:
+            return 0.0, 0.0
+        (dx, dy), response = cv2.phaseCorrelate(prev, g, cv2.createHanningWindow(g.shape[::-1], cv2.CV_32F))
+        return (dx / s, dy / s) if response > 0.05 else (0.0, 0.0)
+
+    def update(self, result, im0, path='', frame=0):
+        """
+        Tracks the next frame of the sequence.
+
+        Args:
+            result (CascadeResult): Cascade result of the frame, result.ids is set to {task: (n,) track IDs}.
+            im0 (np.ndarray): BGR frame, for the camera motion.
+            path (str): Frame source, reported in the records.
+            frame (int): Video frame number, 0 for images.
+
+        Returns:
+            dict: result.ids.
+        """
+        shift = self.motion(im0) if self.cmc else (0.0, 0.0)
+        f = len(self.frames)
+        self.frames.append((str(path), frame))
+        result.ids = {
+            k: t.update(result[k], f, shift, result.stats[k]['dt'] if k in result.stats else None)
+            for k, t in self.trackers.items()}
+        return result.ids
+
+    def close(self):
+        """
+        Finishes all tracks.
+
+        Returns:
+            list: One dict per finished track of the record tasks seen in at least min_hits frames, by task and first
+                frame.
+        """
+        records = []
+        for k in self.tasks:
+            t = self.trackers[k]
+            t.prune(np.ones(len(t.id), dtype=bool))
+            names = self.names.get(k)
+            records.extend({
+                'task': k,
+                'id': i,
+                'class': c,
+                'name': names[c] if names else str(c),
+                'frames': hits,
+                'first': self.frames[first],
+                'last': self.frames[last],
+                'best': self.frames[best],  # frame of the most confident detection
+                'confidence': conf,
+                'xyxy': box,  # in the best frame
+                'dt': None if dt != dt else dt}  # NaN without hotspot statistics
+                for i, c, hits, first, last, best, conf, box, dt in sorted(t.finished, key=lambda x: (x[3], x[0])))
+            t.finished = []
+        return records
@@ -0,0 +1,182 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Background result writers, buffered label sinks and a bounded image/crop/video encoding pool
+
+Usage:
+    from utils.writers import ImageWriter, LabelWriter
+    labels = LabelWriter(background=True)  # per-image *.txt files, written on a background thread
+    labels.add('runs/detect/exp/labels/im', rows)  # (n, 5|6) rows [cls, xywh(, conf)], any number of times
+    labels.flush()  # write everything added so far, one open() per file
+    labels.close()  # flush and wait for pending writes
+
+    images = ImageWriter(fmt='jpg', quality=90)  # encode and write on background threads
+    images.imwrite('runs/detect/exp/im.png', im)  # saved as im.jpg, blocks only when max_pending writes are queued
+    images.close()
+"""
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from utils.general import NUM_THREADS
+from utils.plots import save_one_box
+
+IMAGE_PARAMS = {  # cv2.imwrite() quality flag per output format
+    'jpg': cv2.IMWRITE_JPEG_QUALITY,
+    'jpeg': cv2.IMWRITE_JPEG_QUALITY,
+    'webp': cv2.IMWRITE_WEBP_QUALITY}
+
+
+def format_labels(rows):
+    # YOLO *.txt lines for (n, 5|6) label rows [cls, xywh(, conf)]
+    return ''.join(('%g ' * len(x)).rstrip() % tuple(x) + '\n' for x in rows)
+
+
+class LabelWriter:
+    # Label sink writing each labels file once per flush, optionally to a single JSONL file on a background thread
+    def __init__(self, jsonl=None, background=False):
+        """
+        Initializes the label writer.
+
+        Args:
+            jsonl (str or Path, optional): Append all labels to this JSONL file, one {"file", "labels"} record per
+                labels file, instead of writing *.txt files.
+            background (bool): Write on a background thread, flush() returns immediately.
+        """
+        self.jsonl = Path(jsonl) if jsonl else None
+        self.buffer = {}  # file: [rows]
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix='labels') if background else None  # 1 thread, in order
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def add(self, file, rows):
+        # Buffer (n, 5|6) label rows for file (without .txt suffix)
+        if len(rows):
+            self.buffer.setdefault(str(file), []).append(np.asarray(rows))
+
+    def flush(self):
+        # Write buffered rows, in the background if enabled. Raises errors of earlier background writes
+        buffer, self.buffer = self.buffer, {}
+        for f in [f for f in self.futures if f.done()]:
+            self.futures.remove(f)
+            f.result()
+        if not buffer:
+            return
+        if self.pool:
+            self.futures.append(self.pool.submit(self.write, buffer))
+        else:
+            self.write(buffer)
+
+    def write(self, buffer):
+        with self.lock:
+            if self.jsonl:
+                with open(self.jsonl, 'a') as f:
+                    for k, v in buffer.items():
+                        rows = [[float('%g' % x) for x in r] for r in np.concatenate(v)]  # *.txt label precision
+                        f.write(json.dumps({'file': k, 'labels': rows}) + '\n')
+            else:
+                for k, v in buffer.items():
+                    with open(k + '.txt', 'a') as f:
+                        f.write(''.join(format_labels(x) for x in v))
+
+    def close(self):
+        # Flush and wait for all pending writes
+        self.flush()
+        for f in self.futures:
+            f.result()
+        self.futures = []
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ImageWriter:
+    # Bounded background pool for image, crop and video outputs, submitting blocks once max_pending writes are queued
+    def __init__(self, fmt=None, quality=95, workers=min(4, NUM_THREADS), max_pending=16):
+        """
+        Initializes the image writer.
+
+        Args:
+            fmt (str, optional): Output image format, i.e. 'jpg', 'png' or 'webp', default the file's own suffix.
+            quality (int): JPEG/WebP quality 0-100.
+            workers (int): Encoding threads for images. Crops and video frames are written in order on one extra
+                thread, as crop file names are incremented on disk and video frames must stay ordered.
+            max_pending (int): Maximum queued writes before submitting blocks (backpressure).
+        """
+        self.fmt, self.quality = fmt and fmt.lower().lstrip('.'), quality
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='images')
+        self.serial = ThreadPoolExecutor(1, thread_name_prefix='images-serial')  # crops and video, in order
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = set()
+        self.lock = threading.Lock()
+        self.videos = {}  # slot: (path, cv2.VideoWriter)
+
+    def submit(self, pool, fn, *args, **kwargs):
+        self.pending.acquire()  # backpressure
+        future = pool.submit(fn, *args, **kwargs)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def done(self, future):
+        self.pending.release()
+        if future.exception() is None:
+            with self.lock:
+                self.futures.discard(future)  # keep failed futures, raised on close()
+
+    def imwrite(self, file, im):
+        # Write an image in the background, returns the file written to. im must not be modified afterwards
+        file = Path(file)
+        file = file.with_suffix(f'.{self.fmt}') if self.fmt else file
+        file = file.with_suffix('.png') if file.suffix.lower() == '.npy' else file  # .npy array sources
+        q = IMAGE_PARAMS.get(file.suffix[1:].lower())
+        self.submit(self.pool, self.write_image, str(file), im, [q, self.quality] if q else [])
+        return file
+
+    @staticmethod
+    def write_image(file, im, params):
+        assert cv2.imwrite(file, im, params), f'failed to write {file}'
+
+    def crop(self, xyxy, im, file, **kwargs):
+        # save_one_box() in the background, im must not be modified afterwards
+        self.submit(self.serial, save_one_box, xyxy, im, file=file, **kwargs)
+
+    def video(self, slot, file, im, fps=30, size=None):
+        # Append a frame to the *.mp4 video of writer slot, starting a new video whenever file changes
+        self.submit(self.serial, self.write_video, slot, str(Path(file).with_suffix('.mp4')), im, fps, size)
+
+    def write_video(self, slot, file, im, fps, size):
+        path, writer = self.videos.get(slot, (None, None))
+        if path != file:  # new video
+            if writer:
+                writer.release()  # release previous video writer
+            writer = cv2.VideoWriter(file, cv2.VideoWriter_fourcc(*'mp4v'), fps, size or im.shape[1::-1])
+            self.videos[slot] = file, writer
+        writer.write(im)
+
+    def close(self):
+        # Wait for all pending writes, release video writers and raise the first failed write
+        self.pool.shutdown()
+        self.serial.shutdown()
+        for _, writer in self.videos.values():
+            writer.release()
+        self.videos = {}
+        for f in self.futures:
+            f.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -15,37 +15,41 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
-from models.common import DetectMultiBackend
+from models.registry import load_model
 from utils.callbacks import Callbacks
 from utils.datasets import create_dataloader
 from utils.general import (LOGGER, check_dataset, check_img_size, check_requirements, check_yaml,
-                           coco80_to_coco91_class, colorstr, increment_path, non_max_suppression, print_args,
-                           scale_coords, xywh2xyxy, xyxy2xywh)
+                           coco80_to_coco91_class, colorstr, det2numpy, increment_path, non_max_suppression,
+                           print_args, scale_coords, xywh2xyxy, xyxy2xywh)
 from utils.metrics import ConfusionMatrix, ap_per_class, box_iou
 from utils.plots import output_to_target, plot_images, plot_val_study
-from utils.torch_utils import select_device, time_sync
+from utils.torch_utils import Preprocessor, select_device, time_sync
+from utils.writers import LabelWriter
 
 
-def save_one_txt(predn, save_conf, shape, file):
+def save_one_txt(predn, save_conf, shape, file, labels=None):
     """
     Save the predicted results in a txt file.
 
     Args:
-        predn (list): List of predicted bounding boxes and their corresponding class labels, confidence scores.
+        predn (torch.Tensor): Predicted bounding boxes (n,6) [xyxy, conf, cls] in native-space pixels.
         save_conf (bool): Flag indicating whether to save confidence scores along with the labels.
         shape (list): List containing the shape of the image.
-        file (str): Path to the output txt file.
+        file (str or Path): Path to the output txt file.
+        labels (LabelWriter, optional): Buffered label sink, the file is written when the sink is flushed.
 
     Returns:
         None
     """
     # Save one txt result
-    gn = torch.tensor(shape)[[1, 0, 1, 0]]  # normalization gain whwh
-    for *xyxy, conf, cls in predn.tolist():
-        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-        with open(file, 'a') as f:
-            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+    gn = np.array(shape, dtype=np.float32)[[1, 0, 1, 0]]  # normalization gain whwh
+    det = det2numpy(predn)
+    xywh = xyxy2xywh(det['xyxy']) / gn  # normalized xywh
+    rows = np.column_stack((det['cls'], xywh, det['conf']) if save_conf else (det['cls'], xywh))  # label format
+    sink = labels or LabelWriter()
+    sink.add(Path(file).with_suffix(''), rows)
+    if labels is None:  # unbuffered, write now
+        sink.flush()
 
 
 def save_one_json(predn, jdict, path, class_map):
@@ -179,7 +183,7 @@ def run(
         (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
         # Load model
-        model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+        model = load_model(weights, device=device, dnn=dnn, data=data, fp16=half)  # shared process-wide registry
         stride, pt, jit, engine = model.stride, model.pt, model.jit, model.engine
         imgsz = check_img_size(imgsz, s=stride)  # check image size
         half = model.fp16  # FP16 supported on limited backends with CUDA
@@ -230,16 +234,16 @@ def run(
     dt, p, r, f1, mp, mr, map50, map = [0.0, 0.0, 0.0], 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
     loss = torch.zeros(3, device=device)
     jdict, stats, ap, ap_class = [], [], [], []
+    labels = LabelWriter(background=True) if save_txt else None  # one write per image
+    preprocess = Preprocessor(device, half, model=model)  # reused pinned staging and device buffers
     callbacks.run('on_val_start')
     pbar = tqdm(dataloader, desc=s, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')  # progress bar
     for batch_i, (im, targets, paths, shapes) in enumerate(pbar):
         callbacks.run('on_val_batch_start')
         t1 = time_sync()
         if cuda:
-            im = im.to(device, non_blocking=True)
             targets = targets.to(device)
-        im = im.half() if half else im.float()  # uint8 to fp16/32
-        im /= 255  # 0 - 255 to 0.0 - 1.0
+        im = preprocess(im)  # uint8 to normalized fp16/32 on device
         nb, _, height, width = im.shape  # batch size, channels, height, width
         t2 = time_sync()
         dt[0] += t2 - t1
@@ -292,7 +296,7 @@ def run(
 
             # Save/log
             if save_txt:
-                save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / (path.stem + '.txt'))
+                save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / (path.stem + '.txt'), labels=labels)
             if save_json:
                 save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
             callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
@@ -300,12 +304,17 @@ def run(
         # Plot images
         if plots and batch_i < 3:
             f = save_dir / f'val_batch{batch_i}_labels.jpg'  # labels
-            Thread(target=plot_images, args=(im, targets, paths, f, names), daemon=True).start()
+            Thread(target=plot_images, args=(im.clone(), targets, paths, f, names), daemon=True).start()
             f = save_dir / f'val_batch{batch_i}_pred.jpg'  # predictions
-            Thread(target=plot_images, args=(im, output_to_target(out), paths, f, names), daemon=True).start()
+            Thread(target=plot_images, args=(im.clone(), output_to_target(out), paths, f, names), daemon=True).start()
 
+        if labels:
+            labels.flush()
         callbacks.run('on_val_batch_end')
 
+    if labels:
+        labels.close()
+
     # Compute metrics
     stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
     if len(stats) and stats[0].any():